@@ -0,0 +1,165 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from luamb._exceptions import LuambException
+
+
+# an archived environment is a stub directory containing these two files
+STUB_FILE_NAME = '.archived'
+ARCHIVE_FILE_NAME = 'env.tar.gz'
+
+# touched by the shell function on every activation
+LAST_ACTIVATED_FILE_NAME = '.last-activated'
+
+COMPRESS_LEVEL = 6
+
+# Python 3.12+ (and security backports) warn about or restrict extraction
+# without an explicit filter; 'tar' keeps symlinks and permissions
+if hasattr(tarfile, 'tar_filter'):
+    _EXTRACT_KWARGS = {'filter': 'tar'}
+else:
+    _EXTRACT_KWARGS = {}
+
+
+class ArchiveInfo(object):
+    """Stub metadata of an archived environment"""
+
+    def __init__(self, archived_at, last_activated=None, size=0,
+                 archive_size=0, project=None, spec=None, programs=()):
+        self.archived_at = archived_at
+        self.last_activated = last_activated
+        self.size = size
+        self.archive_size = archive_size
+        self.project = project
+        # EnvSpec dict
+        self.spec = spec
+        self.programs = list(programs)
+
+    def to_dict(self):
+        return {
+            'archived_at': self.archived_at,
+            'last_activated': self.last_activated,
+            'size': self.size,
+            'archive_size': self.archive_size,
+            'project': self.project,
+            'spec': self.spec,
+            'programs': self.programs,
+        }
+
+    @classmethod
+    def from_dict(cls, dct):
+        return cls(
+            archived_at=dct['archived_at'],
+            last_activated=dct.get('last_activated'),
+            size=dct.get('size', 0),
+            archive_size=dct.get('archive_size', 0),
+            project=dct.get('project'),
+            spec=dct.get('spec'),
+            programs=dct.get('programs', ()),
+        )
+
+
+def is_archived(env_path):
+    return os.path.isfile(os.path.join(env_path, STUB_FILE_NAME))
+
+
+def read_stub(env_path):
+    """Return ArchiveInfo or None if the environment is not archived"""
+    try:
+        with open(os.path.join(env_path, STUB_FILE_NAME)) as f:
+            return ArchiveInfo.from_dict(json.load(f))
+    except (IOError, OSError):
+        return None
+    except (ValueError, KeyError, TypeError):
+        raise LuambException(
+            "'{}' is not a valid archive stub".format(env_path))
+
+
+def get_last_activated(env_path):
+    try:
+        return os.path.getmtime(
+            os.path.join(env_path, LAST_ACTIVATED_FILE_NAME))
+    except OSError:
+        return None
+
+
+def get_last_used(env_path):
+    """Return the time of the last activation or of the creation"""
+    last_activated = get_last_activated(env_path)
+    if last_activated is not None:
+        return last_activated
+    return os.path.getmtime(env_path)
+
+
+def _swap(env_path, new_path):
+    """Replace env_path directory with new_path directory"""
+    old_path = new_path + '.old'
+    os.rename(env_path, old_path)
+    os.rename(new_path, env_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def archive(env_path, staging_dir, project=None, spec=None, programs=()):
+    """Pack the environment and replace it with a stub, return ArchiveInfo
+
+    The archive is built next to LUAMB_DIR environments (in staging_dir)
+    and swapped in only when complete, so an interrupted run leaves
+    the environment intact.
+    """
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    stub_path = tempfile.mkdtemp(prefix='archive-', dir=staging_dir)
+    os.chmod(stub_path, 0o755)
+    archive_path = os.path.join(stub_path, ARCHIVE_FILE_NAME)
+    sizes = []
+
+    def count_size(tarinfo):
+        sizes.append(tarinfo.size)
+        return tarinfo
+
+    info = ArchiveInfo(
+        archived_at=time.time(),
+        last_activated=get_last_activated(env_path),
+        project=project,
+        spec=spec,
+        programs=programs,
+    )
+    try:
+        with tarfile.open(
+                archive_path, 'w:gz', compresslevel=COMPRESS_LEVEL) as tar:
+            tar.add(env_path, arcname='.', filter=count_size)
+        info.size = sum(sizes)
+        info.archive_size = os.path.getsize(archive_path)
+        with open(os.path.join(stub_path, STUB_FILE_NAME), 'w') as f:
+            json.dump(info.to_dict(), f, indent=2, sort_keys=True)
+        _swap(env_path, stub_path)
+    except (IOError, OSError, tarfile.TarError) as exc:
+        shutil.rmtree(stub_path, ignore_errors=True)
+        raise LuambException("can't archive '{}': {}".format(env_path, exc))
+    return info
+
+
+def restore(env_path, staging_dir):
+    """Unpack the archived environment in place of its stub
+
+    The archive is decompressed as a stream, without seeking and without
+    creating a temporary uncompressed copy.
+    """
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    restore_path = tempfile.mkdtemp(prefix='restore-', dir=staging_dir)
+    try:
+        with open(os.path.join(env_path, ARCHIVE_FILE_NAME), 'rb') as f:
+            with tarfile.open(fileobj=f, mode='r|gz') as tar:
+                tar.extractall(restore_path, **_EXTRACT_KWARGS)
+        _swap(env_path, restore_path)
+    except (IOError, OSError, tarfile.TarError) as exc:
+        shutil.rmtree(restore_path, ignore_errors=True)
+        raise LuambException("can't restore '{}': {}".format(env_path, exc))
@@ -0,0 +1,463 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import errno
+import gzip
+import hashlib
+import json
+import os
+import platform
+import shutil
+import socket
+import tarfile
+import tempfile
+import time
+
+from luamb._archive import LAST_ACTIVATED_FILE_NAME
+from luamb._paths import PROJECT_FILE_NAME
+
+try:
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+
+ARTIFACT_SUFFIX = '.tar.gz'
+CHECKSUM_SUFFIX = '.sha256'
+LOCK_SUFFIX = '.lock'
+
+COMPRESS_LEVEL = 6
+
+# a lock older than this is considered abandoned (the node building
+# the artifact crashed), other nodes stop waiting for it
+DEFAULT_LOCK_TTL = 30 * 60
+DEFAULT_POLL_INTERVAL = 5
+HTTP_TIMEOUT = 60
+
+CHUNK_SIZE = 64 * 1024
+
+# bump to invalidate all artifacts
+ARTIFACT_FORMAT_VERSION = 1
+
+# per-machine files, not a part of the build
+EXCLUDED_FILE_NAMES = (PROJECT_FILE_NAME, LAST_ACTIVATED_FILE_NAME)
+
+STATUS_HIT = 'hit'
+STATUS_MISS = 'miss'
+STATUS_UPLOADED = 'uploaded'
+
+if hasattr(tarfile, 'tar_filter'):
+    _EXTRACT_KWARGS = {'filter': 'tar'}
+else:
+    _EXTRACT_KWARGS = {}
+
+
+class BinaryCacheError(Exception):
+
+    pass
+
+
+def get_platform_tag():
+    """Return a string identifying binary compatibility of the host"""
+    libc, libc_version = platform.libc_ver()
+    return '-'.join(part for part in (
+        platform.system().lower(),
+        platform.machine().lower(),
+        '{}{}'.format(libc, libc_version) if libc else None,
+    ) if part)
+
+
+def get_artifact_key(spec_dict, env_path, platform_tag=None):
+    """Return artifact name for the resolved spec
+
+    hererocks bakes the installation path into the interpreter and
+    scripts, so the absolute environment path is a part of the key:
+    nodes share artifacts only if they use the same LUAMB_DIR and
+    environment name.
+    """
+    platform_tag = platform_tag or get_platform_tag()
+    digest = hashlib.sha256(json.dumps({
+        'format': ARTIFACT_FORMAT_VERSION,
+        'spec': spec_dict,
+        'path': os.path.abspath(env_path),
+        'platform': platform_tag,
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+    return '{}-{}-{}-{}'.format(
+        spec_dict['lua_type'], spec_dict['lua_version'], platform_tag,
+        digest[:24])
+
+
+class _HashingReader(object):
+    """File-like wrapper computing SHA-256 of everything read"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+    def drain(self):
+        # tarfile stops at the end-of-archive marker, the gzip trailer
+        # and padding must be hashed too
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class _HashingWriter(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class DirectoryBackend(object):
+    """Cache in a local or network-mounted directory"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def open(self, name):
+        try:
+            return open(self._path(name), 'rb')
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise BinaryCacheError(str(exc))
+
+    def read(self, name):
+        f = self.open(name)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put(self, name, fileobj):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='.' + name, suffix='.tmp', dir=self.path)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+                os.chmod(tmp_path, 0o644)
+                # readers never see a partially written file
+                os.rename(tmp_path, self._path(name))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError) as exc:
+            raise BinaryCacheError(str(exc))
+
+    def create(self, name, data):
+        """Write the file only if it doesn't exist, return success"""
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd = os.open(
+                self._path(name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as exc:
+            if exc.errno == errno.EEXIST:
+                return False
+            raise BinaryCacheError(str(exc))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return True
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise BinaryCacheError(str(exc))
+
+
+def _http_request(url, method='GET', data=None, headers=None):
+    request = Request(url, data=data, headers=headers or {})
+    # Python 2 Request doesn't accept method argument
+    request.get_method = lambda: method
+    return urlopen(request, timeout=HTTP_TIMEOUT)
+
+
+class HTTPBackend(object):
+    """Cache on an HTTP server
+
+    Artifacts are downloaded with GET and uploaded with PUT. Locks are
+    created with conditional PUT (If-None-Match: *, the server must
+    respond 412 if the file exists) and removed with DELETE. A read-only
+    server is enough for nodes that don't upload.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def __str__(self):
+        return self.url
+
+    def _url(self, name):
+        return '{}/{}'.format(self.url, name)
+
+    def open(self, name):
+        try:
+            return _http_request(self._url(name))
+        except HTTPError as exc:
+            if exc.code == 404:
+                return None
+            raise BinaryCacheError('GET {}: {}'.format(self._url(name), exc))
+        except (URLError, IOError, OSError) as exc:
+            raise BinaryCacheError('GET {}: {}'.format(self._url(name), exc))
+
+    def read(self, name):
+        response = self.open(name)
+        if response is None:
+            return None
+        try:
+            return response.read()
+        except (IOError, OSError) as exc:
+            raise BinaryCacheError('GET {}: {}'.format(self._url(name), exc))
+        finally:
+            response.close()
+
+    def _put(self, name, data, headers):
+        try:
+            _http_request(
+                self._url(name), 'PUT', data=data, headers=headers).close()
+        except (URLError, IOError, OSError) as exc:
+            if isinstance(exc, HTTPError) and exc.code == 412:
+                return False
+            raise BinaryCacheError('PUT {}: {}'.format(self._url(name), exc))
+        return True
+
+    def put(self, name, fileobj):
+        # the body is streamed from the file
+        size = os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+        self._put(name, fileobj, {
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(size),
+        })
+
+    def create(self, name, data):
+        return self._put(name, data, {
+            'Content-Type': 'application/octet-stream',
+            'If-None-Match': '*',
+        })
+
+    def delete(self, name):
+        try:
+            _http_request(self._url(name), 'DELETE').close()
+        except HTTPError as exc:
+            if exc.code != 404:
+                raise BinaryCacheError(
+                    'DELETE {}: {}'.format(self._url(name), exc))
+        except (URLError, IOError, OSError) as exc:
+            raise BinaryCacheError(
+                'DELETE {}: {}'.format(self._url(name), exc))
+
+
+def get_backend(location):
+    if location.startswith(('http://', 'https://')):
+        return HTTPBackend(location)
+    if location.startswith('file://'):
+        location = location[len('file://'):]
+    return DirectoryBackend(os.path.abspath(os.path.expanduser(location)))
+
+
+class BinaryCache(object):
+    """Prebuilt environments stored as KEY.tar.gz with KEY.sha256
+
+    The checksum file is uploaded after the artifact, an artifact
+    without it is ignored.
+    """
+
+    def __init__(self, backend, upload=False, lock_ttl=DEFAULT_LOCK_TTL,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.backend = backend
+        self.upload = upload
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+
+    def __str__(self):
+        return str(self.backend)
+
+    def fetch(self, key, env_path, staging_dir):
+        """Download and unpack the artifact to env_path, return success
+
+        The artifact is unpacked as it is downloaded (to a staging
+        directory on the LUAMB_DIR filesystem renamed to env_path when
+        the checksum is verified).
+        """
+        checksum = self.backend.read(key + CHECKSUM_SUFFIX)
+        if checksum is None:
+            return False
+        expected = checksum.decode('ascii', 'replace').strip().split()[0]
+        stream = self.backend.open(key + ARTIFACT_SUFFIX)
+        if stream is None:
+            return False
+        if not os.path.isdir(staging_dir):
+            os.makedirs(staging_dir)
+        unpack_path = tempfile.mkdtemp(prefix='bincache-', dir=staging_dir)
+        try:
+            try:
+                reader = _HashingReader(stream)
+                with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+                    tar.extractall(unpack_path, **_EXTRACT_KWARGS)
+                reader.drain()
+            finally:
+                stream.close()
+            if reader.hexdigest() != expected:
+                raise BinaryCacheError(
+                    "checksum mismatch for '{}': expected {}, got {}".format(
+                        key + ARTIFACT_SUFFIX, expected, reader.hexdigest()))
+            os.rename(unpack_path, env_path)
+        except (IOError, OSError, tarfile.TarError) as exc:
+            shutil.rmtree(unpack_path, ignore_errors=True)
+            raise BinaryCacheError(
+                "can't unpack '{}': {}".format(key + ARTIFACT_SUFFIX, exc))
+        except BaseException:
+            shutil.rmtree(unpack_path, ignore_errors=True)
+            raise
+        return True
+
+    def store(self, key, env_path, staging_dir):
+        """Pack the environment and upload it"""
+        if not os.path.isdir(staging_dir):
+            os.makedirs(staging_dir)
+
+        def exclude(tarinfo):
+            if os.path.normpath(tarinfo.name) in EXCLUDED_FILE_NAMES:
+                return None
+            return tarinfo
+
+        with tempfile.TemporaryFile(dir=staging_dir) as f:
+            writer = _HashingWriter(f)
+            try:
+                # stream mode of tarfile doesn't accept compresslevel
+                with gzip.GzipFile(
+                        fileobj=writer, mode='wb',
+                        compresslevel=COMPRESS_LEVEL) as gz:
+                    with tarfile.open(fileobj=gz, mode='w|') as tar:
+                        tar.add(env_path, arcname='.', filter=exclude)
+            except (IOError, OSError, tarfile.TarError) as exc:
+                raise BinaryCacheError(
+                    "can't pack '{}': {}".format(env_path, exc))
+            f.seek(0)
+            self.backend.put(key + ARTIFACT_SUFFIX, f)
+        digest = '{}  {}\n'.format(writer.hexdigest(), key + ARTIFACT_SUFFIX)
+        with tempfile.TemporaryFile(dir=staging_dir) as f:
+            f.write(digest.encode('ascii'))
+            f.seek(0)
+            self.backend.put(key + CHECKSUM_SUFFIX, f)
+
+    def _read_lock(self, key):
+        data = self.backend.read(key + LOCK_SUFFIX)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            # being written
+            return {'created': time.time()}
+
+    def _is_stale(self, lock):
+        return time.time() - lock.get('created', 0) > self.lock_ttl
+
+    def is_locked(self, key):
+        """Return True if another node is building the artifact"""
+        lock = self._read_lock(key)
+        return lock is not None and not self._is_stale(lock)
+
+    def acquire_lock(self, key):
+        data = json.dumps({
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'created': time.time(),
+        }).encode('utf-8')
+        if self.backend.create(key + LOCK_SUFFIX, data):
+            return True
+        lock = self._read_lock(key)
+        if lock is not None and not self._is_stale(lock):
+            return False
+        # the holder is gone; if several nodes break the lock at once,
+        # only one of them wins the following create
+        self.backend.delete(key + LOCK_SUFFIX)
+        return self.backend.create(key + LOCK_SUFFIX, data)
+
+    def release_lock(self, key):
+        self.backend.delete(key + LOCK_SUFFIX)
+
+
+def fetch_or_build(cache, key, env_path, staging_dir, build, timer):
+    """Fetch the artifact or build it with build()
+
+    Return (status, build() return value or None, BinaryCacheError or
+    None). Cache errors are not fatal: the environment is built locally.
+    If another node holds the lock of the missing artifact, wait for it
+    instead of building the same artifact concurrently. Only nodes that
+    upload take the lock.
+    """
+    deadline = time.time() + cache.lock_ttl
+    locked = False
+    waited = False
+    error = None
+    while True:
+        try:
+            with timer.phase('download'):
+                if cache.fetch(key, env_path, staging_dir):
+                    return STATUS_HIT, None, None
+            if cache.upload and cache.acquire_lock(key):
+                locked = True
+                break
+            if time.time() >= deadline:
+                break
+            if not cache.is_locked(key):
+                if not waited:
+                    break
+                # the artifact may have been uploaded between the fetch
+                # and the lock check, try once more
+                waited = False
+                continue
+        except BinaryCacheError as exc:
+            error = exc
+            break
+        with timer.phase('wait'):
+            time.sleep(cache.poll_interval)
+        waited = True
+    if not locked:
+        return STATUS_MISS, build(), error
+    try:
+        value = build()
+        try:
+            with timer.phase('upload'):
+                cache.store(key, env_path, staging_dir)
+        except BinaryCacheError as exc:
+            return STATUS_MISS, value, exc
+    finally:
+        try:
+            cache.release_lock(key)
+        except BinaryCacheError:
+            # expires after lock_ttl
+            pass
+    return STATUS_UPLOADED, value, None
@@ -0,0 +1,244 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import codecs
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_TAIL_SIZE = 50
+
+# lines longer than this are truncated in the tail buffer (not in the log)
+MAX_TAIL_LINE_LENGTH = 4096
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class BuildLog(object):
+    """Line-oriented sink for build output
+
+    Everything written is appended to the log file (rotated when it grows
+    larger than max_bytes and on every open) and optionally echoed to
+    a file descriptor. Only the last tail_size lines are kept in memory.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES,
+                 backup_count=DEFAULT_BACKUP_COUNT,
+                 tail_size=DEFAULT_TAIL_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.echo_fd = None
+        self._tail = collections.deque(maxlen=tail_size)
+        self._partial = b''
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+
+    def open(self, append=False):
+        """Open the log file, rotate the previous one unless append"""
+        log_dir = os.path.dirname(self.path)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        if append:
+            self._file = open(self.path, 'ab')
+            self._size = self._file.tell()
+            return self
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            self._rotate()
+        self._file = open(self.path, 'wb')
+        self._size = 0
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._partial:
+                self._add_tail_line(self._partial)
+                self._partial = b''
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _rotate(self):
+        for index in range(self.backup_count - 1, 0, -1):
+            src = '{}.{}'.format(self.path, index)
+            if os.path.exists(src):
+                os.rename(src, '{}.{}'.format(self.path, index + 1))
+        if self.backup_count > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def _add_tail_line(self, line):
+        self._tail.append(
+            line[:MAX_TAIL_LINE_LENGTH].decode('utf-8', 'replace').rstrip())
+
+    def feed(self, data):
+        if not data:
+            return
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        with self._lock:
+            if self._file:
+                if self._size and self._size + len(data) > self.max_bytes:
+                    self._file.close()
+                    self._rotate()
+                    self._file = open(self.path, 'wb')
+                    self._size = 0
+                self._file.write(data)
+                self._file.flush()
+                self._size += len(data)
+            if self.echo_fd is not None:
+                try:
+                    os.write(self.echo_fd, data)
+                except OSError:
+                    pass
+            lines = (self._partial + data).split(b'\n')
+            self._partial = lines.pop()[:MAX_TAIL_LINE_LENGTH]
+            for line in lines:
+                self._add_tail_line(line)
+
+    @property
+    def tail(self):
+        with self._lock:
+            return list(self._tail)
+
+
+class _LogWriter(object):
+    """File-like object replacing sys.stdout/sys.stderr"""
+
+    encoding = 'utf-8'
+
+    def __init__(self, build_log):
+        self._build_log = build_log
+
+    def write(self, data):
+        self._build_log.feed(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _pump(fd, build_log):
+    while True:
+        try:
+            data = os.read(fd, READ_CHUNK_SIZE)
+        except OSError:
+            break
+        if not data:
+            break
+        build_log.feed(data)
+
+
+@contextlib.contextmanager
+def redirect_output(build_log, echo=True):
+    """Send all output of the process to the build log while in the block
+
+    Both Python-level writes (sys.stdout/sys.stderr) and output of child
+    processes inheriting descriptors 1 and 2 are redirected.
+    """
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (AttributeError, ValueError):
+            pass
+    saved_stdout, saved_stderr = sys.stdout, sys.stderr
+    try:
+        saved_fds = [os.dup(1), os.dup(2)]
+    except OSError:
+        saved_fds = None
+    reader = read_fd = None
+    if saved_fds:
+        if echo:
+            build_log.echo_fd = saved_fds[0]
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        reader = threading.Thread(target=_pump, args=(read_fd, build_log))
+        reader.daemon = True
+        reader.start()
+    elif echo:
+        build_log.echo_fd = 1
+    sys.stdout = sys.stderr = _LogWriter(build_log)
+    try:
+        yield build_log
+    finally:
+        sys.stdout, sys.stderr = saved_stdout, saved_stderr
+        if saved_fds:
+            # restoring descriptors closes the last write end of the pipe
+            # (unless a stray child process still holds it)
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            reader.join(5)
+            os.close(read_fd)
+            for fd in saved_fds:
+                os.close(fd)
+        build_log.echo_fd = None
+
+
+def _make_decoder():
+    return codecs.getincrementaldecoder('utf-8')('replace')
+
+
+def iter_log(path, lines=None):
+    """Yield the log contents in chunks or the last `lines` lines"""
+    with open(path, 'rb') as f:
+        if lines is None:
+            decoder = _make_decoder()
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield decoder.decode(chunk)
+        else:
+            for line in collections.deque(f, maxlen=lines):
+                yield line.decode('utf-8', 'replace')
+
+
+def follow_log(path, poll_interval=0.5, from_end=True):
+    """Yield new contents of the log forever, reopening it on rotation"""
+    f = None
+    inode = None
+    decoder = _make_decoder()
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, 'rb')
+                except (IOError, OSError):
+                    time.sleep(poll_interval)
+                    continue
+                inode = os.fstat(f.fileno()).st_ino
+                if from_end:
+                    f.seek(0, os.SEEK_END)
+                from_end = False
+            chunk = f.read(READ_CHUNK_SIZE)
+            if chunk:
+                yield decoder.decode(chunk)
+                continue
+            try:
+                rotated = os.stat(path).st_ino != inode
+            except OSError:
+                rotated = True
+            if rotated:
+                f.close()
+                f = None
+                continue
+            time.sleep(poll_interval)
+    finally:
+        if f is not None:
+            f.close()
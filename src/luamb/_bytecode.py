@@ -0,0 +1,270 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from luamb._exceptions import LuambException
+from luamb._mirror import lua_string
+from luamb._modindex import clean_environ
+from luamb._spec import MANIFEST_LUA_KEYS, read_hererocks_manifest
+
+
+BYTECODE_DIR = os.path.join('lib', 'luamb', 'bytecode')
+STAMP_FILE_NAME = 'stamp.json'
+BYTECODE_SUFFIX = 'c'
+
+# interpreters compiling bytecode with 'lua -b' (RaptorJIT dropped it)
+BCSAVE_LUA_TYPES = ('luajit', 'moonjit')
+
+# fallback when luac is not installed (e.g., builds from local sources)
+DUMP_SCRIPT = '''\
+local f = assert(loadfile({src}))
+local out = assert(io.open({out}, 'wb'))
+assert(out:write(string.dump(f, {strip})))
+assert(out:close())
+'''
+
+
+class CompileResult(object):
+
+    def __init__(self, compiler, compiled, reused, failed):
+        # see get_compiler()
+        self.compiler = compiler
+        self.compiled = compiled
+        self.reused = reused
+        # [(source path, error message)]
+        self.failed = failed
+
+
+def get_bytecode_dir(env_path):
+    return os.path.join(env_path, BYTECODE_DIR)
+
+
+def get_bytecode_path(env_path, source_path):
+    relpath = os.path.relpath(source_path, env_path)
+    return os.path.join(get_bytecode_dir(env_path), relpath + BYTECODE_SUFFIX)
+
+
+def get_source_copy_path(env_path, source_path):
+    """Return the path of the source copy bytecode was compiled from
+
+    Lua can't stat files without C modules, so the index compares
+    the source with this copy before loading bytecode.
+    """
+    relpath = os.path.relpath(source_path, env_path)
+    return os.path.join(get_bytecode_dir(env_path), relpath)
+
+
+def _get_lua_type(env_path):
+    manifest = read_hererocks_manifest(env_path)
+    for key, lua_type in MANIFEST_LUA_KEYS:
+        if key in manifest:
+            return lua_type, manifest[key]
+    raise LuambException(
+        "can't determine the interpreter of '{}'".format(env_path))
+
+
+def get_interpreter_key(env_path):
+    """Return a value that changes when the interpreter is rebuilt
+
+    Bytecode is specific to the interpreter version and build options.
+    """
+    lua_type, identifiers = _get_lua_type(env_path)
+    st = os.stat(os.path.join(env_path, 'bin', 'lua'))
+    return [lua_type, identifiers, st.st_size, st.st_mtime]
+
+
+def get_compiler(env_path):
+    """Return the tool compiling bytecode for the environment's interpreter
+
+    'luajit -b' for LuaJIT-family interpreters, 'luac' for PUC-Rio Lua
+    and 'string.dump' (run by the interpreter) if luac is missing.
+    """
+    lua_type = _get_lua_type(env_path)[0]
+    if lua_type in BCSAVE_LUA_TYPES:
+        return 'luajit -b'
+    if lua_type == 'lua' and os.path.isfile(
+            os.path.join(env_path, 'bin', 'luac')):
+        return 'luac'
+    return 'string.dump'
+
+
+def _make_command(env_path, compiler, source_path, output_path, strip):
+    bin_dir = os.path.join(env_path, 'bin')
+    if compiler == 'luajit -b':
+        # -g keeps debug info, stripping is the default of -b
+        return [os.path.join(bin_dir, 'lua'), '-b', '-s' if strip else '-g',
+                source_path, output_path]
+    if compiler == 'luac':
+        return [os.path.join(bin_dir, 'luac')] + (['-s'] if strip else []) + [
+            '-o', output_path, source_path]
+    return [os.path.join(bin_dir, 'lua'), '-e', DUMP_SCRIPT.format(
+        src=lua_string(source_path), out=lua_string(output_path),
+        strip='true' if strip else 'false')]
+
+
+def _read_stamp(bytecode_dir):
+    try:
+        with open(os.path.join(bytecode_dir, STAMP_FILE_NAME)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_stamp(bytecode_dir, stamp):
+    path = os.path.join(bytecode_dir, STAMP_FILE_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stamp, f)
+    os.rename(tmp_path, path)
+
+
+def _source_key(source_path):
+    st = os.stat(source_path)
+    return [st.st_size, st.st_mtime]
+
+
+def _compile_file(argv, tmp_path, output_path, source_path, key):
+    try:
+        proc = subprocess.Popen(
+            argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=clean_environ())
+    except OSError as exc:
+        return str(exc)
+    output = proc.communicate()[0].decode('utf-8', 'replace').strip()
+    if proc.returncode or not os.path.isfile(tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return output.splitlines()[-1] if output else 'compilation failed'
+    copy_path = output_path[:-len(BYTECODE_SUFFIX)]
+    try:
+        shutil.copyfile(source_path, copy_path)
+        if _source_key(source_path) != key:
+            raise OSError('source changed during compilation')
+    except (IOError, OSError) as exc:
+        os.remove(tmp_path)
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+        return str(exc)
+    os.rename(tmp_path, output_path)
+    return None
+
+
+def compile_modules(env_path, source_paths, jobs=None, strip=False):
+    """Compile Lua source files of the environment to bytecode
+
+    Bytecode files mirror the environment tree in BYTECODE_DIR. Files
+    whose source and interpreter haven't changed since the last run
+    are reused, bytecode of deleted sources is removed. Each bytecode
+    file is stored with a copy of its source (see
+    get_source_copy_path()).
+    """
+    compiler = get_compiler(env_path)
+    bytecode_dir = get_bytecode_dir(env_path)
+    interpreter_key = get_interpreter_key(env_path)
+    stamp = _read_stamp(bytecode_dir)
+    old_files = {}
+    if (stamp.get('interpreter') == interpreter_key
+            and stamp.get('strip') == strip):
+        old_files = stamp.get('files', {})
+    files = {}
+    tasks = []
+    reused = 0
+    for source_path in source_paths:
+        relpath = os.path.relpath(source_path, env_path)
+        key = _source_key(source_path)
+        output_path = get_bytecode_path(env_path, source_path)
+        if (old_files.get(relpath) == key and os.path.isfile(output_path)
+                and os.path.isfile(
+                    get_source_copy_path(env_path, source_path))):
+            files[relpath] = key
+            reused += 1
+            continue
+        output_dir = os.path.dirname(output_path)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        tmp_path = output_path + '.tmp'
+        argv = _make_command(
+            env_path, compiler, source_path, tmp_path, strip)
+        tasks.append((relpath, key, output_path,
+                      (argv, tmp_path, output_path, source_path, key)))
+
+    failed = []
+    if tasks:
+        jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+        pool = ThreadPool(jobs)
+        try:
+            errors = pool.map(lambda task: _compile_file(*task[3]), tasks)
+        finally:
+            pool.close()
+            pool.join()
+        for (relpath, key, output_path, _), error in zip(tasks, errors):
+            if error is None:
+                files[relpath] = key
+            else:
+                failed.append((os.path.join(env_path, relpath), error))
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+
+    for relpath in set(old_files) - set(files):
+        copy_path = os.path.join(bytecode_dir, relpath)
+        for path in (copy_path + BYTECODE_SUFFIX, copy_path):
+            if os.path.exists(path):
+                os.remove(path)
+    if not os.path.isdir(bytecode_dir):
+        os.makedirs(bytecode_dir)
+    _write_stamp(bytecode_dir, {
+        'interpreter': interpreter_key, 'strip': strip, 'files': files})
+    return CompileResult(compiler, len(tasks) - len(failed), reused, failed)
+
+
+def is_compiled(env_path):
+    return os.path.isfile(
+        os.path.join(get_bytecode_dir(env_path), STAMP_FILE_NAME))
+
+
+def get_strip_option(env_path):
+    return bool(_read_stamp(get_bytecode_dir(env_path)).get('strip'))
+
+
+def get_fresh_bytecode(env_path):
+    """Return {source path: (bytecode path, source copy path)}
+
+    Only bytecode compiled from the current source files by the current
+    interpreter is returned.
+    """
+    bytecode_dir = get_bytecode_dir(env_path)
+    stamp = _read_stamp(bytecode_dir)
+    if not stamp:
+        return {}
+    try:
+        if stamp.get('interpreter') != get_interpreter_key(env_path):
+            return {}
+    except (LuambException, OSError):
+        return {}
+    fresh = {}
+    for relpath, key in stamp.get('files', {}).items():
+        source_path = os.path.join(env_path, relpath)
+        copy_path = os.path.join(bytecode_dir, relpath)
+        output_path = copy_path + BYTECODE_SUFFIX
+        try:
+            if _source_key(source_path) != key:
+                continue
+        except OSError:
+            continue
+        if os.path.isfile(output_path) and os.path.isfile(copy_path):
+            fresh[source_path] = (output_path, copy_path)
+    return fresh
+
+
+def remove_bytecode(env_path):
+    bytecode_dir = get_bytecode_dir(env_path)
+    if not os.path.isdir(bytecode_dir):
+        return False
+    shutil.rmtree(bytecode_dir)
+    return True
@@ -0,0 +1,212 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import fnmatch
+import heapq
+import json
+import os
+import re
+
+from luamb._exceptions import LuambException
+from luamb._paths import list_env_names
+
+
+CATALOG_FILE_NAME = 'catalog.json'
+CATALOG_VERSION = 1
+
+QUERY_FIELDS = (
+    'name', 'lua', 'version', 'luarocks', 'project', 'profile', 'archived')
+
+_natural_key_re = re.compile(r'(\d+)')
+
+_non_release_version_re = re.compile(r'[/@:\\]')
+
+
+class Catalog(object):
+    """Cache of environment descriptions (Env.to_dict() values)
+
+    An entry is reloaded only when the inode or mtime of the environment
+    directory changes (luamb replaces or renames files in the environment
+    root on every change: spec, build, archiving). The LUAMB_DIR itself is
+    listed only when its mtime changes, i.e., when environments are added
+    or removed.
+    """
+
+    def __init__(self, env_dir, path, load_entry):
+        self.env_dir = env_dir
+        self.path = path
+        # env name -> JSON-serializable dict
+        self.load_entry = load_entry
+        self._dir_mtime = None
+        self._entries = {}
+        self._changed = False
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') != CATALOG_VERSION:
+            return
+        self._dir_mtime = data.get('dir_mtime')
+        self._entries = data.get('entries', {})
+
+    def save(self):
+        if not self._changed:
+            return
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            catalog_dir = os.path.dirname(self.path)
+            if not os.path.isdir(catalog_dir):
+                os.makedirs(catalog_dir)
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'version': CATALOG_VERSION,
+                    'dir_mtime': self._dir_mtime,
+                    'entries': self._entries,
+                }, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # the catalog is rebuilt next time
+            pass
+        self._changed = False
+
+    def refresh(self, full=False):
+        """Bring the catalog up to date, return self"""
+        if not full:
+            self._load()
+        dir_mtime = os.stat(self.env_dir).st_mtime
+        if full or dir_mtime != self._dir_mtime:
+            env_names = list_env_names(self.env_dir)
+            self._dir_mtime = dir_mtime
+            self._changed = True
+        else:
+            env_names = sorted(self._entries)
+        entries = {}
+        for env_name in env_names:
+            try:
+                st = os.stat(os.path.join(self.env_dir, env_name))
+            except OSError:
+                self._changed = True
+                continue
+            key = [st.st_ino, st.st_mtime]
+            entry = self._entries.get(env_name)
+            if full or entry is None or entry['key'] != key:
+                try:
+                    entry = {'key': key, 'env': self.load_entry(env_name)}
+                except LuambException:
+                    self._changed = True
+                    continue
+                self._changed = True
+            entries[env_name] = entry
+        if set(entries) != set(self._entries):
+            self._changed = True
+        self._entries = entries
+        return self
+
+    def __iter__(self):
+        """Yield entries (Env.to_dict() values) sorted by name"""
+        for env_name in sorted(self._entries):
+            yield self._entries[env_name]['env']
+
+
+def get_query_fields(entry):
+    """Return {field: string value} of catalog entry for matching"""
+    programs = entry.get('programs') or []
+    spec = entry.get('spec') or {}
+    lua = programs[0] if programs else {}
+    luarocks = {}
+    for identifiers in programs[1:]:
+        if identifiers.get('name') == 'LuaRocks':
+            luarocks = identifiers
+    lua_type = spec.get('lua_type')
+    if not lua_type and lua.get('name'):
+        lua_type = lua['name'].lower()
+    version = lua.get('version')
+    if not version:
+        # the spec has a path or git URI for non-release sources
+        version = spec.get('lua_version') or ''
+        if _non_release_version_re.search(version):
+            version = lua.get('major version') or ''
+    return {
+        'name': entry['name'],
+        'lua': lua_type or '',
+        'version': version,
+        'luarocks': (
+            luarocks.get('version') or spec.get('luarocks_version') or ''),
+        'project': entry.get('project') or '',
+        'profile': spec.get('profile') or '',
+        'archived': 'yes' if entry.get('archived') else 'no',
+    }
+
+
+def _check_field(field):
+    if field not in QUERY_FIELDS:
+        raise LuambException(
+            "unknown field '{}', available fields: {}".format(
+                field, ', '.join(QUERY_FIELDS)))
+
+
+def parse_where(text):
+    """Parse FIELD=PATTERN[,FIELD=PATTERN...] into list of pairs
+
+    Patterns are shell-style wildcards (fnmatch).
+    """
+    conditions = []
+    for condition in text.split(','):
+        field, sep, pattern = condition.partition('=')
+        field = field.strip()
+        if not sep or not field:
+            raise LuambException(
+                "invalid condition '{}', expected FIELD=PATTERN".format(
+                    condition))
+        _check_field(field)
+        conditions.append((field, pattern.strip()))
+    return conditions
+
+
+def parse_sort(text):
+    """Parse [-]FIELD, return (field, reverse)"""
+    reverse = text.startswith('-')
+    field = text.lstrip('-')
+    _check_field(field)
+    return field, reverse
+
+
+def _natural_key(value):
+    return [
+        (0, int(part), '') if part.isdigit() else (1, 0, part)
+        for part in _natural_key_re.split(value) if part
+    ]
+
+
+def query(entries, conditions=(), sort=None, limit=None):
+    """Yield matching entries lazily
+
+    Without sorting, entries are yielded as soon as they match.
+    With sorting and limit, only `limit` entries are kept in memory.
+    """
+    def iter_matching():
+        for entry in entries:
+            fields = get_query_fields(entry)
+            if all(fnmatch.fnmatchcase(fields[field], pattern)
+                   for field, pattern in conditions):
+                yield fields, entry
+
+    matching = iter_matching()
+    if sort:
+        field, reverse = sort
+
+        def key(item):
+            return _natural_key(item[0][field]), item[0]['name']
+
+        if limit is not None:
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            matching = iter(select(limit, matching, key=key))
+        else:
+            matching = iter(sorted(matching, key=key, reverse=reverse))
+    for count, (_, entry) in enumerate(matching):
+        if limit is not None and count >= limit:
+            return
+        yield entry
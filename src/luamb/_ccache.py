@@ -0,0 +1,351 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+
+# This module is imported by luamb and is also executed as a standalone
+# script by the built-in compiler wrapper, so it must not import anything
+# from the luamb package on module level.
+
+import contextlib
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+CACHE_DIR_VAR = 'LUAMB_COMPILER_CACHE_DIR'
+STATS_FILE_VAR = 'LUAMB_COMPILER_CACHE_STATS'
+
+MODES = ('auto', 'ccache', 'builtin')
+DISABLED_VALUES = ('', '0', 'off', 'false', 'no')
+
+# hererocks calls gcc (or cc on macOS) for PUC-Rio Lua, the LuaJIT family
+# makefiles call $(CC), which is gcc by default
+COMPILER_NAMES = ('gcc', 'cc', 'clang')
+
+CACHEABLE_SOURCE_EXTENSIONS = ('.c', '.s', '.S')
+
+# bump to invalidate all objects stored by the built-in wrapper
+WRAPPER_VERSION = '2'
+
+# compiler warnings are stored next to the object and replayed on hits
+DIAGNOSTICS_SUFFIX = '.stderr'
+
+
+class CompilerCacheError(Exception):
+
+    pass
+
+
+def find_executable(name, exclude_dir=None):
+    for path_dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if not path_dir:
+            continue
+        if exclude_dir and os.path.abspath(path_dir) == exclude_dir:
+            continue
+        path = os.path.join(path_dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def _shell_quote(string):
+    return "'{}'".format(string.replace("'", "'\\''"))
+
+
+class CompilerCacheStats(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.available = True
+
+    def __str__(self):
+        if not self.available:
+            return 'statistics are not available'
+        total = self.hits + self.misses
+        if not total:
+            return 'no cacheable compilations'
+        return '{} hits, {} misses ({:.0f}% hit rate)'.format(
+            self.hits, self.misses, 100.0 * self.hits / total)
+
+
+class CompilerCache(object):
+
+    ccache_hit_keys = (
+        # ccache 4.x
+        'direct_cache_hit',
+        'preprocessed_cache_hit',
+        # ccache 3.7
+        'cache_hit_direct',
+        'cache_hit_preprocessed',
+    )
+    ccache_miss_keys = ('cache_miss',)
+
+    def __init__(self, cache_dir, mode):
+        if mode not in MODES:
+            raise CompilerCacheError(
+                "invalid compiler cache mode: '{}', expected one of: "
+                "{}".format(mode, ', '.join(MODES)))
+        self.cache_dir = cache_dir
+        self.ccache = None
+        if mode != 'builtin':
+            self.ccache = find_executable('ccache')
+            if not self.ccache and mode == 'ccache':
+                raise CompilerCacheError('ccache executable not found')
+        self.mode = 'ccache' if self.ccache else 'builtin'
+        self.bin_dir = os.path.join(cache_dir, 'bin-' + self.mode)
+
+    @contextlib.contextmanager
+    def session(self):
+        """Route compiler calls through the cache while the block runs"""
+        stats = CompilerCacheStats()
+        self._write_shims()
+        environ_backup = {
+            key: os.environ.get(key)
+            for key in ('PATH', 'CCACHE_DIR', CACHE_DIR_VAR, STATS_FILE_VAR)
+        }
+        os.environ['PATH'] = os.pathsep.join(
+            [self.bin_dir, os.environ.get('PATH', os.defpath)])
+        stats_file = None
+        ccache_stats_before = None
+        if self.mode == 'ccache':
+            os.environ['CCACHE_DIR'] = os.path.join(self.cache_dir, 'ccache')
+            ccache_stats_before = self._read_ccache_stats()
+        else:
+            os.environ[CACHE_DIR_VAR] = os.path.join(
+                self.cache_dir, 'objects')
+            fd, stats_file = tempfile.mkstemp(
+                prefix='stats-', dir=self.cache_dir)
+            os.close(fd)
+            os.environ[STATS_FILE_VAR] = stats_file
+        try:
+            yield stats
+        finally:
+            if self.mode == 'ccache':
+                self._update_stats_from_ccache(stats, ccache_stats_before)
+            else:
+                self._update_stats_from_file(stats, stats_file)
+            for key, value in environ_backup.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+    def _write_shims(self):
+        if not os.path.isdir(self.bin_dir):
+            os.makedirs(self.bin_dir)
+        bin_dir = os.path.abspath(self.bin_dir)
+        if self.mode == 'ccache':
+            prefix = [self.ccache]
+        else:
+            prefix = [sys.executable, os.path.abspath(__file__)]
+        for name in COMPILER_NAMES:
+            shim_path = os.path.join(bin_dir, name)
+            real_compiler = find_executable(name, exclude_dir=bin_dir)
+            if not real_compiler:
+                if os.path.lexists(shim_path):
+                    os.remove(shim_path)
+                continue
+            command = ' '.join(
+                _shell_quote(arg) for arg in prefix + [real_compiler])
+            with open(shim_path, 'w') as f:
+                f.write('#!/bin/sh\nexec {} "$@"\n'.format(command))
+            os.chmod(shim_path, 0o755)
+
+    def _read_ccache_stats(self):
+        try:
+            output = subprocess.check_output(
+                [self.ccache, '--print-stats'], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        counters = {}
+        for line in output.decode('utf-8', 'replace').splitlines():
+            key, _, value = line.partition('\t')
+            if value.strip().isdigit():
+                counters[key.strip()] = int(value)
+        return counters
+
+    def _update_stats_from_ccache(self, stats, before):
+        after = self._read_ccache_stats()
+        if before is None or after is None:
+            stats.available = False
+            return
+
+        def delta(keys):
+            return sum(after.get(k, 0) - before.get(k, 0) for k in keys)
+
+        stats.hits = delta(self.ccache_hit_keys)
+        stats.misses = delta(self.ccache_miss_keys)
+
+    def _update_stats_from_file(self, stats, stats_file):
+        try:
+            with open(stats_file) as f:
+                for line in f:
+                    line = line.strip()
+                    if line == 'hit':
+                        stats.hits += 1
+                    elif line == 'miss':
+                        stats.misses += 1
+        except (IOError, OSError):
+            stats.available = False
+        finally:
+            try:
+                os.remove(stats_file)
+            except OSError:
+                pass
+
+
+# built-in compiler wrapper
+
+
+def _parse_compile_args(args):
+    """Return (source, output, args_without_output) or None
+
+    Only single-source compilations (-c) without dependency generation
+    are cacheable, everything else is passed through to the compiler.
+    """
+    if '-c' not in args:
+        return None
+    source = output = None
+    rest = []
+    args_iter = iter(args)
+    for arg in args_iter:
+        if arg == '-o':
+            output = next(args_iter, None)
+            if output is None:
+                return None
+            continue
+        if arg.startswith('-M') or arg in ('-', '-E', '-S'):
+            return None
+        if arg.startswith('-o'):
+            output = arg[2:]
+            continue
+        if not arg.startswith('-') and arg.endswith(
+                CACHEABLE_SOURCE_EXTENSIONS):
+            if source is not None:
+                return None
+            source = arg
+        rest.append(arg)
+    if source is None:
+        return None
+    if output is None:
+        output = os.path.splitext(os.path.basename(source))[0] + '.o'
+    return source, output, rest
+
+
+def _compiler_identity(compiler):
+    st = os.stat(os.path.realpath(compiler))
+    return '{}:{}:{}'.format(os.path.realpath(compiler), st.st_size,
+                             int(st.st_mtime))
+
+
+def _record_stat(result):
+    stats_file = os.environ.get(STATS_FILE_VAR)
+    if not stats_file:
+        return
+    try:
+        # O_APPEND writes of a few bytes are atomic on POSIX
+        fd = os.open(stats_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, (result + '\n').encode('ascii'))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def _store_file(path, data):
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def _store_object(output, diagnostics, object_path):
+    # diagnostics go first: an entry is complete once its object exists
+    if diagnostics:
+        _store_file(object_path + DIAGNOSTICS_SUFFIX, diagnostics)
+    with open(output, 'rb') as f:
+        _store_file(object_path, f.read())
+
+
+def _write_stderr(data):
+    if data:
+        stream = getattr(sys.stderr, 'buffer', sys.stderr)
+        stream.write(data)
+        stream.flush()
+
+
+def _strip_working_directory(preprocessed):
+    """Remove the working directory line marker from -E output
+
+    GCC emits it with -g, and hererocks builds in a new temporary
+    directory every time, so debug builds would never hit. As with
+    ccache's hash_dir = false, debug info of a reused object refers to
+    the directory of the build that stored it.
+    """
+    cwd = getattr(os, 'getcwdb', os.getcwd)()
+    return preprocessed.replace(b'# 1 "' + cwd + b'//"\n', b'', 1)
+
+
+def wrap_compiler(compiler, args):
+    cache_dir = os.environ.get(CACHE_DIR_VAR)
+    parsed = _parse_compile_args(args)
+    if not cache_dir or parsed is None:
+        return subprocess.call([compiler] + args)
+    source, output, rest = parsed
+    preprocess_args = [a for a in rest if a != '-c'] + ['-E']
+    proc = subprocess.Popen(
+        [compiler] + preprocess_args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    preprocessed, _ = proc.communicate()
+    if proc.returncode != 0:
+        return subprocess.call([compiler] + args)
+    hasher = hashlib.sha256()
+    for part in [WRAPPER_VERSION, _compiler_identity(compiler)] + rest:
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+    hasher.update(_strip_working_directory(preprocessed))
+    key = hasher.hexdigest()
+    object_path = os.path.join(cache_dir, key[:2], key[2:])
+    if os.path.isfile(object_path):
+        shutil.copyfile(object_path, output)
+        try:
+            with open(object_path + DIAGNOSTICS_SUFFIX, 'rb') as f:
+                _write_stderr(f.read())
+        except (IOError, OSError):
+            pass
+        _record_stat('hit')
+        return 0
+    proc = subprocess.Popen([compiler] + args, stderr=subprocess.PIPE)
+    diagnostics = proc.communicate()[1]
+    _write_stderr(diagnostics)
+    if proc.returncode == 0 and os.path.isfile(output):
+        try:
+            _store_object(output, diagnostics, object_path)
+        except (IOError, OSError):
+            pass
+        _record_stat('miss')
+    return proc.returncode
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        print('usage: _ccache.py COMPILER [ARGS...]', file=sys.stderr)
+        return 2
+    return wrap_compiler(argv[0], argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from luamb._archive import is_archived
+from luamb._paths import PROJECT_FILE_NAME
+from luamb._spec import (
+    HEREROCKS_MANIFEST_FILE_NAME, MANIFEST_LUAROCKS_KEY,
+    read_hererocks_manifest,
+)
+
+
+CHECK_CACHE_FILE_NAME = 'check-cache.json'
+CHECK_CACHE_VERSION = 1
+
+PROGRAM_TIMEOUT = 10
+
+LUA_CHECK_SCRIPT = "io.write('ok')"
+
+# updated by ldconfig when system libraries are installed or upgraded,
+# a part of the cache key so that OS upgrades invalidate cached results
+LD_SO_CACHE_PATH = '/etc/ld.so.cache'
+
+STATUS_OK = 'ok'
+STATUS_BROKEN = 'broken'
+STATUS_ARCHIVED = 'archived'
+
+
+class CheckResult(object):
+
+    def __init__(self, env_name, status, problems=(), cached=False,
+                 duration=0.):
+        self.env_name = env_name
+        self.status = status
+        self.problems = list(problems)
+        self.cached = cached
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.status != STATUS_BROKEN
+
+    def to_dict(self):
+        return {
+            'env': self.env_name,
+            'status': self.status,
+            'problems': self.problems,
+            'cached': self.cached,
+            'duration': self.duration,
+        }
+
+    def __repr__(self):
+        return '<CheckResult {} {}>'.format(self.env_name, self.status)
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_mtime]
+
+
+def get_cache_key(env_path):
+    """Return a value that changes when cached check results may be stale
+
+    The environment directory mtime changes when top-level entries are
+    added or removed (e.g., by a rebuild), inodes of the binaries change
+    when they are reinstalled.
+    """
+    return [
+        _stat_key(env_path),
+        _stat_key(os.path.join(env_path, HEREROCKS_MANIFEST_FILE_NAME)),
+        _stat_key(os.path.join(env_path, 'bin', 'lua')),
+        _stat_key(os.path.join(env_path, 'bin', 'luarocks')),
+        _stat_key(LD_SO_CACHE_PATH),
+    ]
+
+
+def run_program(argv):
+    """Run a program, return (exit status, output), kill it on timeout"""
+    with open(os.devnull) as devnull:
+        try:
+            proc = subprocess.Popen(
+                argv, stdin=devnull, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        except OSError as exc:
+            return None, str(exc)
+    # subprocess timeouts are not available in Python 2
+    timer = threading.Timer(PROGRAM_TIMEOUT, proc.kill)
+    timer.start()
+    try:
+        output = proc.communicate()[0].decode('utf-8', 'replace')
+    finally:
+        timer.cancel()
+    return proc.returncode, output.strip()
+
+
+def describe_failure(what, status, output):
+    if status is None:
+        msg = "{} can't be run".format(what)
+    elif status == 0:
+        msg = '{} produced unexpected output'.format(what)
+    elif status < 0:
+        msg = '{} was killed by signal {}'.format(what, -status)
+    else:
+        msg = '{} exited with status {}'.format(what, status)
+    if output:
+        msg = '{}: {}'.format(msg, output.splitlines()[-1])
+    return msg
+
+
+def check_programs(env_path):
+    """Slow checks (running programs), the results are cacheable"""
+    problems = []
+    manifest = read_hererocks_manifest(env_path)
+    if not manifest:
+        # hererocks writes the manifest last
+        return ['incomplete build: {} is missing or invalid'.format(
+            HEREROCKS_MANIFEST_FILE_NAME)]
+    bin_dir = os.path.join(env_path, 'bin')
+    lua = os.path.join(bin_dir, 'lua')
+    if not os.path.isfile(lua):
+        problems.append('incomplete build: bin/lua is missing')
+    else:
+        status, output = run_program([lua, '-e', LUA_CHECK_SCRIPT])
+        if status != 0 or output != 'ok':
+            problems.append(describe_failure('lua', status, output))
+    if MANIFEST_LUAROCKS_KEY in manifest:
+        luarocks = os.path.join(bin_dir, 'luarocks')
+        if not os.path.isfile(luarocks):
+            problems.append('incomplete build: bin/luarocks is missing')
+        else:
+            status, output = run_program([luarocks, '--version'])
+            if status != 0:
+                problems.append(
+                    describe_failure('luarocks', status, output))
+    activate = os.path.join(bin_dir, 'activate')
+    try:
+        with open(activate) as f:
+            activate_script = f.read()
+    except (IOError, OSError):
+        problems.append('bin/activate is missing')
+    else:
+        env_bin_dirs = set(
+            os.path.join(path, 'bin')
+            for path in (os.path.abspath(env_path), os.path.realpath(env_path))
+        )
+        if not any(path in activate_script for path in env_bin_dirs):
+            problems.append(
+                "bin/activate doesn't point to the environment "
+                "(moved or copied?)")
+    return problems
+
+
+def check_project(env_path):
+    """Fast checks, never cached"""
+    try:
+        with open(os.path.join(env_path, PROJECT_FILE_NAME)) as f:
+            project = f.read().strip()
+    except (IOError, OSError):
+        return []
+    if not os.path.isdir(project):
+        return ["project directory doesn't exist: {}".format(project)]
+    return []
+
+
+class CheckCache(object):
+    """Results of program checks keyed by get_cache_key() values"""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return self
+        if data.get('version') == CHECK_CACHE_VERSION:
+            self._entries = data.get('entries', {})
+        return self
+
+    def get(self, env_name, key):
+        entry = self._entries.get(env_name)
+        if entry and entry['key'] == key:
+            return entry['problems']
+        return None
+
+    def set(self, env_name, key, problems):
+        with self._lock:
+            self._entries[env_name] = {'key': key, 'problems': problems}
+            self._changed = True
+
+    def prune(self, env_names):
+        for env_name in set(self._entries) - set(env_names):
+            del self._entries[env_name]
+            self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+        cache_dir = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'version': CHECK_CACHE_VERSION,
+                    'entries': self._entries,
+                }, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # the cache is an optimization only
+            pass
+
+
+def check_env(env_name, env_path, cache=None):
+    start = time.time()
+    if is_archived(env_path):
+        return CheckResult(env_name, STATUS_ARCHIVED)
+    key = get_cache_key(env_path)
+    problems = cache.get(env_name, key) if cache else None
+    cached = problems is not None
+    if not cached:
+        problems = check_programs(env_path)
+        if cache:
+            cache.set(env_name, key, problems)
+    problems = problems + check_project(env_path)
+    return CheckResult(
+        env_name,
+        status=STATUS_BROKEN if problems else STATUS_OK,
+        problems=problems,
+        cached=cached,
+        duration=time.time() - start,
+    )
+
+
+def check_envs(envs, cache=None, jobs=None):
+    """Check (env name, env path) pairs concurrently, keep the order"""
+    envs = list(envs)
+    if not envs:
+        return []
+    jobs = min(jobs or multiprocessing.cpu_count(), len(envs))
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(
+            lambda env: check_env(env[0], env[1], cache=cache), envs)
+    finally:
+        pool.close()
+        pool.join()
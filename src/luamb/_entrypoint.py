@@ -38,6 +38,17 @@ def main():
         active_env=os.environ.get('LUAMB_ACTIVE_ENV'),
         lua_default=os.environ.get('LUAMB_LUA_DEFAULT'),
         luarocks_default=os.environ.get('LUAMB_LUAROCKS_DEFAULT'),
+        compiler_cache=os.environ.get('LUAMB_COMPILER_CACHE'),
+        tmpfs=os.environ.get('LUAMB_TMPFS'),
+        history=os.environ.get('LUAMB_DISABLE_HISTORY') != 'true',
+        profiles_file=os.environ.get('LUAMB_PROFILES_FILE'),
+        rocks_upstream=os.environ.get('LUAMB_ROCKS_UPSTREAM'),
+        binary_cache=os.environ.get('LUAMB_BINARY_CACHE'),
+        upload_binary=os.environ.get('LUAMB_BINARY_CACHE_UPLOAD') == 'true',
+        max_builds=os.environ.get('LUAMB_MAX_BUILDS'),
+        build_jobs=os.environ.get('LUAMB_BUILD_JOBS'),
+        build_nice=os.environ.get('LUAMB_BUILD_NICE'),
+        build_ionice=os.environ.get('LUAMB_BUILD_IONICE'),
         hererocks=hererocks,
     )
 
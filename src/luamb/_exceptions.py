@@ -0,0 +1,67 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+
+class LuambException(Exception):
+
+    message = None
+
+    def __init__(self, message=None):
+        if message:
+            self.message = message
+
+    def __str__(self):
+        return self.message or self.__class__.__name__
+
+
+class CommandIsShellFunction(LuambException):
+
+    message = (
+        "this command is implemented as a shell function "
+        "and cannot be called via Python script entrypoint"
+    )
+
+
+class HererocksErrorExit(LuambException):
+
+    status = None
+
+    def __init__(self, system_exit_exc, output_tail=None, log_path=None):
+        arg = system_exit_exc.args[0]
+        if isinstance(arg, int):
+            self.status = arg
+            self.message = None
+        else:
+            self.status = 1
+            self.message = arg
+        self.output_tail = output_tail
+        self.log_path = log_path
+
+    def __str__(self):
+        msg = 'hererocks exited with non-zero status: {}'.format(self.status)
+        if self.output_tail:
+            msg = '{}\nlast lines of output:\n{}'.format(
+                msg, '\n'.join(self.output_tail))
+        if self.message and not (
+                self.output_tail and self.message in self.output_tail):
+            msg = '{}\n{}'.format(msg, self.message)
+        if self.log_path:
+            msg = '{}\nfull log: {}'.format(msg, self.log_path)
+        return msg
+
+
+class HererocksUncaughtException(LuambException):
+
+    exc = None
+
+    def __init__(self, exc):
+        self.exc = exc
+        if exc.args:
+            self.message = str(exc)
+
+    def __str__(self):
+        msg = 'uncaught exception while running hererocks: {}'.format(
+            self.exc.__class__.__name__)
+        if self.message:
+            msg = '{}\n{}'.format(msg, self.message)
+        return msg
@@ -0,0 +1,167 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+import math
+import os
+import sqlite3
+
+from luamb._exceptions import LuambException
+
+
+HISTORY_FILE_NAME = 'history.sqlite3'
+
+# a record is dropped rather than waiting for a concurrent writer longer
+LOCK_TIMEOUT = 0.1
+
+# kinds of operations producing an environment, NULL in old records
+# means a build
+KIND_BUILD = 'build'
+KIND_BINARY_CACHE = 'binary-cache'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    command TEXT NOT NULL,
+    args TEXT NOT NULL,
+    env_name TEXT,
+    spec TEXT,
+    exit_status INTEGER NOT NULL,
+    hererocks_version TEXT,
+    luamb_version TEXT,
+    kind TEXT
+);
+CREATE INDEX IF NOT EXISTS operations_spec ON operations (spec);
+"""
+
+
+def spec_key(spec):
+    """Return a canonical string identifying what was built
+
+    hererocks version is not a part of the key, so the same spec built
+    by different hererocks versions is considered a rebuild. Version
+    aliases must be resolved beforehand (see api.resolve_spec()), so that
+    '5.3' and '5.3.6' give the same key.
+    """
+    if spec is None:
+        return None
+    dct = spec.to_dict()
+    dct.pop('hererocks_version', None)
+    return json.dumps(dct, sort_keys=True)
+
+
+def format_spec_key(key):
+    dct = json.loads(key)
+    parts = ['{} {}'.format(dct['lua_type'], dct['lua_version'])]
+    if dct.get('luarocks_version'):
+        parts.append('luarocks {}'.format(dct['luarocks_version']))
+    text = ' + '.join(parts)
+    if dct.get('hererocks_args'):
+        text = '{} ({})'.format(text, ' '.join(dct['hererocks_args']))
+    return text
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of a non-empty sorted list"""
+    rank = int(math.ceil(percent / 100. * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class History(object):
+    """Append-only log of luamb commands stored in SQLite
+
+    Writing is best effort: any database error (locked by another
+    process for longer than LOCK_TIMEOUT, read-only directory, etc.)
+    is swallowed, so history never slows down or breaks a command.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        db_dir = os.path.dirname(self.path)
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        # WAL lets readers (luamb stats) and a writer work concurrently,
+        # NORMAL sync skips fsync on every commit
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+        columns = [
+            row[1] for row in conn.execute('PRAGMA table_info(operations)')]
+        if 'kind' not in columns:
+            # databases of older luamb versions
+            conn.execute('ALTER TABLE operations ADD COLUMN kind TEXT')
+        return conn
+
+    def record(self, started_at, duration, command, args, exit_status,
+               env_name=None, spec=None, hererocks_version=None,
+               luamb_version=None, kind=None):
+        """Add a record, return False if it couldn't be written
+
+        kind is KIND_BUILD or KIND_BINARY_CACHE if the command produced
+        an environment of spec.
+        """
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        'INSERT INTO operations (started_at, duration, '
+                        'command, args, env_name, spec, exit_status, '
+                        'hererocks_version, luamb_version, kind) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (started_at, duration, command, json.dumps(args),
+                         env_name, spec_key(spec), exit_status,
+                         hererocks_version, luamb_version, kind),
+                    )
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            return False
+        return True
+
+    def get_build_stats(self, since=None):
+        """Return list of (spec key, sorted durations, env names)
+
+        Only successful builds are counted (not environments downloaded
+        from the binary cache), most rebuilt specs go first.
+        """
+        rows = self._select(
+            'SELECT spec, duration, env_name FROM operations '
+            'WHERE spec IS NOT NULL AND exit_status = 0 '
+            'AND (kind IS NULL OR kind = ?)', (KIND_BUILD,), since)
+        builds = {}
+        for key, duration, env_name in rows:
+            durations, env_names = builds.setdefault(key, ([], set()))
+            durations.append(duration)
+            env_names.add(env_name)
+        stats = [
+            (key, sorted(durations), sorted(env_names))
+            for key, (durations, env_names) in builds.items()
+        ]
+        stats.sort(key=lambda item: (-len(item[1]), item[0]))
+        return stats
+
+    def count_binary_cache_hits(self, since=None):
+        return self._select(
+            'SELECT COUNT(*) FROM operations '
+            'WHERE exit_status = 0 AND kind = ?', (KIND_BINARY_CACHE,),
+            since)[0][0]
+
+    def _select(self, query, params, since=None):
+        if since is not None:
+            query += ' AND started_at >= ?'
+            params += (since,)
+        try:
+            conn = self._connect()
+            try:
+                return conn.execute(query, params).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as exc:
+            raise LuambException(
+                "can't read history database: {}".format(exc))
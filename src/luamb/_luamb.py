@@ -2,20 +2,22 @@
 from __future__ import print_function, unicode_literals
 
 import argparse
-import contextlib
-import os
-import shutil
+import json
 import sys
+import time
 from collections import OrderedDict
 from importlib import import_module
 
+from luamb import api
+from luamb._exceptions import CommandIsShellFunction, LuambException
+from luamb._history import (
+    KIND_BINARY_CACHE, KIND_BUILD, format_spec_key, percentile,
+)
+from luamb._mirror import parse_rock_arg
+from luamb._paths import is_valid_env_name
+from luamb._scratch import DEFAULT_TMPFS_DIR, parse_tmpfs_setting
 from luamb.version import __version__
 
-if sys.version_info[0] == 2:
-    from StringIO import StringIO
-else:
-    from io import StringIO
-
 
 class CMD(object):
 
@@ -54,114 +56,66 @@ class CMD(object):
         return '\n'.join(help_list)
 
 
-class LuambException(Exception):
-
-    message = None
-
-    def __init__(self, message=None):
-        if message:
-            self.message = message
-
-    def __str__(self):
-        return self.message or self.__class__.__name__
-
-
-class CommandIsShellFunction(LuambException):
-
-    message = (
-        "this command is implemented as a shell function "
-        "and cannot be called via Python script entrypoint"
-    )
-
-
-class HererocksErrorExit(LuambException):
-
-    status = None
-
-    def __init__(self, system_exit_exc):
-        arg = system_exit_exc.args[0]
-        if isinstance(arg, int):
-            self.status = arg
-            self.message = None
-        else:
-            self.status = 1
-            self.message = arg
-
-    def __str__(self):
-        msg = 'hererocks exited with non-zero status: {}'.format(self.status)
-        if self.message:
-            msg = '{}\n{}'.format(msg, self.message)
-        return msg
-
-
-class HererocksUncaughtException(LuambException):
-
-    exc = None
-
-    def __init__(self, exc):
-        self.exc = exc
-        if exc.args:
-            self.message = str(exc)
-
-    def __str__(self):
-        msg = 'uncaught exception while running hererocks: {}'.format(
-            self.exc.__class__.__name__)
-        if self.message:
-            msg = '{}\n{}'.format(msg, self.message)
-        return msg
-
-
 def check_env_name(env_name):
-    if not env_name or env_name == '.' or env_name == '..' or '/' in env_name:
+    if not is_valid_env_name(env_name):
         raise argparse.ArgumentTypeError(
             "invalid env name: '{}'".format(env_name))
     return env_name
 
 
+def _format_size(size):
+    if size < 1024:
+        return '{} B'.format(size)
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024.
+        if size < 1024 or unit == 'GiB':
+            return '{:.1f} {}'.format(size, unit)
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+
 class Luamb(object):
 
-    lua_types = ('lua', 'luajit', 'moonjit', 'raptorjit')
-
-    product_cli_args = {
-        'lua': ('-l', '--lua'),
-        'luajit': ('-j', '--luajit'),
-        'moonjit': ('-m', '--moonjit'),
-        'raptorjit': ('--raptorjit',),
-        'luarocks': ('-r', '--luarocks'),
-    }
-    product_hererocks_classes = {
-        'lua': 'RioLua',
-        'luajit': 'LuaJIT',
-        'moonjit': 'MoonJIT',
-        'raptorjit': 'RaptorJIT',
-        'luarocks': 'LuaRocks',
-    }
-    product_names = {
-        'lua': 'PUC-Rio Lua',
-        'luajit': 'LuaJIT',
-        'moonjit': 'moonjit',
-        'raptorjit': 'RaptorJIT',
-        'luarocks': 'LuaRocks',
-    }
+    lua_types = api.LUA_TYPES
+    product_cli_args = api.PRODUCT_CLI_ARGS
+    product_hererocks_classes = api.PRODUCT_HEREROCKS_CLASSES
+    product_names = api.PRODUCT_NAMES
 
     cmd = CMD()
 
     def __init__(self, env_dir, active_env=None,
                  lua_default=None, luarocks_default=None,
-                 hererocks=None):
+                 compiler_cache=None, tmpfs=None, history=True,
+                 profiles_file=None, rocks_upstream=None, binary_cache=None,
+                 upload_binary=False, max_builds=None, build_jobs=None,
+                 build_nice=None, build_ionice=None, hererocks=None):
         self.env_dir = env_dir
         self.active_env = active_env
         self.lua_default = lua_default
         self.luarocks_default = luarocks_default
+        self.compiler_cache = compiler_cache
+        self.tmpfs = parse_tmpfs_setting(tmpfs)
+        self.profiles_file = profiles_file or api.get_profiles_path(env_dir)
+        self.rocks_upstream = rocks_upstream
+        self.binary_cache = binary_cache or None
+        self.upload_binary = upload_binary
+        self.max_builds = max_builds
+        self.build_jobs = build_jobs
+        self.build_nice = build_nice
+        self.build_ionice = build_ionice
+        self.history = api.get_history(env_dir) if history else None
+        # the environment built by the current command and how it was
+        # produced (for the history)
+        self._built_env = None
+        self._build_kind = None
         self.hererocks = hererocks or import_module('hererocks')
-        self.supported_versions = {
-            product_key: self._fetch_supported_versions(cls_name)
-            for product_key, cls_name in self.product_hererocks_classes.items()
-        }
 
     def run(self, argv=None):
         if not argv:
             argv = sys.argv[1:]
+        self._built_env = self._build_kind = None
         parser = argparse.ArgumentParser(
             prog='luamb',
             add_help=False,
@@ -190,8 +144,42 @@ class Luamb(object):
         if not method:
             print("command '{}' not found\n"
                   "try 'luamb --help'".format(args.command))
-        else:
+        elif self.history is None:
             method(self, argv[1:])
+        else:
+            self._run_recorded(method, args.command, argv[1:])
+
+    def _run_recorded(self, method, command, argv):
+        started_at = time.time()
+        exit_status = 1
+        try:
+            method(self, argv)
+            exit_status = 0
+        except SystemExit as exc:
+            if exc.code is None or isinstance(exc.code, int):
+                exit_status = exc.code or 0
+            raise
+        except KeyboardInterrupt:
+            exit_status = 130
+            raise
+        finally:
+            env = self._built_env
+            spec = env.spec if env else None
+            if spec is not None:
+                # aliases like '5.3' or 'latest' would split build stats
+                spec = api.resolve_spec(spec, hererocks=self.hererocks)
+            self.history.record(
+                started_at=started_at,
+                duration=time.time() - started_at,
+                command=self.cmd.registry[command]['cmd'],
+                args=argv,
+                exit_status=exit_status,
+                env_name=env.name if env else None,
+                spec=spec,
+                hererocks_version=self.hererocks.hererocks_version,
+                luamb_version=__version__,
+                kind=self._build_kind,
+            )
 
     @cmd.add('on', 'enable', 'activate')
     def cmd_on(self, argv):
@@ -214,12 +202,18 @@ class Luamb(object):
                 You can use any hererocks arguments (see below), but instead of
                 a full path to new environment you should specify only
                 its name. In addition, you can specify a project path with
-                -a/--associate argument.
+                -a/--associate argument and a named set of build options
+                with --profile argument.
             """,
             usage=(
-                '\n  luamb mk [-a PROJECT_DIR] [--no-luarocks] HEREROCKS_ARGS '
-                'ENV_NAME\n'
-                '  luamb mk --list-versions WHAT'
+                '\n  luamb mk [-a PROJECT_DIR] [--no-luarocks] '
+                '[--profile PROFILE]\n'
+                '           [--tmpfs [DIR] | --no-tmpfs]\n'
+                '           [--binary-cache LOCATION | --no-binary-cache] '
+                '[--upload-binary]\n'
+                '           HEREROCKS_ARGS ENV_NAME\n'
+                '  luamb mk --list-versions WHAT\n'
+                '  luamb mk --list-profiles'
             ),
         )
         parser.add_argument(
@@ -240,6 +234,14 @@ class Luamb(object):
             help="don't install LuaRocks (if default version specified via "
                  "environment variable)",
         )
+        parser.add_argument(
+            '--profile',
+            help="build profile (see --list-profiles), expands into "
+                 "hererocks arguments and verifies the interpreter "
+                 "after the build",
+        )
+        self._add_tmpfs_arguments(parser)
+        self._add_binary_cache_arguments(parser)
         parser.add_argument(
             '--list-versions',
             choices=self.product_names,
@@ -249,6 +251,11 @@ class Luamb(object):
                 '(one of %(choices)s) available for installation'
             ),
         )
+        parser.add_argument(
+            '--list-profiles',
+            action='store_true',
+            help="list build profiles",
+        )
         for product_key, product_cli_args in self.product_cli_args.items():
             parser.add_argument(
                 *product_cli_args,
@@ -268,8 +275,10 @@ class Luamb(object):
         )
         args, extra_args = parser.parse_known_args(argv)
 
-        if args.help or (not args.env_name and not args.list_versions):
-            output = self._call_hererocks(['--help'], capture_output=True)
+        if args.help or not (
+                args.env_name or args.list_versions or args.list_profiles):
+            output = api.call_hererocks(
+                ['--help'], capture_output=True, hererocks=self.hererocks)
             hererocks_help = output.partition("optional arguments:\n")[2]
             parser.print_help()
             print('\nhererocks arguments:')
@@ -277,15 +286,33 @@ class Luamb(object):
             return
 
         if args.list_versions:
-            product_key = args.list_versions
-            versions = self._get_supported_versions(product_key)
+            versions = api.list_versions(
+                args.list_versions, hererocks=self.hererocks)
+            all_versions = versions.versions + list(versions.aliases)
             print('Supported {} versions are: {}'.format(
-                self.product_names[product_key],
-                self._format_versions_string(versions),
+                versions.product_name,
+                api.format_versions(all_versions),
             ))
-            print('latest and ^ are aliases for {}'.format(versions['latest']))
+            print('latest and ^ are aliases for {}'.format(versions.latest))
+            return
+
+        if args.list_profiles:
+            profiles = api.list_profiles(self.profiles_file)
+            for profile in profiles.values():
+                print(profile.name)
+                if profile.description:
+                    print('    ' + profile.description)
+                print('    hererocks arguments: {}'.format(' '.join(
+                    profile.get_hererocks_args('lua')) or '-'))
+                if profile.jit_cflags is not None:
+                    print('    LuaJIT: {}'.format(' '.join(
+                        profile.get_hererocks_args('luajit')) or '-'))
             return
 
+        profile = None
+        if args.profile:
+            profile = api.get_profile(args.profile, self.profiles_file)
+
         env_name = args.env_name
 
         args_lua_types = []
@@ -318,7 +345,7 @@ class Luamb(object):
                     "environment variable: {}".format(self.lua_default)
                 )
 
-        self._check_product_version_is_supported(lua_type, lua_version)
+        api.check_version(lua_type, lua_version, hererocks=self.hererocks)
 
         if args.no_luarocks:
             luarocks_version = None
@@ -333,28 +360,681 @@ class Luamb(object):
         else:
             luarocks_version = None
 
-        if luarocks_version is not None:
-            self._check_product_version_is_supported(
-                'luarocks', luarocks_version)
-
-        env_path = os.path.join(self.env_dir, env_name)
+        result = api.create_env(
+            self.env_dir, env_name,
+            lua_type=lua_type,
+            lua_version=lua_version,
+            luarocks_version=luarocks_version,
+            hererocks_args=extra_args,
+            project=args.associate,
+            profile=profile,
+            **self._build_kwargs(args, binary_cache=True)
+        )
+        self._show_build_result(result)
 
-        hererocks_args = [
-            self.product_cli_args[lua_type][-1],
-            lua_version,
+    @cmd.add('upgrade', 'up')
+    def cmd_upgrade(self, argv):
+        """upgrade Lua or LuaRocks in place"""
+        parser = argparse.ArgumentParser(
+            prog='luamb upgrade',
+            description="""
+                Rebuild only the specified component of an existing
+                environment keeping installed rocks. Other hererocks
+                arguments are taken from the environment creation spec.
+                Rocks are reinstalled only if the Lua ABI (interpreter or
+                its major version) has changed.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        for product_key, product_cli_args in self.product_cli_args.items():
+            parser.add_argument(
+                *product_cli_args,
+                dest=product_key,
+                metavar='VERSION',
+                help='new {} version'.format(self.product_names[product_key])
+            )
+        self._add_tmpfs_arguments(parser)
+        args = parser.parse_args(argv)
+        args_lua_types = [
+            (lua_type, getattr(args, lua_type)) for lua_type in self.lua_types
+            if getattr(args, lua_type) is not None
         ]
-        if luarocks_version:
-            hererocks_args.extend([
-                self.product_cli_args['luarocks'][-1],
-                luarocks_version,
-            ])
-        hererocks_args.extend(extra_args)
-        hererocks_args.append(env_path)
-        self._call_hererocks(hererocks_args)
-
-        if args.associate:
-            with open(os.path.join(env_path, '.project'), 'w') as f:
-                f.write(os.path.abspath(os.path.expandvars(args.associate)))
+        if len(args_lua_types) > 1:
+            raise LuambException("can't install more than one Lua interpreter")
+        if not args_lua_types and args.luarocks is None:
+            parser.error('specify a new Lua or LuaRocks version')
+        lua_type, lua_version = (
+            args_lua_types[0] if args_lua_types else (None, None))
+        result = api.upgrade_env(
+            self.env_dir, args.env_name,
+            lua_type=lua_type,
+            lua_version=lua_version,
+            luarocks_version=args.luarocks,
+            profiles_path=self.profiles_file,
+            **self._build_kwargs(args)
+        )
+        if result.installed_rocks:
+            print('Lua ABI has changed, reinstalled rocks: {}'.format(
+                ', '.join(rock.name for rock in result.installed_rocks)))
+        self._show_build_result(result)
+
+    @cmd.add('freeze', 'lock')
+    def cmd_freeze(self, argv):
+        """print lockfile of environment"""
+        parser = argparse.ArgumentParser(
+            prog='luamb freeze',
+            description="""
+                Print the environment creation spec and installed rocks
+                with exact versions as JSON. Use 'luamb sync' to
+                reproduce the environment from the output.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        args = parser.parse_args(argv)
+        lock = api.freeze_env(self.env_dir, args.env_name)
+        print(json.dumps(lock, indent=2, sort_keys=True))
+
+    @cmd.add('sync')
+    def cmd_sync(self, argv):
+        """sync environment with lockfile"""
+        parser = argparse.ArgumentParser(
+            prog='luamb sync',
+            description="""
+                Install and remove rocks so that the environment matches
+                the lockfile created by 'luamb freeze'. The environment is
+                created from the lockfile spec if it doesn't exist.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            'lockfile',
+            metavar='LOCKFILE',
+        )
+        parser.add_argument(
+            '-j', '--jobs',
+            type=int,
+            help="number of concurrent installs (default: number of CPUs)",
+        )
+        self._add_tmpfs_arguments(parser)
+        self._add_binary_cache_arguments(parser)
+        args = parser.parse_args(argv)
+        result = api.sync_env(
+            self.env_dir, args.env_name, args.lockfile, jobs=args.jobs,
+            **self._build_kwargs(args, binary_cache=True)
+        )
+        if result.spec_mismatch:
+            print(
+                'Warning: environment spec differs from the lockfile, '
+                "use 'luamb upgrade' to change Lua or LuaRocks version")
+        if result.build:
+            self._show_build_result(result.build)
+        if not result.changed:
+            print('Already in sync')
+            return
+        for rock in result.removed:
+            print('Removed {} {}'.format(rock.name, rock.version))
+
+    @cmd.add('log')
+    def cmd_log(self, argv):
+        """show build log of environment"""
+        parser = argparse.ArgumentParser(
+            prog='luamb log',
+            description="""
+                Show hererocks and luarocks output of the latest build
+                (mk, upgrade, sync) of the environment. Logs of previous
+                builds are kept next to it with .1, .2, etc. suffixes.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            '-n', '--lines',
+            type=int,
+            help="show only the last LINES lines",
+        )
+        parser.add_argument(
+            '-f', '--follow',
+            action='store_true',
+            help="output appended data as the log grows",
+        )
+        args = parser.parse_args(argv)
+        env_name = args.env_name
+        try:
+            for chunk in api.read_build_log(
+                    self.env_dir, env_name, lines=args.lines):
+                sys.stdout.write(chunk)
+        except LuambException:
+            if not args.follow:
+                raise
+        if not args.follow:
+            return
+        sys.stdout.flush()
+        try:
+            for chunk in api.follow_build_log(self.env_dir, env_name):
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+
+    @cmd.add('archive')
+    def cmd_archive(self, argv):
+        """archive idle environments"""
+        parser = argparse.ArgumentParser(
+            prog='luamb archive',
+            description="""
+                Pack environments into compressed archives to save disk
+                space. Archived environments are still listed by
+                'luamb ls' and are restored automatically by 'luamb on'
+                and 'luamb info'.
+            """,
+        )
+        parser.add_argument(
+            'env_names',
+            nargs='*',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            '--idle-days',
+            type=int,
+            metavar='N',
+            help="archive all environments not activated for N days",
+        )
+        parser.add_argument(
+            '-n', '--dry-run',
+            action='store_true',
+            help="only show what would be archived",
+        )
+        args = parser.parse_args(argv)
+        env_names = list(args.env_names)
+        if args.idle_days is not None:
+            env_names.extend(
+                env_name for env_name in api.find_idle_envs(
+                    self.env_dir, args.idle_days, active_env=self.active_env)
+                if env_name not in env_names
+            )
+        elif not env_names:
+            parser.error('specify environment names or --idle-days')
+        for env_name in env_names:
+            if args.dry_run:
+                print(env_name)
+                continue
+            info = api.archive_env(
+                self.env_dir, env_name, active_env=self.active_env)
+            print("env '{}' has been archived ({} -> {})".format(
+                env_name, _format_size(info.size),
+                _format_size(info.archive_size)))
+
+    @cmd.add('restore', 'unarchive')
+    def cmd_restore(self, argv):
+        """restore archived environment"""
+        parser = argparse.ArgumentParser(prog='luamb restore')
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        args = parser.parse_args(argv)
+        api.restore_env(self.env_dir, args.env_name)
+        print("env '{}' has been restored".format(args.env_name))
+
+    @cmd.add('snapshot', 'snap')
+    def cmd_snapshot(self, argv):
+        """save snapshot of environment"""
+        parser = argparse.ArgumentParser(
+            prog='luamb snapshot',
+            description="""
+                Save a copy-on-write snapshot of the environment in
+                LUAMB_DIR/.luamb/snapshots: files are reflinked if the
+                filesystem supports it and hardlinked otherwise, so
+                a snapshot takes almost no time and space. Use
+                'luamb rollback' to return to it; snapshots are listed
+                by 'luamb info'.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            'tag',
+            nargs='?',
+            metavar='TAG',
+            help="snapshot name (default: current time)",
+        )
+        parser.add_argument(
+            '-d', '--delete',
+            action='store_true',
+            help="delete the snapshot TAG",
+        )
+        args = parser.parse_args(argv)
+        if args.delete:
+            if not args.tag:
+                parser.error('TAG is required with --delete')
+            api.delete_env_snapshot(self.env_dir, args.env_name, args.tag)
+            print("snapshot '{}' of env '{}' has been deleted".format(
+                args.tag, args.env_name))
+            return
+        start = time.time()
+        snapshot = api.snapshot_env(self.env_dir, args.env_name, args.tag)
+        print("snapshot '{}' of env '{}' has been saved ({}, {:.2f}s)".format(
+            snapshot.tag, args.env_name, snapshot.method,
+            time.time() - start))
+
+    @cmd.add('rollback')
+    def cmd_rollback(self, argv):
+        """roll environment back to snapshot"""
+        parser = argparse.ArgumentParser(
+            prog='luamb rollback',
+            description="""
+                Replace the environment with a snapshot saved by
+                'luamb snapshot'. The directories are swapped atomically,
+                the snapshot is kept.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            'tag',
+            metavar='TAG',
+        )
+        args = parser.parse_args(argv)
+        start = time.time()
+        api.rollback_env(self.env_dir, args.env_name, args.tag)
+        print("env '{}' has been rolled back to snapshot '{}' ({:.2f}s)"
+              .format(args.env_name, args.tag, time.time() - start))
+
+    @cmd.add('rocks')
+    def cmd_rocks(self, argv):
+        """manage shared rocks mirror"""
+        parser = argparse.ArgumentParser(
+            prog='luamb rocks',
+            description="""
+                All environments use a shared LuaRocks cache and a local
+                rocks mirror in LUAMB_DIR/.luamb/rocks. Rocks found in
+                the mirror are installed without network access.
+            """,
+        )
+        subparsers = parser.add_subparsers(dest='subcommand', metavar='CMD')
+        subparsers.required = True
+        prefetch_parser = subparsers.add_parser(
+            'prefetch',
+            help="download rocks with dependencies into the mirror",
+        )
+        prefetch_parser.add_argument(
+            'rocks',
+            nargs='+',
+            type=self._parse_rock_arg,
+            metavar='ROCK',
+            help="rock name, optionally with ==VERSION",
+        )
+        prefetch_parser.add_argument(
+            '-e', '--env',
+            type=check_env_name,
+            metavar='ENV_NAME',
+            help="environment to run luarocks from (default: active one)",
+        )
+        prefetch_parser.add_argument(
+            '-j', '--jobs',
+            type=int,
+            help="number of concurrent downloads (default: number of CPUs)",
+        )
+        configure_parser = subparsers.add_parser(
+            'configure',
+            help="point environments created by older luamb versions "
+                 "at the shared cache and mirror",
+        )
+        configure_parser.add_argument(
+            'env_names',
+            nargs='*',
+            type=check_env_name,
+            metavar='ENV_NAME',
+            help="environments to configure (default: all)",
+        )
+        args = parser.parse_args(argv)
+        if args.subcommand == 'prefetch':
+            env_name = args.env or self.active_env
+            if not env_name:
+                raise LuambException(
+                    "no active environment found - specify environment "
+                    "with LuaRocks with -e/--env")
+            added = api.prefetch_rocks(
+                self.env_dir, env_name, args.rocks,
+                rocks_upstream=self.rocks_upstream, jobs=args.jobs)
+            for file_name in added:
+                print('Added {}'.format(file_name))
+            print('Mirror: {}'.format(api.get_rocks_mirror_path(self.env_dir)))
+        else:
+            env_names = args.env_names or [
+                env.name for env in api.list_envs(self.env_dir)
+                if not env.archived
+            ]
+            for env_name in env_names:
+                if api.configure_rocks(
+                        self.env_dir, env_name,
+                        rocks_upstream=self.rocks_upstream):
+                    print("env '{}' has been configured".format(env_name))
+
+    @staticmethod
+    def _parse_rock_arg(arg):
+        try:
+            return parse_rock_arg(arg)
+        except LuambException as exc:
+            raise argparse.ArgumentTypeError(str(exc))
+
+    @cmd.add('check')
+    def cmd_check(self, argv):
+        """check health of environments"""
+        parser = argparse.ArgumentParser(
+            prog='luamb check',
+            description="""
+                Check that environments are usable: run the interpreter
+                and LuaRocks, verify bin/activate and the associated
+                project directory, and detect incomplete builds. All
+                environments are checked if no names are given.
+                Results are cached until the environment or its
+                binaries change.
+            """,
+        )
+        parser.add_argument(
+            'env_names',
+            nargs='*',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            '-j', '--jobs',
+            type=int,
+            help="number of concurrent checks (default: number of CPUs)",
+        )
+        parser.add_argument(
+            '--no-cache',
+            action='store_true',
+            help="ignore cached results",
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help="print results as JSON",
+        )
+        args = parser.parse_args(argv)
+        results = api.check_envs(
+            self.env_dir, env_names=args.env_names or None, jobs=args.jobs,
+            use_cache=not args.no_cache)
+        if args.json:
+            print(json.dumps(
+                [result.to_dict() for result in results],
+                indent=2, sort_keys=True))
+        elif results:
+            width = max(len(result.env_name) for result in results)
+            width = max(width, len('ENV'))
+            print('{0:<{1}}  {2:<8}  {3}'.format(
+                'ENV', width, 'STATUS', 'PROBLEMS'))
+            for result in results:
+                status = result.status
+                if result.cached:
+                    status += '*'
+                problems = result.problems or ['']
+                print('{0:<{1}}  {2:<8}  {3}'.format(
+                    result.env_name, width, status, problems[0]).rstrip())
+                for problem in problems[1:]:
+                    print('{0:<{1}}  {2:<8}  {3}'.format(
+                        '', width, '', problem))
+            if any(result.cached for result in results):
+                print('\n* cached result')
+        broken = [result for result in results if not result.ok]
+        if broken:
+            raise LuambException('{} of {} environments are broken'.format(
+                len(broken), len(results)))
+
+    @cmd.add('stats')
+    def cmd_stats(self, argv):
+        """show build statistics and unused environments"""
+        parser = argparse.ArgumentParser(
+            prog='luamb stats',
+            description="""
+                Summarize the history of luamb commands: build durations
+                per spec, most rebuilt specs, and environments that have
+                not been activated for a while.
+            """,
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            metavar='N',
+            help="consider environments not activated for N days unused "
+                 "and count builds of the last N days only (default: 30)",
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=5,
+            metavar='N',
+            help="show N most rebuilt specs (default: 5)",
+        )
+        args = parser.parse_args(argv)
+        since = time.time() - args.days * 24 * 60 * 60
+        history = api.get_history(self.env_dir)
+        stats = history.get_build_stats(since=since)
+        print('Build durations per spec (last {} days):'.format(args.days))
+        if not stats:
+            print('  no builds recorded')
+        else:
+            rows = sorted(
+                (format_spec_key(key), len(durations),
+                 percentile(durations, 50), percentile(durations, 95))
+                for key, durations, _ in stats
+            )
+            width = max(len(row[0]) for row in rows)
+            print('  {0:<{1}}  {2:>6}  {3:>7}  {4:>7}'.format(
+                'SPEC', width, 'BUILDS', 'P50', 'P95'))
+            for spec, count, p50, p95 in rows:
+                print('  {0:<{1}}  {2:>6}  {3:>6.1f}s  {4:>6.1f}s'.format(
+                    spec, width, count, p50, p95))
+        cache_hits = history.count_binary_cache_hits(since=since)
+        if cache_hits:
+            print('  (and {} environments from the binary cache)'.format(
+                cache_hits))
+        rebuilt = [item for item in stats if len(item[1]) > 1][:args.top]
+        if rebuilt:
+            print('\nMost rebuilt specs:')
+            for key, durations, env_names in rebuilt:
+                print('  {}: {} builds, {:.1f}s total ({})'.format(
+                    format_spec_key(key), len(durations), sum(durations),
+                    ', '.join(env_names)))
+        unused = api.find_idle_envs(
+            self.env_dir, args.days, active_env=self.active_env)
+        print('\nUnused environments (not activated for {} days):'.format(
+            args.days))
+        print('  ' + (', '.join(unused) if unused else 'none'))
+
+    @cmd.add('queue')
+    def cmd_queue(self, argv):
+        """show running and waiting builds"""
+        parser = argparse.ArgumentParser(
+            prog='luamb queue',
+            description="""
+                Show builds of all luamb processes sharing LUAMB_DIR that
+                are running or waiting for a slot (when LUAMB_MAX_BUILDS
+                is set).
+            """,
+        )
+        parser.parse_args(argv)
+        running, waiting = api.get_build_queue(self.env_dir)
+        now = time.time()
+        for title, builds in (('Running', running), ('Waiting', waiting)):
+            print('{} builds: {}'.format(title, len(builds)))
+            for position, build in enumerate(builds, 1):
+                print('  {}. {} (pid {}, {:.0f}s)'.format(
+                    position, build.get('env'), build.get('pid'),
+                    now - build.get('since', now)))
+
+    @cmd.add('index')
+    def cmd_index(self, argv):
+        """index Lua modules to speed up require()"""
+        parser = argparse.ArgumentParser(
+            prog='luamb index',
+            description="""
+                Generate a map of module names to files for the default
+                package.path and package.cpath of the environment.
+                'luamb on' loads it via LUA_INIT (unless LUA_INIT is
+                already set), and require() then finds indexed modules
+                without probing every search path. The environment's
+                luarocks is wrapped to refresh the index when rocks
+                change, luamb refreshes it after 'luamb sync' and
+                'luamb upgrade'.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            '--remove',
+            action='store_true',
+            help="remove the index",
+        )
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            help="regenerate the index only if it exists "
+                 "(run by the luarocks wrapper)",
+        )
+        parser.add_argument(
+            '--bench',
+            action='store_true',
+            help="compare require() without and with the index",
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            metavar='N',
+            help="number of benchmark runs (default: 5)",
+        )
+        parser.add_argument(
+            '-m', '--module',
+            action='append',
+            dest='modules',
+            metavar='MODULE',
+            help="module to require in the benchmark, can be repeated "
+                 "(default: all indexed modules)",
+        )
+        args = parser.parse_args(argv)
+        if args.remove:
+            if api.remove_env_index(self.env_dir, args.env_name):
+                print("index of env '{}' has been removed".format(
+                    args.env_name))
+            else:
+                print("env '{}' is not indexed".format(args.env_name))
+            return
+        if args.refresh:
+            if api.refresh_env_index(self.env_dir, args.env_name):
+                print("index of env '{}' has been refreshed".format(
+                    args.env_name))
+            return
+        index = api.index_env(self.env_dir, args.env_name)
+        print("env '{}': indexed {} Lua modules and {} C modules".format(
+            args.env_name, len(index.lua_modules), len(index.c_modules)))
+        if not args.bench:
+            return
+        result = api.benchmark_env_index(
+            self.env_dir, args.env_name, modules=args.modules,
+            repeat=args.repeat)
+        self._show_index_benchmark(result, args.repeat)
+
+    @cmd.add('compile')
+    def cmd_compile(self, argv):
+        """precompile Lua modules to bytecode"""
+        parser = argparse.ArgumentParser(
+            prog='luamb compile',
+            description="""
+                Compile Lua modules found via the default package.path
+                to bytecode (with luac for PUC-Rio Lua and 'luajit -b'
+                for LuaJIT-family interpreters) and index them, see
+                'luamb index'. Only modules whose source or interpreter
+                changed are recompiled. The startup gain is measured
+                by requiring all compiled modules.
+            """,
+        )
+        parser.add_argument(
+            'env_name',
+            type=check_env_name,
+            metavar='ENV_NAME',
+        )
+        parser.add_argument(
+            '-j', '--jobs',
+            type=int,
+            help="number of concurrent compilations "
+                 "(default: number of CPUs)",
+        )
+        parser.add_argument(
+            '-s', '--strip',
+            action='store_true',
+            help="strip debug information (error messages lose line "
+                 "numbers)",
+        )
+        parser.add_argument(
+            '--remove',
+            action='store_true',
+            help="remove bytecode",
+        )
+        parser.add_argument(
+            '--no-bench',
+            action='store_true',
+            help="don't measure the startup gain",
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            metavar='N',
+            help="number of benchmark runs (default: 5)",
+        )
+        args = parser.parse_args(argv)
+        if args.remove:
+            if api.remove_env_bytecode(self.env_dir, args.env_name):
+                print("bytecode of env '{}' has been removed".format(
+                    args.env_name))
+            else:
+                print("env '{}' is not compiled".format(args.env_name))
+            return
+        result = api.compile_env(
+            self.env_dir, args.env_name, jobs=args.jobs, strip=args.strip)
+        print("env '{}': compiled {} modules with {}, {} up to date".format(
+            args.env_name, result.compiled, result.compiler, result.reused))
+        if result.failed:
+            print('Failed to compile {} modules (sources are used):'.format(
+                len(result.failed)))
+            for source_path, error in result.failed:
+                print('  {}: {}'.format(source_path, error))
+        if args.no_bench or not result.compiled + result.reused:
+            return
+        self._show_index_benchmark(
+            api.benchmark_env_index(
+                self.env_dir, args.env_name, repeat=args.repeat),
+            args.repeat)
 
     @cmd.add('rm', 'remove', 'del', 'delete')
     def cmd_rm(self, argv):
@@ -367,13 +1047,7 @@ class Luamb(object):
         )
         args = parser.parse_args(argv)
         env_name = args.env_name
-        if env_name == self.active_env:
-            raise LuambException('cannot remove the active environment')
-        env_path = self._get_env_path(env_name)
-        try:
-            shutil.rmtree(env_path)
-        except OSError:
-            raise LuambException("can't delete {}".format(env_path))
+        api.remove_env(self.env_dir, env_name, active_env=self.active_env)
         print("env '{}' has been deleted".format(env_name))
 
     @cmd.add('info', 'show')
@@ -386,143 +1060,244 @@ class Luamb(object):
         if not env_name:
             raise LuambException("no active environment found - "
                                  "specify environment name")
-        self._show_env_info(env_name, mark_active=False)
+        env = api.get_env(self.env_dir, env_name)
+        if env.archived:
+            env = api.restore_env(self.env_dir, env_name)
+            print("env '{}' has been restored".format(env_name))
+        self._show_env_info(env, mark_active=False, snapshot_usage=True)
 
     @cmd.add('ls', 'list')
     def cmd_ls(self, argv):
         """list available environments"""
-        parser = argparse.ArgumentParser(prog='luamb ls')
+        parser = argparse.ArgumentParser(
+            prog='luamb ls',
+            description="""
+                List environments using the catalog kept in
+                LUAMB_DIR/.luamb (only changed environments are re-read).
+                Query fields: {}. Patterns are shell-style wildcards,
+                e.g., --where lua=luajit,version=2.1*,project=/srv/*
+            """.format(', '.join(api.QUERY_FIELDS)),
+        )
         parser.add_argument(
             '-s', '--short',
             action='store_true',
             help="show only names of environments",
         )
+        parser.add_argument(
+            '-w', '--where',
+            action='append',
+            metavar='FIELD=PATTERN[,...]',
+            help="show only environments matching all conditions",
+        )
+        parser.add_argument(
+            '--sort',
+            metavar='FIELD',
+            help="sort by field",
+        )
+        parser.add_argument(
+            '-r', '--reverse',
+            action='store_true',
+            help="sort in descending order",
+        )
+        parser.add_argument(
+            '-n', '--limit',
+            type=int,
+            metavar='N',
+            help="show at most N environments",
+        )
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            help="rebuild the catalog",
+        )
         args = parser.parse_args(argv)
-        envs = next(os.walk(self.env_dir))[1]
-        envs.sort()
-        detail = not args.short
+        sort = args.sort
+        if args.reverse:
+            if not sort:
+                parser.error('--reverse requires --sort')
+            sort = '-' + sort.lstrip('-')
+        envs = api.iter_envs(
+            self.env_dir, where=args.where, sort=sort, limit=args.limit,
+            active_env=self.active_env, refresh=args.refresh)
         for env in envs:
-            self._show_env_info(env, detail=detail)
-            if detail:
+            if args.short:
+                env_name = env.name
+                if env.active:
+                    env_name = '(' + env_name + ')'
+                print(env_name)
+            else:
+                self._show_env_info(env)
                 print('\n')
 
-    @contextlib.contextmanager
-    def _maybe_capture_output(self, capture_output):
-        string_buffer = StringIO()
-        if capture_output:
-            stdout, stderr = sys.stdout, sys.stderr
-            sys.stdout = sys.stderr = string_buffer
-        try:
-            yield string_buffer
-        finally:
-            if capture_output:
-                sys.stdout, sys.stderr = stdout, stderr
-            string_buffer.close()
+    def _add_tmpfs_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            '--tmpfs',
+            nargs='?',
+            const=DEFAULT_TMPFS_DIR,
+            metavar='DIR',
+            help="build in RAM-backed directory DIR (default: {}) and copy "
+                 "the result to LUAMB_DIR".format(DEFAULT_TMPFS_DIR),
+        )
+        group.add_argument(
+            '--no-tmpfs',
+            action='store_true',
+            help="don't use RAM-backed directory even if set via "
+                 "environment variable",
+        )
+
+    def _add_binary_cache_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            '--binary-cache',
+            metavar='LOCATION',
+            help="directory or HTTP(S) URL of prebuilt environments "
+                 "to try before building",
+        )
+        group.add_argument(
+            '--no-binary-cache',
+            action='store_true',
+            help="don't use binary cache even if set via environment "
+                 "variable",
+        )
+        parser.add_argument(
+            '--upload-binary',
+            action='store_true',
+            help="upload the environment to the binary cache after "
+                 "building it",
+        )
 
-    def _call_hererocks(self, argv, capture_output=False):
-        with self._maybe_capture_output(capture_output) as output_buffer:
+    def _build_kwargs(self, args, binary_cache=False):
+        if args.no_tmpfs:
+            tmpfs = None
+        else:
+            tmpfs = args.tmpfs or self.tmpfs
+        kwargs = {
+            'compiler_cache': self.compiler_cache,
+            'tmpfs': tmpfs,
+            'rocks_upstream': self.rocks_upstream,
+            'scheduler': self._get_build_scheduler(),
+            'hererocks': self.hererocks,
+        }
+        if binary_cache:
+            if args.no_binary_cache:
+                kwargs['binary_cache'] = None
+            else:
+                kwargs['binary_cache'] = args.binary_cache or self.binary_cache
+            kwargs['upload_binary'] = args.upload_binary or self.upload_binary
+        return kwargs
+
+    def _get_build_scheduler(self):
+        if not self.max_builds:
+            return None
+        settings = {}
+        for name, value in (
+                ('LUAMB_MAX_BUILDS', self.max_builds),
+                ('LUAMB_BUILD_JOBS', self.build_jobs),
+                ('LUAMB_BUILD_NICE', self.build_nice)):
             try:
-                self.hererocks.main(argv=argv)
-            except SystemExit as exc:
-                if exc.code:
-                    raise HererocksErrorExit(exc)
-            except Exception as exc:
-                raise HererocksUncaughtException(exc)
-            if capture_output:
-                return output_buffer.getvalue()
+                settings[name] = int(value) if value else None
+            except ValueError:
+                raise LuambException(
+                    "{} must be an integer, got '{}'".format(name, value))
+
+        def report_position(position):
+            print('Waiting for a build slot, position in queue: {}'.format(
+                position))
+            sys.stdout.flush()
+
+        return api.get_build_scheduler(
+            self.env_dir, settings['LUAMB_MAX_BUILDS'],
+            total_jobs=settings['LUAMB_BUILD_JOBS'],
+            nice=settings['LUAMB_BUILD_NICE'] or 0,
+            ionice=self.build_ionice,
+            on_wait=report_position,
+        )
+
+    def _show_build_result(self, result):
+        self._built_env = result.env
+        self._build_kind = (
+            KIND_BINARY_CACHE if result.binary_cache_status == 'hit'
+            else KIND_BUILD)
+        if result.binary_cache_error:
+            print('Warning: binary cache {} failed: {}'.format(
+                result.binary_cache, result.binary_cache_error))
+        if result.binary_cache_status:
+            print('Binary cache ({}): {}'.format(
+                result.binary_cache, result.binary_cache_status))
+        if result.compiler_cache_stats is not None:
+            print('Compiler cache ({}): {}'.format(
+                result.compiler_cache_mode, result.compiler_cache_stats))
+        phases = ', '.join(
+            '{} {:.1f}s'.format(name, duration)
+            for name, duration in result.phases.items())
+        print('Build time: {:.1f}s ({})'.format(result.duration, phases))
+        if result.log_path:
+            print('Build log: {}'.format(result.log_path))
+
+    def _show_index_benchmark(self, result, repeat):
+        columns = ['NO INDEX', 'INDEX']
+        if len(result.require_time) > 2:
+            columns.append('BYTECODE')
+        rows = [
+            ('require() time', ['{:.2f}ms'.format(value * 1000)
+                                for value in result.require_time]),
+            ('file probes (estimated)', result.probes),
+        ]
+        if result.syscalls:
+            rows.append(('syscalls', result.syscalls))
+            rows.append(('failed syscalls', result.failed_syscalls))
+        print('\nrequire() of {} modules, median of {} runs:'.format(
+            len(result.modules), repeat))
+        width = max(len(row[0]) for row in rows)
+        for title, values in [('', columns)] + rows:
+            print('  {0:<{1}}'.format(title, width) + ''.join(
+                '  {:>10}'.format(value) for value in values))
+        if not result.syscalls:
+            print('  syscalls: n/a (strace not found)')
 
     def _show_main_help(self):
         self._show_main_usage()
         print("\navailable commands:\n")
         print(self.cmd.render_help())
 
-    def _get_env_path(self, env_name, raise_exc=True):
-        env_path = os.path.join(self.env_dir, env_name)
-        if os.path.isdir(env_path):
-            return env_path
-        if raise_exc:
-            raise LuambException("environment '{}' doesn't exist".format(
-                                 env_name))
-
-    def _show_env_info(
-        self, env_name, detail=True, mark_active=True, raise_exc=True,
-    ):
-        env_path = self._get_env_path(env_name, raise_exc=raise_exc)
-        if not env_path:
-            return
-        if mark_active and env_name == self.active_env:
+    def _show_env_info(self, env, mark_active=True, snapshot_usage=False):
+        env_name = env.name
+        if mark_active and env.active:
             env_name = '(' + env_name + ')'
         print(env_name)
-        if not detail:
-            return
         print('=' * len(env_name))
-        self._call_hererocks(['--show', env_path])
-        project_file_path = os.path.join(env_path, '.project')
-        if os.path.isfile(project_file_path):
-            with open(project_file_path) as f:
-                print('Project:', f.read().strip())
-
-    def _fetch_supported_versions(self, hererocks_cls_name):
-        try:
-            cls = getattr(self.hererocks, hererocks_cls_name)
-        except AttributeError:
-            return {}
-        versions = {v: v for v in cls.versions}
-        versions.update(cls.translations)
-        return versions
-
-    def _get_supported_versions(self, product_key, raise_exc=True):
-        versions = self.supported_versions[product_key]
-        if versions or not raise_exc:
-            return versions
-        raise LuambException(
-            '{} is not supported\n'
-            'Try to upgrade hererocks'.format(self.product_names[product_key])
-        )
-
-    def _format_versions_string(self, versions):
-        return '  '.join(sorted(versions))
-
-    def _check_product_version_is_supported(self, product_key, version):
-        if product_key != 'luarocks' and product_key not in self.lua_types:
-            raise LuambException(
-                'Unsupported Lua interpreter: {}'.format(product_key)
-            )
-        product_name = self.product_names[product_key]
-        if not version:
-            raise LuambException(
-                '{} version is not specified'.format(product_name))
-        if self._is_local_path_or_git_uri(version):
-            return
-        supported_versions = self._get_supported_versions(product_key)
-        if version not in supported_versions:
-            raise LuambException(
-                'Unsupported {} version: {}\n'
-                'Supported versions are: {}'.format(
-                    product_name,
-                    version,
-                    self._format_versions_string(supported_versions),
-                )
-            )
-
-    def _is_local_path_or_git_uri(self, version_string, skip_path_check=False):
-        if '@' in version_string:
-            return True
-        if (
-                not version_string.startswith('/')
-                and not version_string.startswith('./')
-                and not version_string.startswith('../')
-        ):
-            return False
-        if skip_path_check:
-            return True
-        if not os.path.exists(version_string):
-            raise LuambException(
-                "'{}' seems like local path "
-                "but doesn't exist".format(version_string)
-            )
-        if not os.path.isdir(version_string):
-            raise LuambException(
-                "'{}' is not a directory ".format(version_string)
-            )
-        return True
+        if env.programs:
+            print('Programs installed in {}:'.format(env.path))
+            for identifiers in env.programs:
+                self.hererocks.show_identifiers(identifiers)
+        else:
+            print('No programs installed in {}.'.format(env.path))
+        if env.project:
+            print('Project:', env.project)
+        if env.spec and env.spec.profile:
+            print('Build profile: {} ({})'.format(
+                env.spec.profile, ' '.join(env.spec.hererocks_args)))
+        if env.archived:
+            archived = env.archived
+            print('Archived: {} ({} -> {})'.format(
+                _format_time(archived.archived_at),
+                _format_size(archived.size),
+                _format_size(archived.archive_size)))
+            if archived.last_activated:
+                print('Last activated:',
+                      _format_time(archived.last_activated))
+        # computing usage walks snapshot trees, 'ls' must stay cheap
+        snapshots = api.list_env_snapshots(
+            self.env_dir, env.name, usage=snapshot_usage)
+        if snapshots:
+            print('Snapshots:')
+            width = max(len(snapshot.tag) for snapshot in snapshots)
+            for snapshot in snapshots:
+                line = '  {0:<{1}}  {2}  {3:<8}'.format(
+                    snapshot.tag, width, _format_time(snapshot.created_at),
+                    snapshot.method)
+                if snapshot.unique_size is not None:
+                    line += '  {} unique'.format(
+                        _format_size(snapshot.unique_size))
+                print(line.rstrip())
@@ -0,0 +1,261 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import glob
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from luamb._exceptions import LuambException
+from luamb._rocks import call_luarocks
+
+
+DEFAULT_ROCKS_UPSTREAM = 'https://luarocks.org'
+
+CONFIG_MARKER = '-- luamb: shared rocks cache and mirror'
+
+CONFIG_TEMPLATE = '''
+{marker}
+local_cache = {cache_dir}
+rocks_servers = {{
+    {mirror_dir},
+    {upstream},
+}}
+'''
+
+EMPTY_MANIFEST = 'repository = {}\nmodules = {}\ncommands = {}\n'
+
+# prints dependencies of the rockspec read from stdin (Lua 5.1-5.4)
+ROCKSPEC_DEPENDENCIES_SCRIPT = '''
+local source = io.read('*a')
+local env = {}
+local chunk
+if setfenv then
+    chunk = assert(loadstring(source, 'rockspec'))
+    setfenv(chunk, env)
+else
+    chunk = assert(load(source, 'rockspec', 't', env))
+end
+chunk()
+for _, dependency in ipairs(env.dependencies or {}) do
+    print(dependency)
+end
+'''
+
+_dependency_name_re = re.compile(r'^\s*([^\s<>=~]+)')
+
+_rock_file_re = re.compile(
+    r'^(?P<name>.+)-(?P<version>[^-]+-[^-]+)\.(?:src\.rock|rockspec)$')
+
+
+def lua_string(value):
+    return '"{}"'.format(
+        value.replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
+
+
+def init_mirror(mirror_dir):
+    """Create the mirror with an empty manifest if it doesn't exist
+
+    LuaRocks warns about servers without manifest, so an empty one
+    is written before anything is prefetched.
+    """
+    if not os.path.isdir(mirror_dir):
+        os.makedirs(mirror_dir)
+    manifest = os.path.join(mirror_dir, 'manifest')
+    if not os.path.exists(manifest):
+        with open(manifest, 'w') as f:
+            f.write(EMPTY_MANIFEST)
+
+
+def get_luarocks_config_paths(env_path):
+    return sorted(glob.glob(
+        os.path.join(env_path, 'etc', 'luarocks', 'config*.lua')))
+
+
+def configure_env(env_path, mirror_dir, cache_dir, upstream=None):
+    """Point LuaRocks of the environment at the shared cache and mirror
+
+    Return True if the config has been changed. hererocks rewrites
+    the config whenever LuaRocks is (re)installed, so this is called
+    after every build.
+    """
+    config_paths = get_luarocks_config_paths(env_path)
+    if not config_paths:
+        return False
+    init_mirror(mirror_dir)
+    block = CONFIG_TEMPLATE.format(
+        marker=CONFIG_MARKER,
+        cache_dir=lua_string(cache_dir),
+        mirror_dir=lua_string(mirror_dir),
+        upstream=lua_string(upstream or DEFAULT_ROCKS_UPSTREAM),
+    )
+    changed = False
+    for config_path in config_paths:
+        with open(config_path) as f:
+            config = f.read()
+        if CONFIG_MARKER in config:
+            continue
+        with open(config_path, 'a') as f:
+            f.write(block)
+        changed = True
+    return changed
+
+
+def parse_rock_arg(arg):
+    """Split NAME or NAME==VERSION"""
+    name, _, version = arg.partition('==')
+    if not name or '/' in name or (_ and not version):
+        raise LuambException("invalid rock: '{}'".format(arg))
+    return name, version or None
+
+
+def iter_mirrored_rocks(mirror_dir):
+    """Yield (name, version) of rocks in the mirror"""
+    try:
+        file_names = os.listdir(mirror_dir)
+    except OSError:
+        return
+    for file_name in sorted(file_names):
+        match = _rock_file_re.match(file_name)
+        if match:
+            yield match.group('name'), match.group('version')
+
+
+def _read_rockspec(path):
+    if path.endswith('.rockspec'):
+        with open(path, 'rb') as f:
+            return f.read()
+    with zipfile.ZipFile(path) as rock:
+        for member in rock.namelist():
+            if member.endswith('.rockspec') and '/' not in member:
+                return rock.read(member)
+    return None
+
+
+def get_rock_dependencies(env_path, path):
+    """Return names of rocks the downloaded rock depends on"""
+    try:
+        rockspec = _read_rockspec(path)
+    except (IOError, OSError, zipfile.BadZipfile):
+        rockspec = None
+    if rockspec is None:
+        raise LuambException("can't read rockspec from '{}'".format(path))
+    proc = subprocess.Popen(
+        [os.path.join(env_path, 'bin', 'lua'), '-e',
+         ROCKSPEC_DEPENDENCIES_SCRIPT],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = proc.communicate(rockspec)[0].decode('utf-8', 'replace')
+    if proc.returncode:
+        raise LuambException("can't parse rockspec from '{}': {}".format(
+            path, output.strip()))
+    names = []
+    for line in output.splitlines():
+        match = _dependency_name_re.match(line)
+        if match and match.group(1) != 'lua':
+            names.append(match.group(1))
+    return names
+
+
+def _download(env_path, staging_dir, upstream, name, version):
+    """Download source rock (or rockspec) to a private directory"""
+    download_dir = tempfile.mkdtemp(prefix='prefetch-', dir=staging_dir)
+    args = ['--only-server=' + upstream, name]
+    if version:
+        args.append(version)
+    try:
+        try:
+            call_luarocks(
+                env_path, 'download', '--source', *args,
+                capture_output=True, cwd=download_dir)
+        except LuambException:
+            # rocks without source rocks (e.g., git-based ones)
+            call_luarocks(
+                env_path, 'download', '--rockspec', *args,
+                capture_output=True, cwd=download_dir)
+    except LuambException:
+        shutil.rmtree(download_dir, ignore_errors=True)
+        raise
+    return download_dir
+
+
+def prefetch(env_path, mirror_dir, staging_dir, rocks, upstream=None,
+             jobs=None):
+    """Download rocks and their dependencies into the mirror concurrently
+
+    rocks is a list of (name, version or None). Dependencies are
+    resolved by rockspecs in waves; a dependency already present in
+    the mirror in any version is not downloaded again. luarocks
+    download doesn't support version constraints, so dependencies are
+    fetched in their latest versions.
+    Return list of file names added to the mirror.
+    """
+    upstream = upstream or DEFAULT_ROCKS_UPSTREAM
+    init_mirror(mirror_dir)
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    mirrored = set(name for name, _ in iter_mirrored_rocks(mirror_dir))
+    seen = set(name for name, _ in rocks)
+    added = []
+    errors = []
+
+    def fetch(rock):
+        name, version = rock
+        try:
+            download_dir = _download(
+                env_path, staging_dir, upstream, name, version)
+        except LuambException as exc:
+            return rock, [], [], exc
+        try:
+            file_names = os.listdir(download_dir)
+            dependencies = []
+            for file_name in file_names:
+                dependencies.extend(get_rock_dependencies(
+                    env_path, os.path.join(download_dir, file_name)))
+                # rename is atomic, concurrent luarocks never sees
+                # a partially written file
+                os.rename(os.path.join(download_dir, file_name),
+                          os.path.join(mirror_dir, file_name))
+        except (LuambException, OSError) as exc:
+            return rock, [], [], exc
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+        return rock, file_names, dependencies, None
+
+    wave = list(rocks)
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = ThreadPool(min(jobs, max(len(wave), 1)))
+    try:
+        while wave:
+            next_wave = []
+            for rock, file_names, dependencies, exc in pool.imap_unordered(
+                    fetch, wave):
+                if exc:
+                    errors.append('{}: {}'.format(rock[0], exc))
+                    continue
+                added.extend(file_names)
+                for name in dependencies:
+                    if name not in seen and name not in mirrored:
+                        seen.add(name)
+                        next_wave.append((name, None))
+            wave = next_wave
+    finally:
+        pool.close()
+        pool.join()
+    if added:
+        luarocks_admin = os.path.join(env_path, 'bin', 'luarocks-admin')
+        with open(os.devnull, 'w') as devnull:
+            status = subprocess.call(
+                [luarocks_admin, 'make_manifest', mirror_dir], stdout=devnull)
+        if status:
+            errors.append("failed to rebuild manifest of '{}'".format(
+                mirror_dir))
+    if errors:
+        raise LuambException('\n'.join(errors))
+    return sorted(added)
@@ -0,0 +1,531 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import copy
+import os
+import re
+import subprocess
+import tempfile
+from collections import OrderedDict
+
+from luamb._ccache import _shell_quote, find_executable
+from luamb._exceptions import LuambException
+from luamb._mirror import lua_string
+from luamb._rocks import (
+    HOOKED_LUAROCKS_PATH, LUAROCKS_HOOK_MARKER, get_rocks_tree,
+    is_luarocks_hook,
+)
+
+
+INDEX_PATH = os.path.join('lib', 'luamb', 'index.lua')
+
+# variables changing package.path/cpath or running code at startup
+LUA_ENV_VAR_RE = re.compile(r'^LUA_(?:INIT|PATH|CPATH)(?:_\d+_\d+)?$')
+
+SEARCH_PATHS_SCRIPT = (
+    "io.write(package.path, '\\n', package.cpath, '\\n', "
+    "package.config:sub(1, 1))"
+)
+
+# reads module names from stdin, requires them, writes CPU time spent
+BENCHMARK_SCRIPT = '''
+local names = {}
+for name in io.lines() do
+    names[#names + 1] = name
+end
+local start = os.clock()
+for _, name in ipairs(names) do
+    pcall(require, name)
+end
+io.write(string.format('%.9f', os.clock() - start))
+'''
+
+INDEX_TEMPLATE = '''\
+-- generated by luamb index, do not edit
+--
+-- Installs a package searcher resolving modules from the precomputed
+-- map before the default searchers walk package.path/package.cpath.
+-- The index is ignored if the search paths differ or the LuaRocks
+-- manifest has changed since indexing; modules missing from the index
+-- and stale entries are resolved by the default searchers.
+local path = {path}
+local cpath = {cpath}
+local manifest = {manifest}
+local manifest_size = {manifest_size}
+local dirsep = {dirsep}
+-- name = {{file, rank[, bytecode, source copy]}}, rank is the template
+-- position in the path, bytecode was compiled from the source copy
+local lua_modules = {{
+{lua_modules}}}
+local c_modules = {{
+{c_modules}}}
+-- {{rank, template}} of not indexed templates (relative or outside
+-- the environment), checked if they precede the indexed one
+local lua_unindexed = {{
+{lua_unindexed}}}
+local c_unindexed = {{
+{c_unindexed}}}
+
+if manifest then
+    local f = io.open(manifest, 'rb')
+    local size = f and f:seek('end')
+    if f then
+        f:close()
+    end
+    if size ~= manifest_size then
+        return
+    end
+end
+
+local function shadowed(name, rank, templates)
+    local file_name = name:gsub('%.', dirsep)
+    for i = 1, #templates do
+        local template = templates[i]
+        if template[1] >= rank then
+            return false
+        end
+        local f = io.open(template[2]:gsub('%?', function()
+            return file_name
+        end), 'rb')
+        if f then
+            f:close()
+            return true
+        end
+    end
+    return false
+end
+
+local function read(file_name)
+    local f = io.open(file_name, 'rb')
+    if f then
+        local result = f:read('*a')
+        f:close()
+        return result
+    end
+end
+
+local function searcher(name)
+    if package.path ~= path or package.cpath ~= cpath then
+        return nil
+    end
+    local entry = lua_modules[name]
+    if entry then
+        if not shadowed(name, entry[2], lua_unindexed) then
+            local loader
+            -- bytecode of a changed source or another interpreter
+            -- is ignored
+            if entry[3] then
+                local source = read(entry[1])
+                if source and source == read(entry[4]) then
+                    loader = loadfile(entry[3])
+                end
+            end
+            loader = loader or loadfile(entry[1])
+            if loader then
+                return loader, entry[1]
+            end
+        end
+        return nil
+    end
+    entry = c_modules[name]
+    if entry and not shadowed(name, math.huge, lua_unindexed)
+            and not shadowed(name, entry[2], c_unindexed) then
+        local symbol = 'luaopen_' .. name:gsub('%.', '_')
+        local loader = package.loadlib(entry[1], symbol)
+        if loader then
+            return loader, entry[1]
+        end
+    end
+    return nil
+end
+
+local searchers = package.searchers or package.loaders
+-- after the preload searcher
+table.insert(searchers, 2, searcher)
+'''
+
+# replaces bin/luarocks of an indexed environment, runs the refresh
+# command if the LuaRocks manifest has changed since indexing
+LUAROCKS_HOOK_TEMPLATE = '''\
+#!/bin/sh
+{marker}: refreshes the module index after rocks change
+{luarocks} "$@"
+status=$?
+size=$(wc -c 2>/dev/null < {manifest} | tr -d ' ')
+if [ -f {index} ] && [ "$size" != {manifest_size} ]; then
+    {refresh_command} >&2
+fi
+exit $status
+'''
+
+
+class ModuleIndex(object):
+
+    def __init__(self, path, cpath, dirsep, lua_modules, c_modules,
+                 lua_unindexed, c_unindexed, manifest=None,
+                 manifest_size=None, bytecode=None):
+        self.path = path
+        self.cpath = cpath
+        self.dirsep = dirsep
+        # OrderedDict {module name: (file path, template rank)}
+        self.lua_modules = lua_modules
+        self.c_modules = c_modules
+        # [(template rank, template)]
+        self.lua_unindexed = lua_unindexed
+        self.c_unindexed = c_unindexed
+        self.manifest = manifest
+        self.manifest_size = manifest_size
+        # {source path: (bytecode path, source copy path)}
+        self.bytecode = bytecode or {}
+
+    def render(self):
+        def modules(dct):
+            lines = []
+            for name, (path, rank) in dct.items():
+                fields = [lua_string(path), str(rank)]
+                if path in self.bytecode:
+                    fields.extend(
+                        lua_string(bytecode_path)
+                        for bytecode_path in self.bytecode[path])
+                lines.append('    [{}] = {{{}}},\n'.format(
+                    lua_string(name), ', '.join(fields)))
+            return ''.join(lines)
+
+        def templates(lst):
+            return ''.join(
+                '    {{{}, {}}},\n'.format(rank, lua_string(template))
+                for rank, template in lst)
+
+        return INDEX_TEMPLATE.format(
+            path=lua_string(self.path),
+            cpath=lua_string(self.cpath),
+            manifest=lua_string(self.manifest) if self.manifest else 'nil',
+            manifest_size=(
+                self.manifest_size if self.manifest_size is not None
+                else 'nil'),
+            dirsep=lua_string(self.dirsep),
+            lua_modules=modules(self.lua_modules),
+            c_modules=modules(self.c_modules),
+            lua_unindexed=templates(self.lua_unindexed),
+            c_unindexed=templates(self.c_unindexed),
+        )
+
+
+class IndexBenchmark(object):
+    """require() cost without and with the index
+
+    Values are (without index, with index) pairs, or triples if the
+    index is also measured with bytecode. syscalls and failed_syscalls
+    are None if strace is not available, probes are file opens
+    estimated by simulating the searchers.
+    """
+
+    def __init__(self, modules, require_time, probes, syscalls=None,
+                 failed_syscalls=None):
+        self.modules = modules
+        self.require_time = require_time
+        self.probes = probes
+        self.syscalls = syscalls
+        self.failed_syscalls = failed_syscalls
+
+
+def get_index_path(env_path):
+    return os.path.join(env_path, INDEX_PATH)
+
+
+def clean_environ(lua_init=None):
+    environ = dict(
+        (key, value) for key, value in os.environ.items()
+        if not LUA_ENV_VAR_RE.match(key))
+    if lua_init:
+        environ['LUA_INIT'] = lua_init
+    return environ
+
+
+def _get_lua(env_path):
+    lua = os.path.join(env_path, 'bin', 'lua')
+    if not os.path.isfile(lua):
+        raise LuambException(
+            "no Lua interpreter in '{}'".format(env_path))
+    return lua
+
+
+def get_search_paths(env_path):
+    """Return default (package.path, package.cpath, directory separator)"""
+    proc = subprocess.Popen(
+        [_get_lua(env_path), '-e', SEARCH_PATHS_SCRIPT],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        env=clean_environ())
+    output = proc.communicate()[0].decode('utf-8', 'replace')
+    lines = output.split('\n')
+    if proc.returncode or len(lines) != 3:
+        raise LuambException(
+            "can't get search paths: {}".format(output.strip()))
+    path, cpath, dirsep = lines
+    return path, cpath, dirsep
+
+
+def _is_indexable(template, env_path):
+    return (
+        template.count('?') == 1
+        and os.path.isabs(template)
+        and template.startswith(os.path.join(env_path, ''))
+    )
+
+
+def iter_template_modules(template, dirsep='/'):
+    """Yield (module name, file path) matching the template
+
+    Only templates with a single '?' are supported, names containing
+    dots can't be produced by the searchers and are skipped.
+    """
+    prefix, suffix = template.split('?')
+    base_dir = prefix if prefix.endswith(dirsep) else os.path.dirname(prefix)
+    for dir_path, dir_names, file_names in os.walk(base_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            if not (file_path.startswith(prefix)
+                    and file_path.endswith(suffix)):
+                continue
+            name = file_path[len(prefix):len(file_path) - len(suffix)]
+            if not name or '.' in name:
+                continue
+            parts = name.split(dirsep)
+            if '' in parts:
+                continue
+            yield '.'.join(parts), file_path
+
+
+def _index_templates(templates, env_path, dirsep, skip=lambda name: False):
+    modules = OrderedDict()
+    unindexed = []
+    for rank, template in enumerate(templates):
+        if not _is_indexable(template, env_path):
+            unindexed.append((rank, template))
+            continue
+        for name, file_path in iter_template_modules(template, dirsep):
+            if name not in modules and not skip(name):
+                modules[name] = (file_path, rank)
+    return modules, unindexed
+
+
+def _split_templates(path):
+    return [template for template in path.split(';') if template]
+
+
+def build_index(env_path):
+    env_path = os.path.abspath(env_path)
+    path, cpath, dirsep = get_search_paths(env_path)
+    lua_modules, lua_unindexed = _index_templates(
+        _split_templates(path), env_path, dirsep)
+    # luaopen_ function names of modules with hyphens differ between
+    # Lua versions, leave them to the default searcher
+    c_modules, c_unindexed = _index_templates(
+        _split_templates(cpath), env_path, dirsep,
+        skip=lambda name: '-' in name)
+    manifest = manifest_size = None
+    rocks_tree = get_rocks_tree(env_path)
+    if rocks_tree and os.path.isfile(os.path.join(rocks_tree, 'manifest')):
+        manifest = os.path.join(rocks_tree, 'manifest')
+        manifest_size = os.path.getsize(manifest)
+    return ModuleIndex(
+        path, cpath, dirsep, lua_modules, c_modules, lua_unindexed,
+        c_unindexed, manifest=manifest, manifest_size=manifest_size)
+
+
+def write_index(env_path, index):
+    index_path = get_index_path(env_path)
+    index_dir = os.path.dirname(index_path)
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    fd, tmp_path = tempfile.mkstemp(prefix='.index-', dir=index_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(index.render().encode('utf-8'))
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, index_path)
+    return index_path
+
+
+def install_luarocks_hook(env_path, index, refresh_argv):
+    """Make bin/luarocks run refresh_argv when rocks change
+
+    The original script is moved to HOOKED_LUAROCKS_PATH; a luarocks
+    reinstalled over the hook (e.g., by an upgrade) replaces it there.
+    Return False if the environment has no LuaRocks.
+    """
+    bin_path = os.path.join(env_path, 'bin', 'luarocks')
+    real_path = os.path.join(env_path, HOOKED_LUAROCKS_PATH)
+    if index.manifest is None or not os.path.isfile(bin_path):
+        return False
+    if not is_luarocks_hook(bin_path):
+        if not os.path.isdir(os.path.dirname(real_path)):
+            os.makedirs(os.path.dirname(real_path))
+        os.rename(bin_path, real_path)
+    elif not os.path.isfile(real_path):
+        return False
+    script = LUAROCKS_HOOK_TEMPLATE.format(
+        marker=LUAROCKS_HOOK_MARKER,
+        luarocks=_shell_quote(real_path),
+        index=_shell_quote(get_index_path(env_path)),
+        manifest=_shell_quote(index.manifest),
+        manifest_size=index.manifest_size,
+        refresh_command=' '.join(_shell_quote(arg) for arg in refresh_argv),
+    )
+    # replaced, not rewritten: the file may be shared with snapshots
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.luarocks-', dir=os.path.dirname(bin_path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(script)
+    os.chmod(tmp_path, 0o755)
+    os.rename(tmp_path, bin_path)
+    return True
+
+
+def remove_luarocks_hook(env_path):
+    bin_path = os.path.join(env_path, 'bin', 'luarocks')
+    real_path = os.path.join(env_path, HOOKED_LUAROCKS_PATH)
+    if is_luarocks_hook(bin_path) and os.path.isfile(real_path):
+        os.rename(real_path, bin_path)
+
+
+def remove_index(env_path):
+    """Remove the index chunk, keeping bytecode in the same directory"""
+    index_path = get_index_path(env_path)
+    if not os.path.isfile(index_path):
+        return False
+    remove_luarocks_hook(env_path)
+    os.remove(index_path)
+    try:
+        os.rmdir(os.path.dirname(index_path))
+    except OSError:
+        # bytecode is there
+        pass
+    return True
+
+
+def count_probes(index, names, use_index):
+    """Estimate the number of files opened to resolve modules"""
+    lua_templates = _split_templates(index.path)
+    c_templates = _split_templates(index.cpath)
+    probes = 0
+    for name in names:
+        file_name = name.replace('.', index.dirsep)
+        if use_index:
+            # shadowing checks and the load itself, see the searcher
+            entry = index.lua_modules.get(name)
+            if entry is not None:
+                probes += 1 + sum(
+                    1 for rank, _ in index.lua_unindexed if rank < entry[1])
+                continue
+            entry = index.c_modules.get(name)
+            if entry is not None:
+                probes += 1 + len(index.lua_unindexed) + sum(
+                    1 for rank, _ in index.c_unindexed if rank < entry[1])
+                continue
+        for template in lua_templates + c_templates:
+            probes += 1
+            if os.path.isfile(template.replace('?', file_name)):
+                break
+    return probes
+
+
+def _run_benchmark(lua, names, lua_init):
+    proc = subprocess.Popen(
+        [lua, '-e', BENCHMARK_SCRIPT],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, env=clean_environ(lua_init))
+    output = proc.communicate('\n'.join(names).encode('utf-8'))[0]
+    output = output.decode('utf-8', 'replace').strip()
+    if proc.returncode:
+        raise LuambException('benchmark failed: {}'.format(output))
+    try:
+        return float(output.splitlines()[-1])
+    except (IndexError, ValueError):
+        raise LuambException('benchmark failed: {}'.format(output))
+
+
+def _count_syscalls(lua, names, lua_init):
+    """Return (calls, failed calls) counted by strace or None"""
+    strace = find_executable('strace')
+    if not strace:
+        return None
+    fd, output_path = tempfile.mkstemp(prefix='luamb-strace-')
+    os.close(fd)
+    try:
+        proc = subprocess.Popen(
+            [strace, '-f', '-c', '-o', output_path, lua, '-e',
+             BENCHMARK_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, env=clean_environ(lua_init))
+        proc.communicate('\n'.join(names).encode('utf-8'))
+        if proc.returncode:
+            return None
+        with open(output_path) as f:
+            for line in f:
+                tokens = line.split()
+                if tokens and tokens[-1] == 'total':
+                    numbers = tokens[:-1]
+                    calls = int(numbers[3])
+                    errors = int(numbers[4]) if len(numbers) > 4 else 0
+                    return calls, errors
+    except (OSError, ValueError, IndexError):
+        return None
+    finally:
+        os.remove(output_path)
+    return None
+
+
+def _count_bytecode_probes(index, names):
+    """Return the number of file opens comparing sources with copies"""
+    return sum(
+        2 for name in names
+        if name in index.lua_modules
+        and index.lua_modules[name][0] in index.bytecode)
+
+
+def benchmark(env_path, index, names=None, repeat=5, bytecode=False):
+    """Compare require() of modules without and with the index
+
+    All indexed modules are required by default. Every run is a fresh
+    interpreter, the median CPU time of repeat runs is reported. With
+    bytecode, the index is measured without and with bytecode.
+    """
+    lua = _get_lua(env_path)
+    if not names:
+        names = list(index.lua_modules) + list(index.c_modules)
+    if not names:
+        raise LuambException("no modules to benchmark")
+    index_path = get_index_path(env_path)
+    if not os.path.isfile(index_path):
+        raise LuambException("environment is not indexed")
+    index_probes = count_probes(index, names, use_index=True)
+    probes = [count_probes(index, names, use_index=False), index_probes]
+    variants = [None, '@' + index_path]
+    source_index_path = None
+    if bytecode:
+        source_index = copy.copy(index)
+        source_index.bytecode = {}
+        fd, source_index_path = tempfile.mkstemp(
+            prefix='.index-', dir=os.path.dirname(index_path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(source_index.render().encode('utf-8'))
+        variants.insert(1, '@' + source_index_path)
+        probes.append(index_probes + _count_bytecode_probes(index, names))
+    try:
+        times = []
+        for lua_init in variants:
+            samples = sorted(
+                _run_benchmark(lua, names, lua_init) for _ in range(repeat))
+            times.append(samples[len(samples) // 2])
+        syscalls = [
+            _count_syscalls(lua, names, lua_init) for lua_init in variants]
+    finally:
+        if source_index_path:
+            os.remove(source_index_path)
+    result = IndexBenchmark(
+        modules=names, require_time=tuple(times), probes=tuple(probes))
+    if None not in syscalls:
+        result.syscalls = tuple(calls for calls, _ in syscalls)
+        result.failed_syscalls = tuple(errors for _, errors in syscalls)
+    return result
@@ -0,0 +1,29 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import os
+
+
+# luamb keeps its own data (caches, logs, etc.) in this LUAMB_DIR subdirectory
+STATE_DIR_NAME = '.luamb'
+
+PROJECT_FILE_NAME = '.project'
+
+
+def is_valid_env_name(env_name):
+    return bool(
+        env_name and env_name not in ('.', '..', STATE_DIR_NAME)
+        and '/' not in env_name
+    )
+
+
+def get_state_path(env_dir, *parts):
+    return os.path.join(env_dir, STATE_DIR_NAME, *parts)
+
+
+def list_env_names(env_dir):
+    envs = next(os.walk(env_dir))[1]
+    if STATE_DIR_NAME in envs:
+        envs.remove(STATE_DIR_NAME)
+    envs.sort()
+    return envs
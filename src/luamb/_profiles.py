@@ -0,0 +1,182 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+import os
+from collections import OrderedDict
+
+from luamb._check import describe_failure, run_program
+from luamb._exceptions import LuambException
+
+
+PROFILES_FILE_NAME = 'profiles.json'
+
+JIT_LUA_TYPES = ('luajit', 'moonjit', 'raptorjit')
+
+# exercises the parser, tables, strings and arithmetic; works with
+# Lua 5.1-5.4 and LuaJIT
+DEFAULT_VERIFY_SCRIPT = (
+    'local t = {} '
+    'for i = 1, 1000 do t[i] = i * i end '
+    'local s = 0 '
+    'for _, v in ipairs(t) do s = s + v end '
+    'assert(s == 333833500) '
+    'assert(("%d"):format(42) .. ("ab"):rep(2) == "42abab") '
+    'assert(math.floor(7 / 2) == 3) '
+    'assert(select("#", pcall(error, "x")) == 2) '
+    'io.write("ok")'
+)
+
+
+class BuildProfile(object):
+    """Named set of hererocks arguments
+
+    cflags are passed with --cflags (hererocks adds them to the Lua
+    build and to the LuaRocks config, so rocks are built with them too),
+    jit_cflags replace cflags for LuaJIT-based interpreters. verify is
+    a Lua chunk run with the new interpreter after the build; it must
+    write 'ok' to stdout.
+    """
+
+    def __init__(self, name, description='', cflags=None, jit_cflags=None,
+                 args=(), verify=None):
+        self.name = name
+        self.description = description
+        self.cflags = cflags
+        self.jit_cflags = jit_cflags
+        self.args = list(args)
+        self.verify = verify or DEFAULT_VERIFY_SCRIPT
+
+    def get_cflags(self, lua_type):
+        if lua_type in JIT_LUA_TYPES and self.jit_cflags is not None:
+            return self.jit_cflags
+        return self.cflags
+
+    def get_hererocks_args(self, lua_type):
+        cflags = self.get_cflags(lua_type)
+        args = []
+        if cflags:
+            args.append('--cflags=' + cflags)
+        return args + self.args
+
+    @classmethod
+    def from_dict(cls, name, dct):
+        if not isinstance(dct, dict):
+            raise TypeError
+        unknown_keys = set(dct) - set(
+            ('description', 'cflags', 'jit_cflags', 'args', 'verify'))
+        if unknown_keys:
+            raise KeyError(', '.join(sorted(unknown_keys)))
+        args = dct.get('args', [])
+        if not isinstance(args, list):
+            raise TypeError
+        return cls(
+            name,
+            description=dct.get('description', ''),
+            cflags=dct.get('cflags'),
+            jit_cflags=dct.get('jit_cflags'),
+            args=args,
+            verify=dct.get('verify'),
+        )
+
+    def __repr__(self):
+        return '<BuildProfile {}>'.format(self.name)
+
+
+BUILTIN_PROFILES = OrderedDict((profile.name, profile) for profile in (
+    BuildProfile(
+        'release',
+        description='optimized portable build (-O3)',
+        cflags='-O3',
+    ),
+    BuildProfile(
+        'release-native',
+        description=(
+            'optimized for the build machine CPU with link-time '
+            'optimization (no LTO for LuaJIT)'),
+        cflags='-O3 -march=native -flto',
+        jit_cflags='-O3 -march=native',
+    ),
+    BuildProfile(
+        'debug',
+        description='no optimization, debug info, API checks and assertions',
+        cflags='-O0 -g -DLUA_USE_APICHECK -DLUAI_ASSERT',
+        jit_cflags='-O0 -g -DLUA_USE_APICHECK -DLUA_USE_ASSERT',
+    ),
+))
+
+
+def load_profiles(path=None):
+    """Return built-in profiles updated with profiles from the JSON file
+
+    The file maps profile names to objects with optional description,
+    cflags, jit_cflags, args (list of hererocks arguments) and verify
+    keys. User profiles override built-in ones with the same name.
+    """
+    profiles = OrderedDict(BUILTIN_PROFILES)
+    if not path or not os.path.exists(path):
+        return profiles
+    try:
+        with open(path) as f:
+            data = json.load(f, object_pairs_hook=OrderedDict)
+    except (IOError, OSError) as exc:
+        raise LuambException("can't read profiles file: {}".format(exc))
+    except ValueError as exc:
+        raise LuambException("invalid profiles file '{}': {}".format(
+            path, exc))
+    if not isinstance(data, dict):
+        raise LuambException(
+            "invalid profiles file '{}': not an object".format(path))
+    for name, dct in data.items():
+        try:
+            profiles[name] = BuildProfile.from_dict(name, dct)
+        except KeyError as exc:
+            raise LuambException(
+                "invalid profile '{}' in '{}': unknown keys: {}".format(
+                    name, path, exc.args[0]))
+        except (TypeError, ValueError):
+            raise LuambException(
+                "invalid profile '{}' in '{}'".format(name, path))
+    return profiles
+
+
+def get_profile(name, path=None):
+    profiles = load_profiles(path)
+    try:
+        return profiles[name]
+    except KeyError:
+        raise LuambException(
+            "unknown build profile '{}', available profiles: {}".format(
+                name, ', '.join(profiles)))
+
+
+def check_no_cflags(hererocks_args):
+    for arg in hererocks_args:
+        if arg == '--cflags' or arg.startswith('--cflags='):
+            raise LuambException(
+                '--cflags cannot be combined with a build profile, '
+                'define a profile instead')
+
+
+def change_lua_type(profile, hererocks_args, lua_type):
+    """Return expanded hererocks_args of the profile for another lua_type
+
+    Only cflags depend on the interpreter; as profiles can't be combined
+    with --cflags (see check_no_cflags()), any --cflags comes from
+    the profile.
+    """
+    args = [arg for arg in hererocks_args if not arg.startswith('--cflags=')]
+    cflags = profile.get_cflags(lua_type)
+    return (['--cflags=' + cflags] if cflags else []) + args
+
+
+def verify_build(env_path, profile):
+    """Run the profile verification chunk with the new interpreter"""
+    lua = os.path.join(env_path, 'bin', 'lua')
+    status, output = run_program([lua, '-e', profile.verify])
+    if status != 0 or output != 'ok':
+        raise LuambException(
+            "build with profile '{}' failed verification: {}\n"
+            "the environment is kept for inspection: {}".format(
+                profile.name, describe_failure('lua', status, output),
+                env_path))
@@ -0,0 +1,286 @@
+# coding: utf-8
+from __future__ import print_function, unicode_literals
+
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from luamb._exceptions import LuambException
+
+
+ROCKS_TREE_PARENT = os.path.join('lib', 'luarocks')
+
+# bin/luarocks replaced by the module index hook (see _modindex) is moved
+# here, the hook script starts with the marker
+HOOKED_LUAROCKS_PATH = os.path.join('lib', 'luamb', 'luarocks')
+LUAROCKS_HOOK_MARKER = '# generated by luamb'
+
+_rock_manifest_lib_re = re.compile(r'^\s*lib\s*=', re.MULTILINE)
+
+
+class InstalledRock(object):
+
+    def __init__(self, name, version, rock_dir):
+        self.name = name
+        self.version = version
+        self.rock_dir = rock_dir
+
+    @property
+    def has_c_modules(self):
+        """Whether the rock installs modules to the lib/ (cpath) tree"""
+        try:
+            with open(os.path.join(self.rock_dir, 'rock_manifest')) as f:
+                return bool(_rock_manifest_lib_re.search(f.read()))
+        except (IOError, OSError):
+            return False
+
+    def __repr__(self):
+        return '<InstalledRock {} {}>'.format(self.name, self.version)
+
+
+def get_rocks_tree(env_path, lua_major_version=None):
+    """Return path to rocks tree of the environment or None
+
+    LuaRocks 3 keeps a tree per Lua major version (rocks-5.x),
+    LuaRocks 2 uses a single 'rocks' directory.
+    """
+    parent = os.path.join(env_path, ROCKS_TREE_PARENT)
+    if lua_major_version:
+        candidates = ['rocks-' + lua_major_version, 'rocks']
+    else:
+        try:
+            candidates = sorted(
+                (n for n in os.listdir(parent) if n.startswith('rocks')),
+                reverse=True,
+            )
+        except OSError:
+            return None
+    for name in candidates:
+        path = os.path.join(parent, name)
+        if os.path.isfile(os.path.join(path, 'manifest')):
+            return path
+    return None
+
+
+def iter_installed_rocks(rocks_tree):
+    """Yield rocks by walking the tree, without running luarocks"""
+    if not rocks_tree:
+        return
+    for name in sorted(os.listdir(rocks_tree)):
+        name_dir = os.path.join(rocks_tree, name)
+        if not os.path.isdir(name_dir):
+            continue
+        for version in sorted(os.listdir(name_dir)):
+            rock_dir = os.path.join(name_dir, version)
+            if os.path.isfile(os.path.join(rock_dir, 'rock_manifest')):
+                yield InstalledRock(name, version, rock_dir)
+
+
+def is_luarocks_hook(path):
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(256)
+    except (IOError, OSError):
+        return False
+    return LUAROCKS_HOOK_MARKER.encode('ascii') in head
+
+
+def get_luarocks_path(env_path):
+    """Return the luarocks script, bypassing the module index hook"""
+    path = os.path.join(env_path, 'bin', 'luarocks')
+    if not os.path.isfile(path):
+        raise LuambException(
+            "LuaRocks is not installed in '{}'".format(env_path))
+    if is_luarocks_hook(path):
+        return os.path.join(env_path, HOOKED_LUAROCKS_PATH)
+    return path
+
+
+def _run(command, cwd=None, capture_output=False, build_log=None):
+    """Run command, return (exit status, output or None)"""
+    if build_log is not None:
+        proc = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            cwd=cwd)
+        for line in iter(proc.stdout.readline, b''):
+            build_log.feed(line)
+        proc.stdout.close()
+        return proc.wait(), '\n'.join(build_log.tail)
+    if not capture_output:
+        return subprocess.call(command, cwd=cwd), None
+    proc = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        cwd=cwd)
+    output = proc.communicate()[0].decode('utf-8', 'replace')
+    return proc.returncode, output
+
+
+def call_luarocks(env_path, *args, **kwargs):
+    """Run luarocks of the environment
+
+    If capture_output=True, the output is returned instead of being
+    printed (and is included in the exception message on error).
+    If build_log (BuildLog) is given, the output is written there and
+    the last lines of the log are included in the exception message.
+    cwd is the working directory of luarocks.
+    """
+    capture_output = kwargs.pop('capture_output', False)
+    build_log = kwargs.pop('build_log', None)
+    cwd = kwargs.pop('cwd', None)
+    command = [get_luarocks_path(env_path)] + list(args)
+    status, output = _run(
+        command, cwd=cwd, capture_output=capture_output, build_log=build_log)
+    if status:
+        msg = 'luarocks exited with non-zero status: {}\ncommand: {}'.format(
+            status, ' '.join(command))
+        if output:
+            msg = '{}\n{}'.format(msg, output.rstrip())
+        raise LuambException(msg)
+    return output if capture_output else None
+
+
+# lockfiles
+
+LOCKFILE_VERSION = 1
+
+
+class LockedRock(object):
+
+    def __init__(self, name, version, has_c_modules=False):
+        self.name = name
+        self.version = version
+        self.has_c_modules = has_c_modules
+
+    @property
+    def key(self):
+        return self.name, self.version
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'version': self.version,
+            'c_modules': self.has_c_modules,
+        }
+
+    @classmethod
+    def from_dict(cls, dct):
+        return cls(dct['name'], dct['version'], dct.get('c_modules', False))
+
+
+def freeze(spec, rocks_tree):
+    return {
+        'lockfile_version': LOCKFILE_VERSION,
+        'spec': spec.to_dict() if spec else None,
+        'rocks': [
+            LockedRock(rock.name, rock.version, rock.has_c_modules).to_dict()
+            for rock in iter_installed_rocks(rocks_tree)
+        ],
+    }
+
+
+def read_lockfile(path):
+    try:
+        with open(path) as f:
+            lock = json.load(f)
+        rocks = [LockedRock.from_dict(dct) for dct in lock['rocks']]
+    except (IOError, OSError) as exc:
+        raise LuambException("can't read lockfile: {}".format(exc))
+    except (ValueError, KeyError, TypeError):
+        raise LuambException("'{}' is not a valid lockfile".format(path))
+    if lock.get('lockfile_version') != LOCKFILE_VERSION:
+        raise LuambException(
+            'unsupported lockfile version: {}'.format(
+                lock.get('lockfile_version')))
+    return lock.get('spec'), rocks
+
+
+def plan_sync(installed_rocks, locked_rocks):
+    """Return (rocks to remove, rocks to install)"""
+    installed = {(rock.name, rock.version): rock for rock in installed_rocks}
+    locked_keys = set(rock.key for rock in locked_rocks)
+    to_remove = [
+        rock for key, rock in sorted(installed.items())
+        if key not in locked_keys
+    ]
+    to_install = [rock for rock in locked_rocks if rock.key not in installed]
+    return to_remove, to_install
+
+
+def _supports_no_manifest(env_path):
+    try:
+        output = call_luarocks(
+            env_path, 'help', 'install', capture_output=True)
+    except LuambException:
+        return False
+    return '--no-manifest' in output
+
+
+def install_rocks(env_path, rocks_tree, rocks, jobs=None, build_log=None):
+    """Install exact rock versions with dependency resolution disabled
+
+    The lockfile contains the whole dependency closure, so installs are
+    independent of each other. Pure-Lua rocks are installed concurrently
+    (with manifest updates postponed and done once at the end), rocks with
+    C modules are built one by one afterwards. Progress and luarocks
+    output go to build_log (BuildLog) if given, to stdout otherwise.
+    """
+    install_args = ['install', '--deps-mode=none']
+    pure_lua = [rock for rock in rocks if not rock.has_c_modules]
+    with_c = [rock for rock in rocks if rock.has_c_modules]
+    concurrent = (
+        len(pure_lua) > 1 and rocks_tree and _supports_no_manifest(env_path))
+    if not concurrent:
+        with_c = pure_lua + with_c
+        pure_lua = []
+
+    def report(text):
+        if build_log is None:
+            print(text)
+        else:
+            build_log.feed(text + '\n')
+
+    def install(rock):
+        try:
+            output = call_luarocks(
+                env_path,
+                *(install_args + ['--no-manifest', rock.name, rock.version]),
+                capture_output=True
+            )
+        except LuambException as exc:
+            return rock, None, exc
+        return rock, output, None
+
+    if pure_lua:
+        jobs = jobs or multiprocessing.cpu_count()
+        pool = ThreadPool(min(jobs, len(pure_lua)))
+        errors = []
+        try:
+            for rock, output, exc in pool.imap_unordered(install, pure_lua):
+                if exc:
+                    errors.append('{} {}: {}'.format(
+                        rock.name, rock.version, exc))
+                    continue
+                if build_log is not None:
+                    # concurrent outputs are not interleaved in the log
+                    build_log.feed(output)
+                report('Installed {} {}'.format(rock.name, rock.version))
+        finally:
+            pool.close()
+            pool.join()
+        luarocks_admin = os.path.join(env_path, 'bin', 'luarocks-admin')
+        status, _ = _run(
+            [luarocks_admin, 'make_manifest', '--local-tree', rocks_tree],
+            build_log=build_log)
+        if status:
+            errors.append(
+                'failed to rebuild manifest of {}'.format(rocks_tree))
+        if errors:
+            raise LuambException('\n'.join(errors))
+    for rock in with_c:
+        report('Installing {} {}'.format(rock.name, rock.version))
+        call_luarocks(
+            env_path, *(install_args + [rock.name, rock.version]),
+            build_log=build_log)
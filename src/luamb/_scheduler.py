@@ -0,0 +1,302 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import contextlib
+import errno
+import fcntl
+import glob
+import json
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import time
+
+from luamb._ccache import find_executable
+from luamb._exceptions import LuambException
+
+
+SCHEDULER_DIR_NAME = 'scheduler'
+
+DEFAULT_POLL_INTERVAL = 0.2
+
+IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+
+def parse_ionice(value):
+    """Convert CLASS[:LEVEL] (e.g., idle, best-effort:7) to ionice args"""
+    if not value:
+        return None
+    io_class, _, level = value.strip().partition(':')
+    if io_class not in IONICE_CLASSES:
+        raise LuambException(
+            "invalid I/O priority class '{}', expected one of: {}".format(
+                io_class, ', '.join(sorted(IONICE_CLASSES))))
+    args = ['-c', IONICE_CLASSES[io_class]]
+    if level:
+        if not level.isdigit() or int(level) > 7:
+            raise LuambException(
+                "invalid I/O priority level '{}', expected 0-7".format(level))
+        args.extend(['-n', level])
+    return args
+
+
+def _lock(f, shared=False, blocking=True):
+    """flock() the file, return success
+
+    flock locks belong to the open file and are released by the kernel
+    when the process dies, so a crashed build never holds a slot.
+    """
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), flags)
+    except (IOError, OSError) as exc:
+        if exc.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        raise
+    return True
+
+
+def _is_held(path):
+    """Return True if the file is locked by a live process"""
+    try:
+        with open(path) as f:
+            return not _lock(f, shared=True, blocking=False)
+    except (IOError, OSError):
+        return False
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+class BuildSlot(object):
+
+    def __init__(self, index, make_jobs, command_prefix=()):
+        self.index = index
+        self.make_jobs = make_jobs
+        # nice/ionice command line to run build commands with
+        self.command_prefix = list(command_prefix)
+
+    def wrap_command(self, argv):
+        return self.command_prefix + list(argv)
+
+
+class CommandPrefixer(object):
+    """Stand-in for the subprocess module running commands with a prefix
+
+    Replaces the module in hererocks while a build runs, so that only
+    build commands get the slot's priority, not the calling process.
+    """
+
+    def __init__(self, slot):
+        self._slot = slot
+
+    def __getattr__(self, name):
+        return getattr(subprocess, name)
+
+    def call(self, args, **kwargs):
+        return subprocess.call(self._slot.wrap_command(args), **kwargs)
+
+    def check_call(self, args, **kwargs):
+        return subprocess.check_call(self._slot.wrap_command(args), **kwargs)
+
+    def check_output(self, args, **kwargs):
+        return subprocess.check_output(
+            self._slot.wrap_command(args), **kwargs)
+
+
+class BuildScheduler(object):
+    """Host-wide admission control for builds of all luamb processes
+
+    At most max_builds builds run at once, each holding an flock()ed
+    slot file. Waiting builds form a FIFO queue of ticket files, also
+    held with flock(), numbered by a counter; only the head of the
+    queue takes a free slot, so builds start in the order they arrived
+    regardless of polling timing. total_jobs compile jobs are split
+    evenly between slots (passed to make via MAKEFLAGS, PUC-Rio Lua is
+    compiled one file at a time anyway). nice and ionice apply to build
+    commands only (see BuildSlot.command_prefix), the calling process
+    keeps its priority.
+    """
+
+    def __init__(self, state_dir, max_builds, total_jobs=None, nice=0,
+                 ionice=None, on_wait=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        if max_builds < 1:
+            raise LuambException('maximum number of builds must be positive')
+        self.state_dir = state_dir
+        self.max_builds = max_builds
+        self.total_jobs = total_jobs or multiprocessing.cpu_count()
+        self.nice = nice
+        # list of ionice arguments, see parse_ionice()
+        self.ionice = ionice
+        # called with 1-based queue position whenever it changes
+        self.on_wait = on_wait
+        self.poll_interval = poll_interval
+
+    @property
+    def make_jobs(self):
+        return max(1, self.total_jobs // self.max_builds)
+
+    @property
+    def queue_dir(self):
+        return os.path.join(self.state_dir, 'queue')
+
+    def _slot_path(self, index):
+        return os.path.join(self.state_dir, 'slot-{}.lock'.format(index))
+
+    def _makedirs(self):
+        if not os.path.isdir(self.queue_dir):
+            try:
+                os.makedirs(self.queue_dir)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    @contextlib.contextmanager
+    def _next_ticket_number(self):
+        """Yield the next ticket number holding the counter lock"""
+        with open(os.path.join(self.state_dir, 'counter'), 'a+') as f:
+            _lock(f)
+            f.seek(0)
+            value = f.read().strip()
+            number = int(value) + 1 if value.isdigit() else 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(number))
+            f.flush()
+            yield number
+
+    def _enqueue(self, info):
+        """Create a locked ticket file, return (path, open file)"""
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.queue_dir)
+        f = os.fdopen(fd, 'w')
+        try:
+            _lock(f)
+            json.dump(info, f)
+            f.flush()
+            # renaming under the counter lock keeps tickets appearing in
+            # the order of their numbers
+            with self._next_ticket_number() as number:
+                path = os.path.join(
+                    self.queue_dir, '{:012d}.ticket'.format(number))
+                # the ticket appears already locked, so others never
+                # mistake it for a ticket of a dead process
+                os.rename(tmp_path, path)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+        return path, f
+
+    def _iter_live_tickets(self):
+        """Yield paths of tickets in queue order removing dead ones"""
+        for file_name in sorted(os.listdir(self.queue_dir)):
+            if not file_name.endswith('.ticket'):
+                continue
+            path = os.path.join(self.queue_dir, file_name)
+            if _is_held(path):
+                yield path
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _get_position(self, ticket_path):
+        position = 0
+        for path in self._iter_live_tickets():
+            if path >= ticket_path:
+                break
+            position += 1
+        return position
+
+    def _try_acquire_slot(self, info):
+        for index in range(self.max_builds):
+            f = open(self._slot_path(index), 'a+')
+            if not _lock(f, blocking=False):
+                f.close()
+                continue
+            f.seek(0)
+            f.truncate()
+            json.dump(info, f)
+            f.flush()
+            return index, f
+        return None
+
+    def _get_command_prefix(self):
+        """Return nice/ionice command line raising build priority
+
+        Commands are reniced to at least self.nice. Missing tools
+        (e.g., util-linux is not installed or not Linux) are skipped.
+        """
+        prefix = []
+        increment = self.nice - os.nice(0) if self.nice else 0
+        if increment > 0 and find_executable('nice'):
+            prefix.extend(['nice', '-n', str(increment)])
+        if self.ionice and find_executable('ionice'):
+            # -t: run the command even if the class needs privileges
+            prefix.extend(['ionice', '-t'] + self.ionice)
+        return prefix
+
+    @contextlib.contextmanager
+    def admit(self, env_name):
+        """Wait for a build slot, yield BuildSlot"""
+        self._makedirs()
+        info = {'pid': os.getpid(), 'env': env_name, 'since': time.time()}
+        ticket_path, ticket = self._enqueue(info)
+        try:
+            last_position = None
+            while True:
+                position = self._get_position(ticket_path)
+                if position == 0:
+                    info['since'] = time.time()
+                    acquired = self._try_acquire_slot(info)
+                    if acquired:
+                        break
+                if self.on_wait and position != last_position:
+                    self.on_wait(position + 1)
+                last_position = position
+                time.sleep(self.poll_interval)
+        finally:
+            os.remove(ticket_path)
+            ticket.close()
+        index, slot = acquired
+        try:
+            environ_backup = os.environ.get('MAKEFLAGS')
+            os.environ['MAKEFLAGS'] = '-j{}'.format(self.make_jobs)
+            try:
+                yield BuildSlot(
+                    index, self.make_jobs, self._get_command_prefix())
+            finally:
+                if environ_backup is None:
+                    os.environ.pop('MAKEFLAGS', None)
+                else:
+                    os.environ['MAKEFLAGS'] = environ_backup
+        finally:
+            slot.seek(0)
+            slot.truncate()
+            slot.close()
+
+
+def get_queue_status(state_dir):
+    """Return (running builds, waiting builds), lists of info dicts"""
+    running = []
+    waiting = []
+    for path in sorted(glob.glob(os.path.join(state_dir, 'slot-*.lock'))):
+        if _is_held(path):
+            running.append(_read_json(path))
+    queue_dir = os.path.join(state_dir, 'queue')
+    if os.path.isdir(queue_dir):
+        for file_name in sorted(os.listdir(queue_dir)):
+            path = os.path.join(queue_dir, file_name)
+            if file_name.endswith('.ticket') and _is_held(path):
+                waiting.append(_read_json(path))
+    return running, waiting
@@ -0,0 +1,127 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+from luamb._exceptions import LuambException
+
+
+DEFAULT_TMPFS_DIR = '/dev/shm'
+DEFAULT_MIN_FREE_BYTES = 256 * 1024 * 1024
+
+DISABLED_VALUES = ('', '0', 'off', 'false', 'no')
+ENABLED_VALUES = ('1', 'on', 'true', 'yes')
+
+
+def parse_tmpfs_setting(value):
+    """Convert LUAMB_TMPFS-like value to a directory path or None"""
+    if value is None:
+        return None
+    stripped = value.strip()
+    if stripped.lower() in DISABLED_VALUES:
+        return None
+    if stripped.lower() in ENABLED_VALUES:
+        return DEFAULT_TMPFS_DIR
+    return stripped
+
+
+def get_free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+
+class ScratchBuild(object):
+    """Build (and, for new environments, install) in RAM-backed storage
+
+    hererocks bakes the installation path into Lua and LuaRocks files,
+    so a new environment is installed through a symlink placed at its
+    final path and pointing to the scratch directory. After the build
+    the symlink is replaced with a copy of the tree made in one
+    sequential pass (to a staging directory on the target filesystem
+    which is then renamed).
+    """
+
+    def __init__(self, tmpfs_dir, env_path, staging_dir,
+                 min_free_bytes=DEFAULT_MIN_FREE_BYTES, timer=None):
+        self.tmpfs_dir = tmpfs_dir
+        self.env_path = env_path
+        self.staging_dir = staging_dir
+        self.min_free_bytes = min_free_bytes
+        self.timer = timer or PhaseTimer()
+        self.scratch_dir = None
+        self.install_in_scratch = not os.path.lexists(env_path)
+
+    def check(self):
+        if not os.path.isdir(self.tmpfs_dir):
+            raise LuambException(
+                "scratch directory '{}' doesn't exist".format(self.tmpfs_dir))
+        free = get_free_bytes(self.tmpfs_dir)
+        if free < self.min_free_bytes:
+            raise LuambException(
+                "not enough free space in '{}': {} MiB available, "
+                "{} MiB required".format(
+                    self.tmpfs_dir, free // 2 ** 20,
+                    self.min_free_bytes // 2 ** 20))
+
+    @contextlib.contextmanager
+    def activate(self):
+        with self.timer.phase('scratch setup'):
+            self.check()
+            self.scratch_dir = tempfile.mkdtemp(
+                prefix='luamb-', dir=self.tmpfs_dir)
+            build_tmp = os.path.join(self.scratch_dir, 'tmp')
+            os.mkdir(build_tmp)
+            if self.install_in_scratch:
+                scratch_env = os.path.join(self.scratch_dir, 'env')
+                os.mkdir(scratch_env)
+                os.symlink(scratch_env, self.env_path)
+            # hererocks creates its build directory with tempfile.mkdtemp()
+            saved_tempdir = tempfile.tempdir
+            tempfile.tempdir = build_tmp
+        succeeded = False
+        try:
+            with self.timer.phase('build'):
+                yield self
+            succeeded = True
+        finally:
+            tempfile.tempdir = saved_tempdir
+            if self.install_in_scratch:
+                os.remove(self.env_path)
+            if succeeded and self.install_in_scratch:
+                with self.timer.phase('copy to environment directory'):
+                    self._copy_out(scratch_env)
+            with self.timer.phase('scratch cleanup'):
+                shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    def _copy_out(self, scratch_env):
+        if not os.path.isdir(self.staging_dir):
+            os.makedirs(self.staging_dir)
+        staging_path = tempfile.mkdtemp(dir=self.staging_dir)
+        os.rmdir(staging_path)
+        try:
+            shutil.copytree(scratch_env, staging_path, symlinks=True)
+            os.rename(staging_path, self.env_path)
+        except (IOError, OSError, shutil.Error) as exc:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise LuambException(
+                "can't copy the environment from scratch space: {}".format(
+                    exc))
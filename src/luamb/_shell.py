@@ -16,6 +16,7 @@
 #   cat
 #   uname
 #   sed
+#   touch
 #   find (for completions)
 #
 # Exported variables
@@ -50,7 +51,8 @@ __luamb_is_active() {
 
 
 __luamb_check_env_name() {
-    if [ "${1}" = '.' ] || [ "${1}" = '..' ] || [ -z "${1##*/*}" ]; then
+    if [ "${1}" = '.' ] || [ "${1}" = '..' ] || [ "${1}" = '.luamb' ] || \
+            [ -z "${1##*/*}" ]; then
         echo "invalid env name: '${1}'"
         return 1
     fi
@@ -77,6 +79,9 @@ __luamb_on() {
         echo "environment doesn't exist: $env_name"
         return 1
     fi
+    if [ -f "$env_path/.archived" ]; then
+        __luamb_cmd restore "$env_name" || return 1
+    fi
     if __luamb_is_active; then
         __luamb_off
     fi
@@ -85,7 +90,14 @@ __luamb_on() {
     LUAMB_ACTIVE_ENV=$env_name
     # shellcheck disable=SC1090
     source "$env_path/bin/activate"
+    # used by 'luamb archive --idle-days'
+    touch "$env_path/.last-activated"
     __luamb_wrap_deactivate_function
+    # module index generated by 'luamb index'
+    if [ -f "$env_path/lib/luamb/index.lua" ] && [ -z "${LUA_INIT+x}" ]; then
+        export LUA_INIT="@$env_path/lib/luamb/index.lua"
+        __luamb_lua_init_set=1
+    fi
     if [ -f "$env_path/.project" ]; then
         # shellcheck disable=SC2164
         cd "$(cat "$env_path/.project")"
@@ -98,6 +110,9 @@ __luamb_off() {
     if __luamb_is_active; then
         __luamb_orig_deactivate
         unset -f deactivate-lua
+        if [ -n "$__luamb_lua_init_set" ]; then
+            unset LUA_INIT __luamb_lua_init_set
+        fi
         echo "environment deactivated: $LUAMB_ACTIVE_ENV"
         PS1=$__luamb_orig_ps1
         unset __luamb_orig_ps1
@@ -163,13 +178,32 @@ if [ "$LUAMB_DISABLE_COMPLETION" != "true" ]; then
                 COMPLETION_OPTS="on enable activate \
                                  off disable deactivate \
                                  mk new create \
+                                 upgrade up \
+                                 freeze lock \
+                                 sync \
+                                 log \
+                                 archive \
+                                 restore unarchive \
+                                 snapshot snap \
+                                 rollback \
+                                 rocks \
+                                 check \
+                                 stats \
+                                 queue \
+                                 index \
+                                 compile \
                                  rm remove del delete \
                                  info show \
                                  ls list"
                 ;;
-            on|enable|activate|rm|remove|del|delete|info|show)
+            rocks)
+                COMPLETION_OPTS="prefetch configure"
+                ;;
+            on|enable|activate|rm|remove|del|delete|info|show|\
+            upgrade|up|freeze|lock|sync|log|archive|restore|unarchive|\
+            snapshot|snap|rollback|check|index|compile|configure|-e|--env)
                 COMPLETION_OPTS=$(find "$LUAMB_DIR" -mindepth 1 -maxdepth 1 \
-                                  -type d -printf "%f ")
+                                  -type d ! -name .luamb -printf "%f ")
                 ;;
             *)
                 COMPLETION_OPTS=""
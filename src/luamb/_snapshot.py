@@ -0,0 +1,315 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import ctypes
+import errno
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from luamb._exceptions import LuambException
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    scandir = None
+
+
+SNAPSHOTS_DIR_NAME = 'snapshots'
+METADATA_SUFFIX = '.json'
+
+# ioctl cloning file extents (Btrfs, XFS, etc.), from linux/fs.h
+FICLONE = 0x40049409
+# errors meaning the filesystem can't clone files
+REFLINK_UNSUPPORTED_ERRNOS = (
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EPERM,
+    errno.ENOSYS,
+)
+
+# flags of renameat2(2)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+class Snapshot(object):
+
+    def __init__(self, tag, path, created_at, method, unique_size=None):
+        self.tag = tag
+        self.path = path
+        self.created_at = created_at
+        # 'reflink' or 'hardlink'
+        self.method = method
+        # bytes freed by deleting the snapshot, None if not computed
+        self.unique_size = unique_size
+
+    def __repr__(self):
+        return '<Snapshot {} {}>'.format(self.tag, self.method)
+
+
+def is_valid_tag(tag):
+    return bool(tag and not tag.startswith('.') and '/' not in tag)
+
+
+def make_tag():
+    return time.strftime('%Y%m%d-%H%M%S')
+
+
+def _is_mutable(relpath):
+    """Return True if tools rewrite the file in place
+
+    Such files are copied rather than linked: luamb metadata in the
+    environment root, LuaRocks configs and rocks tree manifests.
+    Everything else is replaced by creating a new file (LuaRocks deploys
+    rocks this way) or by luamb itself breaking links first.
+    """
+    parts = relpath.split(os.sep)
+    return (
+        len(parts) == 1
+        or parts[0] == 'etc'
+        or parts[-1].startswith('manifest')
+    )
+
+
+def _reflink(src, dst):
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except BaseException:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+
+
+def _iter_dir(path):
+    """Yield (name, is directory, is symlink) without stat() if possible"""
+    if scandir is None:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            is_link = os.path.islink(entry_path)
+            yield name, not is_link and os.path.isdir(entry_path), is_link
+        return
+    for entry in scandir(path):
+        is_link = entry.is_symlink()
+        yield entry.name, not is_link and entry.is_dir(), is_link
+
+
+def clone_tree(src, dst, method=None):
+    """Recreate src tree at dst sharing file data, return the method used
+
+    Files are cloned with reflinks if the filesystem supports them
+    (copy-on-write at the block level), hardlinked otherwise. Mutable
+    files (see _is_mutable()) are always copied. dst must not exist.
+    """
+    os.mkdir(dst)
+    shutil.copymode(src, dst)
+    # (relative path, source directory, target directory)
+    stack = [('', src, dst)]
+    while stack:
+        relpath, source_dir, target_dir = stack.pop()
+        for name, is_dir, is_link in _iter_dir(source_dir):
+            source = os.path.join(source_dir, name)
+            target = os.path.join(target_dir, name)
+            if is_link:
+                os.symlink(os.readlink(source), target)
+            elif is_dir:
+                os.mkdir(target)
+                shutil.copymode(source, target)
+                stack.append((os.path.join(relpath, name), source, target))
+            elif _is_mutable(os.path.join(relpath, name)):
+                shutil.copy2(source, target)
+            elif method == 'hardlink':
+                os.link(source, target)
+            else:
+                try:
+                    _reflink(source, target)
+                    method = 'reflink'
+                except (IOError, OSError) as exc:
+                    if (method == 'reflink'
+                            or exc.errno not in REFLINK_UNSUPPORTED_ERRNOS):
+                        raise
+                    method = 'hardlink'
+                    os.link(source, target)
+    return method or 'hardlink'
+
+
+def get_unique_size(path):
+    """Return disk usage of files not linked from outside the tree
+
+    Blocks shared with reflinks can't be detected, so the result is
+    an upper bound for reflink snapshots.
+    """
+    size = 0
+    # {(device, inode): [links outside the tree, size]}
+    inodes = {}
+    for dir_path, dir_names, file_names in os.walk(path):
+        size += os.lstat(dir_path).st_blocks * 512
+        for name in file_names:
+            st = os.lstat(os.path.join(dir_path, name))
+            key = (st.st_dev, st.st_ino)
+            if key not in inodes:
+                inodes[key] = [st.st_nlink, st.st_blocks * 512]
+            inodes[key][0] -= 1
+    return size + sum(
+        file_size for links, file_size in inodes.values() if links <= 0)
+
+
+def _get_paths(snapshots_dir, tag):
+    if not is_valid_tag(tag):
+        raise LuambException("invalid snapshot tag: '{}'".format(tag))
+    path = os.path.join(snapshots_dir, tag)
+    return path, path + METADATA_SUFFIX
+
+
+def _read_snapshot(snapshots_dir, tag):
+    path, metadata_path = _get_paths(snapshots_dir, tag)
+    try:
+        with open(metadata_path) as f:
+            dct = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not os.path.isdir(path):
+        return None
+    return Snapshot(tag, path, dct['created_at'], dct['method'])
+
+
+def get_snapshot(snapshots_dir, tag):
+    snapshot = _read_snapshot(snapshots_dir, tag)
+    if not snapshot:
+        raise LuambException("snapshot '{}' doesn't exist".format(tag))
+    return snapshot
+
+
+def list_snapshots(snapshots_dir, usage=False):
+    """Return snapshots sorted by creation time"""
+    try:
+        file_names = os.listdir(snapshots_dir)
+    except OSError:
+        return []
+    snapshots = []
+    for file_name in file_names:
+        if not file_name.endswith(METADATA_SUFFIX):
+            continue
+        snapshot = _read_snapshot(
+            snapshots_dir, file_name[:-len(METADATA_SUFFIX)])
+        if snapshot:
+            if usage:
+                snapshot.unique_size = get_unique_size(snapshot.path)
+            snapshots.append(snapshot)
+    snapshots.sort(key=lambda snapshot: (snapshot.created_at, snapshot.tag))
+    return snapshots
+
+
+def create_snapshot(snapshots_dir, env_path, tag):
+    path, metadata_path = _get_paths(snapshots_dir, tag)
+    if os.path.lexists(path):
+        raise LuambException("snapshot '{}' already exists".format(tag))
+    if not os.path.isdir(snapshots_dir):
+        os.makedirs(snapshots_dir)
+    tmp_path = tempfile.mkdtemp(prefix='.' + tag + '-', dir=snapshots_dir)
+    os.rmdir(tmp_path)
+    try:
+        method = clone_tree(os.path.realpath(env_path), tmp_path)
+        snapshot = Snapshot(tag, path, time.time(), method)
+        with open(metadata_path, 'w') as f:
+            json.dump(
+                {'created_at': snapshot.created_at, 'method': method}, f)
+        os.rename(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if os.path.exists(metadata_path) and not os.path.isdir(path):
+            os.remove(metadata_path)
+        raise
+    return snapshot
+
+
+def delete_snapshot(snapshots_dir, tag):
+    snapshot = get_snapshot(snapshots_dir, tag)
+    os.remove(snapshot.path + METADATA_SUFFIX)
+    shutil.rmtree(snapshot.path)
+
+
+def _encode_path(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
+
+
+def exchange(path1, path2):
+    """Swap two directories atomically if the platform allows
+
+    renameat2(RENAME_EXCHANGE) is used on Linux, two renames (leaving
+    a moment without path1) otherwise.
+    """
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (AttributeError, OSError):
+        renameat2 = None
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, _encode_path(path1), AT_FDCWD,
+                     _encode_path(path2), RENAME_EXCHANGE) == 0:
+            return
+        error = ctypes.get_errno()
+        if error not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(error, os.strerror(error), path1)
+    tmp_path = path2 + '.old'
+    os.rename(path1, tmp_path)
+    os.rename(path2, path1)
+    os.rename(tmp_path, path2)
+
+
+def rollback(snapshots_dir, env_path, tag, staging_dir):
+    """Replace the environment with a clone of the snapshot
+
+    The snapshot is kept and can be rolled back to again.
+    """
+    snapshot = get_snapshot(snapshots_dir, tag)
+    env_path = os.path.realpath(env_path)
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    new_path = tempfile.mkdtemp(prefix='rollback-', dir=staging_dir)
+    os.rmdir(new_path)
+    try:
+        clone_tree(
+            snapshot.path, new_path,
+            method='hardlink' if snapshot.method == 'hardlink' else None)
+        exchange(env_path, new_path)
+    finally:
+        # the old environment after the exchange
+        shutil.rmtree(new_path, ignore_errors=True)
+    return snapshot
+
+
+def break_links(path):
+    """Give files linked elsewhere (e.g., from snapshots) their own copy
+
+    Must be called before modifying files in place, e.g., by rebuilding
+    programs over the existing ones. Return the number of copied files.
+    """
+    count = 0
+    for dir_path, _, file_names in os.walk(path):
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            st = os.lstat(file_path)
+            if st.st_nlink < 2 or os.path.islink(file_path):
+                continue
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + name, dir=dir_path)
+            os.close(fd)
+            try:
+                shutil.copy2(file_path, tmp_path)
+                os.rename(tmp_path, file_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            count += 1
+    return count
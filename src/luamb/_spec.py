@@ -0,0 +1,128 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+import os
+
+
+SPEC_FILE_NAME = '.spec'
+HEREROCKS_MANIFEST_FILE_NAME = 'hererocks.manifest'
+
+# hererocks manifest keys of Lua interpreters
+MANIFEST_LUA_KEYS = (
+    ('lua', 'lua'),
+    ('LuaJIT', 'luajit'),
+    ('moonjit', 'moonjit'),
+    ('raptorjit', 'raptorjit'),
+)
+MANIFEST_LUAROCKS_KEY = 'luarocks'
+
+
+class EnvSpec(object):
+    """Arguments an environment was created with"""
+
+    def __init__(self, lua_type, lua_version, luarocks_version=None,
+                 hererocks_args=(), hererocks_version=None, profile=None):
+        self.lua_type = lua_type
+        self.lua_version = lua_version
+        self.luarocks_version = luarocks_version
+        # including arguments the build profile expanded into
+        self.hererocks_args = list(hererocks_args)
+        self.hererocks_version = hererocks_version
+        # build profile name
+        self.profile = profile
+
+    def to_dict(self):
+        return {
+            'lua_type': self.lua_type,
+            'lua_version': self.lua_version,
+            'luarocks_version': self.luarocks_version,
+            'hererocks_args': self.hererocks_args,
+            'hererocks_version': self.hererocks_version,
+            'profile': self.profile,
+        }
+
+    @classmethod
+    def from_dict(cls, dct):
+        return cls(
+            lua_type=dct['lua_type'],
+            lua_version=dct['lua_version'],
+            luarocks_version=dct.get('luarocks_version'),
+            hererocks_args=dct.get('hererocks_args') or (),
+            hererocks_version=dct.get('hererocks_version'),
+            profile=dct.get('profile'),
+        )
+
+    @classmethod
+    def from_hererocks_manifest(cls, manifest):
+        for key, lua_type in MANIFEST_LUA_KEYS:
+            if key in manifest:
+                lua_identifiers = manifest[key]
+                break
+        else:
+            return None
+        hererocks_args = []
+        if lua_identifiers.get('c flags'):
+            hererocks_args.extend(['--cflags', lua_identifiers['c flags']])
+        if lua_identifiers.get('compat', 'default') != 'default':
+            hererocks_args.extend(['--compat', lua_identifiers['compat']])
+        if lua_identifiers.get('readline') == 'false':
+            hererocks_args.append('--no-readline')
+        luarocks_identifiers = manifest.get(MANIFEST_LUAROCKS_KEY)
+        return cls(
+            lua_type=lua_type,
+            lua_version=_version_from_identifiers(lua_identifiers),
+            luarocks_version=_version_from_identifiers(luarocks_identifiers),
+            hererocks_args=hererocks_args,
+        )
+
+
+def _version_from_identifiers(identifiers):
+    if not identifiers:
+        return None
+    source = identifiers.get('source')
+    if source == 'release':
+        return identifiers.get('version')
+    if source == 'git':
+        return '{}@{}'.format(identifiers['repo'], identifiers['commit'])
+    # local sources, the path is not recorded by hererocks
+    return None
+
+
+def read_hererocks_manifest(env_path):
+    path = os.path.join(env_path, HEREROCKS_MANIFEST_FILE_NAME)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def get_lua_abi(manifest):
+    """Return (interpreter, major version) of the installed Lua or None
+
+    C modules have to be rebuilt when this pair changes.
+    """
+    for key, lua_type in MANIFEST_LUA_KEYS:
+        if key in manifest:
+            return lua_type, manifest[key].get('major version')
+    return None
+
+
+def read_env_spec(env_path):
+    """Read the recorded spec, fall back to hererocks manifest"""
+    path = os.path.join(env_path, SPEC_FILE_NAME)
+    try:
+        with open(path) as f:
+            return EnvSpec.from_dict(json.load(f))
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return EnvSpec.from_hererocks_manifest(read_hererocks_manifest(env_path))
+
+
+def write_env_spec(env_path, spec):
+    path = os.path.join(env_path, SPEC_FILE_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(spec.to_dict(), f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
@@ -0,0 +1,1354 @@
+# coding: utf-8
+"""Programmatic interface to luamb
+
+All functions return data instead of printing it and raise
+LuambException on errors. Environment directory (LUAMB_DIR) is passed
+explicitly, environment variables are not consulted.
+
+hererocks is executed in-process and relies on the process-wide state
+(current directory, sys.stdout), so builds are serialized within
+a process. Pass a process pool (any object with a map() method, e.g.,
+concurrent.futures.ProcessPoolExecutor or multiprocessing.Pool) as the
+executor of batch functions to build several environments in parallel.
+"""
+from __future__ import unicode_literals
+
+import contextlib
+import os
+import shutil
+import sys
+import threading
+import time
+from importlib import import_module
+
+from luamb._archive import (
+    ArchiveInfo, archive, get_last_used, is_archived, read_stub, restore,
+)
+from luamb._bincache import (
+    BinaryCache, fetch_or_build, get_artifact_key, get_backend,
+)
+from luamb._buildlog import BuildLog, follow_log, iter_log, redirect_output
+from luamb._bytecode import (
+    CompileResult, compile_modules, get_fresh_bytecode, get_strip_option,
+    is_compiled, remove_bytecode,
+)
+from luamb._catalog import (
+    CATALOG_FILE_NAME, QUERY_FIELDS, Catalog, parse_sort, parse_where, query,
+)
+from luamb._check import (
+    CHECK_CACHE_FILE_NAME, CheckCache, CheckResult, check_envs as _check_envs,
+)
+from luamb._ccache import (
+    DISABLED_VALUES as COMPILER_CACHE_DISABLED_VALUES, CompilerCache,
+    CompilerCacheError,
+)
+from luamb._exceptions import (
+    HererocksErrorExit, HererocksUncaughtException, LuambException,
+)
+from luamb._history import HISTORY_FILE_NAME, History
+from luamb._mirror import configure_env, prefetch
+from luamb._modindex import (
+    IndexBenchmark, ModuleIndex, benchmark as _benchmark, build_index,
+    get_index_path, install_luarocks_hook, remove_index, write_index,
+)
+from luamb._paths import (
+    PROJECT_FILE_NAME, get_state_path, is_valid_env_name, list_env_names,
+)
+from luamb._profiles import (
+    PROFILES_FILE_NAME, BuildProfile, check_no_cflags,
+    change_lua_type, get_profile as _get_profile, load_profiles,
+    verify_build,
+)
+from luamb._rocks import (
+    LockedRock, call_luarocks, freeze, get_rocks_tree, install_rocks,
+    iter_installed_rocks, plan_sync, read_lockfile,
+)
+from luamb._scheduler import (
+    SCHEDULER_DIR_NAME, BuildScheduler, CommandPrefixer, get_queue_status,
+    parse_ionice,
+)
+from luamb._scratch import PhaseTimer, ScratchBuild
+from luamb._snapshot import (
+    SNAPSHOTS_DIR_NAME, Snapshot, break_links, create_snapshot,
+    delete_snapshot, list_snapshots, make_tag, rollback,
+)
+from luamb._spec import (
+    MANIFEST_LUA_KEYS, MANIFEST_LUAROCKS_KEY, EnvSpec, get_lua_abi,
+    read_env_spec, read_hererocks_manifest, write_env_spec,
+)
+
+if sys.version_info[0] == 2:
+    from StringIO import StringIO
+else:
+    from io import StringIO
+
+
+__all__ = [
+    'LuambException',
+    'LUA_TYPES', 'PRODUCT_NAMES',
+    'Env', 'EnvSpec', 'ArchiveInfo', 'VersionList', 'BuildResult',
+    'SyncResult', 'BatchResult', 'CheckResult', 'BuildProfile',
+    'list_env_names', 'list_envs', 'iter_envs', 'get_env', 'get_envs',
+    'QUERY_FIELDS',
+    'get_supported_versions', 'list_versions', 'check_version',
+    'resolve_spec',
+    'create_env', 'create_envs', 'upgrade_env', 'remove_env', 'remove_envs',
+    'freeze_env', 'sync_env',
+    'archive_env', 'restore_env', 'find_idle_envs',
+    'get_history', 'check_envs',
+    'get_profiles_path', 'list_profiles', 'get_profile',
+    'get_rocks_mirror_path', 'configure_rocks', 'prefetch_rocks',
+    'get_build_scheduler', 'get_build_queue',
+    'ModuleIndex', 'IndexBenchmark', 'index_env', 'refresh_env_index',
+    'remove_env_index',
+    'benchmark_env_index',
+    'CompileResult', 'compile_env', 'remove_env_bytecode',
+    'Snapshot', 'snapshot_env', 'rollback_env', 'list_env_snapshots',
+    'delete_env_snapshot',
+    'get_build_log_path', 'read_build_log', 'follow_build_log',
+]
+
+
+LUA_TYPES = ('lua', 'luajit', 'moonjit', 'raptorjit')
+
+PRODUCT_CLI_ARGS = {
+    'lua': ('-l', '--lua'),
+    'luajit': ('-j', '--luajit'),
+    'moonjit': ('-m', '--moonjit'),
+    'raptorjit': ('--raptorjit',),
+    'luarocks': ('-r', '--luarocks'),
+}
+PRODUCT_HEREROCKS_CLASSES = {
+    'lua': 'RioLua',
+    'luajit': 'LuaJIT',
+    'moonjit': 'MoonJIT',
+    'raptorjit': 'RaptorJIT',
+    'luarocks': 'LuaRocks',
+}
+PRODUCT_NAMES = {
+    'lua': 'PUC-Rio Lua',
+    'luajit': 'LuaJIT',
+    'moonjit': 'moonjit',
+    'raptorjit': 'RaptorJIT',
+    'luarocks': 'LuaRocks',
+}
+
+
+class Env(object):
+
+    def __init__(self, name, path, project=None, spec=None, programs=(),
+                 active=False, archived=None):
+        self.name = name
+        self.path = path
+        self.project = project
+        self.spec = spec
+        # hererocks identifiers of installed programs, Lua goes first
+        self.programs = list(programs)
+        self.active = active
+        # ArchiveInfo if the environment is archived
+        self.archived = archived
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'path': self.path,
+            'project': self.project,
+            'spec': self.spec.to_dict() if self.spec else None,
+            'programs': self.programs,
+            'active': self.active,
+            'archived': self.archived.to_dict() if self.archived else None,
+        }
+
+    @classmethod
+    def from_dict(cls, dct):
+        return cls(
+            name=dct['name'],
+            path=dct['path'],
+            project=dct.get('project'),
+            spec=EnvSpec.from_dict(dct['spec']) if dct.get('spec') else None,
+            programs=dct.get('programs', ()),
+            active=dct.get('active', False),
+            archived=(
+                ArchiveInfo.from_dict(dct['archived'])
+                if dct.get('archived') else None),
+        )
+
+    def __repr__(self):
+        return '<Env {}>'.format(self.name)
+
+
+class VersionList(object):
+
+    def __init__(self, product_key, versions, aliases):
+        self.product_key = product_key
+        self.product_name = PRODUCT_NAMES[product_key]
+        self.versions = versions
+        self.aliases = aliases
+
+    @property
+    def latest(self):
+        return self.aliases.get('latest')
+
+    def to_dict(self):
+        return {
+            'product': self.product_key,
+            'versions': self.versions,
+            'aliases': self.aliases,
+        }
+
+
+class BuildResult(object):
+
+    def __init__(self, env, duration, compiler_cache_mode=None,
+                 compiler_cache_stats=None, log_path=None, output_tail=(),
+                 phases=None, installed_rocks=(), removed_rocks=(),
+                 binary_cache=None, binary_cache_status=None,
+                 binary_cache_error=None):
+        self.env = env
+        # seconds
+        self.duration = duration
+        self.compiler_cache_mode = compiler_cache_mode
+        self.compiler_cache_stats = compiler_cache_stats
+        # full hererocks output is in the log file, only the last lines
+        # are kept in memory
+        self.log_path = log_path
+        self.output_tail = list(output_tail)
+        # {phase name: seconds}
+        self.phases = phases or {}
+        # LockedRock lists of rocks reinstalled by an upgrade
+        self.installed_rocks = list(installed_rocks)
+        self.removed_rocks = list(removed_rocks)
+        # location of the binary cache, 'hit', 'miss' or 'uploaded',
+        # error message if the cache couldn't be used
+        self.binary_cache = binary_cache
+        self.binary_cache_status = binary_cache_status
+        self.binary_cache_error = binary_cache_error
+
+    def __repr__(self):
+        return '<BuildResult {} {:.1f}s>'.format(self.env.name, self.duration)
+
+
+class SyncResult(object):
+
+    def __init__(self, env, removed, installed, build=None,
+                 spec_mismatch=False):
+        self.env = env
+        # LockedRock lists
+        self.removed = removed
+        self.installed = installed
+        # BuildResult if the environment was created
+        self.build = build
+        self.spec_mismatch = spec_mismatch
+
+    @property
+    def changed(self):
+        return bool(self.removed or self.installed or self.build)
+
+
+class BatchResult(object):
+
+    def __init__(self, key, value=None, error=None):
+        self.key = key
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<BatchResult {} ok>'.format(self.key)
+        return '<BatchResult {} error: {}>'.format(self.key, self.error)
+
+
+# hererocks
+
+
+_hererocks_lock = threading.RLock()
+
+
+def _get_hererocks(hererocks=None):
+    if hererocks is not None:
+        return hererocks
+    try:
+        return import_module('hererocks')
+    except ImportError:
+        raise LuambException("'hererocks' is not installed")
+
+
+@contextlib.contextmanager
+def _maybe_capture_output(capture_output):
+    string_buffer = StringIO()
+    if capture_output:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = string_buffer
+    try:
+        yield string_buffer
+    finally:
+        if capture_output:
+            sys.stdout, sys.stderr = stdout, stderr
+        string_buffer.close()
+
+
+def call_hererocks(argv, capture_output=False, hererocks=None):
+    """Run hererocks, return its output if capture_output is True
+
+    Output is accumulated in memory, so capturing should be used only for
+    short outputs like --help. Builds are logged with _build().
+    """
+    hererocks = _get_hererocks(hererocks)
+    with _hererocks_lock, _maybe_capture_output(
+            capture_output) as output_buffer:
+        try:
+            hererocks.main(argv=argv)
+        except SystemExit as exc:
+            if exc.code:
+                raise HererocksErrorExit(exc)
+        except Exception as exc:
+            raise HererocksUncaughtException(exc)
+        if capture_output:
+            return output_buffer.getvalue()
+
+
+def _call_hererocks_logged(argv, build_log, quiet=False, hererocks=None):
+    """Run hererocks writing its output to the open build log"""
+    hererocks = _get_hererocks(hererocks)
+    with _hererocks_lock:
+        try:
+            with redirect_output(build_log, echo=not quiet):
+                hererocks.main(argv=argv)
+        except SystemExit as exc:
+            if exc.code:
+                # the last unterminated line goes to the tail
+                build_log.close()
+                raise HererocksErrorExit(
+                    exc, output_tail=build_log.tail, log_path=build_log.path)
+        except Exception as exc:
+            raise HererocksUncaughtException(exc)
+
+
+def get_compiler_cache(env_dir, mode):
+    mode = (mode or '').strip().lower()
+    if mode in COMPILER_CACHE_DISABLED_VALUES:
+        return None
+    if mode in ('1', 'on', 'true', 'yes'):
+        mode = 'auto'
+    try:
+        return CompilerCache(get_state_path(env_dir, 'compiler-cache'), mode)
+    except CompilerCacheError as exc:
+        raise LuambException(str(exc))
+
+
+def get_build_log_path(env_dir, env_name):
+    return get_state_path(env_dir, 'logs', env_name + '.log')
+
+
+@contextlib.contextmanager
+def _nullcontext(value=None):
+    yield value
+
+
+def get_build_scheduler(env_dir, max_builds, total_jobs=None, nice=0,
+                        ionice=None, on_wait=None):
+    """Return BuildScheduler shared by all luamb processes using env_dir
+
+    At most max_builds builds run at once, total_jobs (default: number
+    of CPUs) compile jobs are split between them. Builds wait in a FIFO
+    queue, on_wait is called with the 1-based queue position whenever
+    it changes. Commands of an admitted build are reniced to at least
+    nice and get I/O priority ionice (CLASS[:LEVEL], e.g., idle or
+    best-effort:7), the calling process keeps its priority.
+    """
+    return BuildScheduler(
+        get_state_path(env_dir, SCHEDULER_DIR_NAME), max_builds,
+        total_jobs=total_jobs, nice=nice, ionice=parse_ionice(ionice),
+        on_wait=on_wait)
+
+
+def get_build_queue(env_dir):
+    """Return (running builds, waiting builds) of all luamb processes
+
+    Builds are dicts with pid, env and since (timestamp) keys, waiting
+    builds are in queue order.
+    """
+    return get_queue_status(get_state_path(env_dir, SCHEDULER_DIR_NAME))
+
+
+@contextlib.contextmanager
+def _prefixed_commands(hererocks, slot):
+    """Run commands spawned by hererocks with the build slot's priority"""
+    original = getattr(hererocks, 'subprocess', None)
+    if slot is None or not slot.command_prefix or original is None:
+        yield
+        return
+    hererocks.subprocess = CommandPrefixer(slot)
+    try:
+        yield
+    finally:
+        hererocks.subprocess = original
+
+
+@contextlib.contextmanager
+def _open_build_log(env_dir, env_name, build_log=None, append=False):
+    """Open the build log of the environment rotating the previous one
+
+    An already open build_log shared by several phases of a command is
+    used as is and left open.
+    """
+    if build_log is not None:
+        yield build_log
+        return
+    build_log = BuildLog(get_build_log_path(env_dir, env_name))
+    build_log.open(append=append)
+    try:
+        yield build_log
+    finally:
+        build_log.close()
+
+
+@contextlib.contextmanager
+def _echo_output(build_log, quiet=False):
+    """Print what is written to the build log in the block unless quiet"""
+    if not quiet:
+        sys.stdout.flush()
+        build_log.echo_fd = 1
+    try:
+        yield build_log
+    finally:
+        build_log.echo_fd = None
+
+
+def _build(env_dir, env_name, hererocks_args, compiler_cache=None,
+           tmpfs=None, scheduler=None, quiet=False, build_log=None,
+           hererocks=None):
+    """Run hererocks logging its output
+
+    The build log is opened anew unless an open build_log is passed.
+    Return BuildResult without env, the caller is responsible for
+    setting it.
+    """
+    start = time.time()
+    cache = get_compiler_cache(env_dir, compiler_cache)
+    timer = PhaseTimer()
+    if tmpfs:
+        build_cm = ScratchBuild(
+            tmpfs_dir=tmpfs,
+            env_path=os.path.join(env_dir, env_name),
+            staging_dir=get_state_path(env_dir, 'tmp'),
+            timer=timer,
+        ).activate()
+    else:
+        build_cm = timer.phase('build')
+    hererocks = _get_hererocks(hererocks)
+    with _hererocks_lock, _open_build_log(
+            env_dir, env_name, build_log) as build_log:
+        queued_at = time.time()
+        with scheduler.admit(env_name) if scheduler else _nullcontext() \
+                as slot:
+            if scheduler:
+                timer.phases['queue'] = time.time() - queued_at
+            with build_cm, _prefixed_commands(hererocks, slot), \
+                    (cache.session() if cache else _nullcontext()) \
+                    as cache_stats:
+                _call_hererocks_logged(
+                    hererocks_args, build_log, quiet=quiet,
+                    hererocks=hererocks)
+    return BuildResult(
+        env=None,
+        duration=time.time() - start,
+        compiler_cache_mode=cache.mode if cache else None,
+        compiler_cache_stats=cache_stats,
+        log_path=build_log.path,
+        output_tail=build_log.tail,
+        phases=timer.phases,
+    )
+
+
+# versions
+
+
+def get_supported_versions(product_key, hererocks=None):
+    """Return {version or alias: version} dict, empty if not supported"""
+    hererocks = _get_hererocks(hererocks)
+    try:
+        cls = getattr(hererocks, PRODUCT_HEREROCKS_CLASSES[product_key])
+    except AttributeError:
+        return {}
+    versions = {v: v for v in cls.versions}
+    versions.update(cls.translations)
+    return versions
+
+
+def _get_supported_versions_or_raise(product_key, hererocks=None):
+    versions = get_supported_versions(product_key, hererocks=hererocks)
+    if not versions:
+        raise LuambException(
+            '{} is not supported\n'
+            'Try to upgrade hererocks'.format(PRODUCT_NAMES[product_key])
+        )
+    return versions
+
+
+def format_versions(versions):
+    return '  '.join(sorted(versions))
+
+
+def list_versions(product_key, hererocks=None):
+    if product_key not in PRODUCT_NAMES:
+        raise LuambException('Unknown product: {}'.format(product_key))
+    supported = _get_supported_versions_or_raise(product_key, hererocks)
+    hererocks_cls = getattr(
+        _get_hererocks(hererocks), PRODUCT_HEREROCKS_CLASSES[product_key])
+    versions = list(hererocks_cls.versions)
+    aliases = {k: v for k, v in supported.items() if k not in versions}
+    return VersionList(product_key, versions, aliases)
+
+
+def is_local_path_or_git_uri(version_string, skip_path_check=False):
+    if '@' in version_string:
+        return True
+    if (
+            not version_string.startswith('/')
+            and not version_string.startswith('./')
+            and not version_string.startswith('../')
+    ):
+        return False
+    if skip_path_check:
+        return True
+    if not os.path.exists(version_string):
+        raise LuambException(
+            "'{}' seems like local path "
+            "but doesn't exist".format(version_string)
+        )
+    if not os.path.isdir(version_string):
+        raise LuambException(
+            "'{}' is not a directory ".format(version_string)
+        )
+    return True
+
+
+def check_version(product_key, version, hererocks=None):
+    if product_key != 'luarocks' and product_key not in LUA_TYPES:
+        raise LuambException(
+            'Unsupported Lua interpreter: {}'.format(product_key)
+        )
+    product_name = PRODUCT_NAMES[product_key]
+    if not version:
+        raise LuambException(
+            '{} version is not specified'.format(product_name))
+    if is_local_path_or_git_uri(version):
+        return
+    supported_versions = _get_supported_versions_or_raise(
+        product_key, hererocks)
+    if version not in supported_versions:
+        raise LuambException(
+            'Unsupported {} version: {}\n'
+            'Supported versions are: {}'.format(
+                product_name,
+                version,
+                format_versions(supported_versions),
+            )
+        )
+
+
+# environments
+
+
+def _check_env_name(env_name):
+    if not is_valid_env_name(env_name):
+        raise LuambException("invalid env name: '{}'".format(env_name))
+
+
+def get_env_path(env_dir, env_name, raise_exc=True):
+    _check_env_name(env_name)
+    env_path = os.path.join(env_dir, env_name)
+    if os.path.isdir(env_path):
+        return env_path
+    if raise_exc:
+        raise LuambException("environment '{}' doesn't exist".format(
+                             env_name))
+
+
+def _read_project(env_path):
+    try:
+        with open(os.path.join(env_path, PROJECT_FILE_NAME)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _get_programs(manifest):
+    keys = [key for key, _ in MANIFEST_LUA_KEYS] + [MANIFEST_LUAROCKS_KEY]
+    return [manifest[key] for key in keys if key in manifest]
+
+
+def _get_live_env_path(env_dir, env_name, raise_exc=True):
+    """Like get_env_path() but restore the environment if it's archived"""
+    env_path = get_env_path(env_dir, env_name, raise_exc=raise_exc)
+    if env_path and is_archived(env_path):
+        restore(env_path, get_state_path(env_dir, 'tmp'))
+    return env_path
+
+
+def get_env(env_dir, env_name, active_env=None):
+    """Return Env, archived environments are described by stub metadata"""
+    env_path = get_env_path(env_dir, env_name)
+    archived = read_stub(env_path)
+    if archived:
+        return Env(
+            name=env_name,
+            path=env_path,
+            project=archived.project,
+            spec=EnvSpec.from_dict(archived.spec) if archived.spec else None,
+            programs=archived.programs,
+            active=env_name == active_env,
+            archived=archived,
+        )
+    return Env(
+        name=env_name,
+        path=env_path,
+        project=_read_project(env_path),
+        spec=read_env_spec(env_path),
+        programs=_get_programs(read_hererocks_manifest(env_path)),
+        active=env_name == active_env,
+    )
+
+
+def list_envs(env_dir, active_env=None):
+    return [
+        get_env(env_dir, env_name, active_env=active_env)
+        for env_name in list_env_names(env_dir)
+    ]
+
+
+def get_profiles_path(env_dir):
+    """Return the default path of the user build profiles file"""
+    return get_state_path(env_dir, PROFILES_FILE_NAME)
+
+
+def list_profiles(profiles_path=None):
+    """Return {name: BuildProfile}, built-in and from profiles_path"""
+    return load_profiles(profiles_path)
+
+
+def get_profile(name, profiles_path=None):
+    return _get_profile(name, profiles_path)
+
+
+def iter_envs(env_dir, where=None, sort=None, limit=None, active_env=None,
+              refresh=False):
+    """Yield Env objects matching the query from the environment catalog
+
+    where is a FIELD=PATTERN[,FIELD=PATTERN...] string (or a list of
+    such strings, all conditions must match), fields are QUERY_FIELDS,
+    patterns are shell-style wildcards. sort is a field name optionally
+    prefixed with '-' for descending order. The catalog is kept in
+    LUAMB_DIR/.luamb and updated incrementally: only environments whose
+    directory has changed are read. refresh=True rebuilds it.
+    """
+    conditions = []
+    if where:
+        for text in where if isinstance(where, (list, tuple)) else [where]:
+            conditions.extend(parse_where(text))
+    sort = parse_sort(sort) if sort else None
+    catalog = Catalog(
+        env_dir, get_state_path(env_dir, CATALOG_FILE_NAME),
+        load_entry=lambda env_name: get_env(env_dir, env_name).to_dict(),
+    ).refresh(full=refresh)
+    catalog.save()
+    for entry in query(catalog, conditions, sort=sort, limit=limit):
+        env = Env.from_dict(entry)
+        env.active = env.name == active_env
+        yield env
+
+
+def create_env(env_dir, env_name, lua_type, lua_version,
+               luarocks_version=None, hererocks_args=(), project=None,
+               profile=None, compiler_cache=None, tmpfs=None,
+               rocks_upstream=None, binary_cache=None, upload_binary=False,
+               scheduler=None, quiet=False, hererocks=None):
+    """Create an environment, return BuildResult
+
+    lua_type is one of LUA_TYPES, versions are hererocks version
+    specifiers, hererocks_args are passed to hererocks as is.
+    profile is a BuildProfile (see get_profile()), its arguments are
+    added to hererocks_args and the interpreter is verified after
+    the build. hererocks output is written to the build log (see
+    get_build_log_path) and, unless quiet is True, to stdout. If tmpfs
+    is a directory path (e.g., /dev/shm), the build and the installation
+    are done there. LuaRocks is configured to use the shared rocks cache
+    and mirror falling back to rocks_upstream (see configure_rocks()).
+    binary_cache is a directory or an HTTP(S) URL of prebuilt
+    environments: a matching artifact is downloaded instead of building,
+    a locally built environment is uploaded if upload_binary is True
+    (see BuildResult.binary_cache_status). scheduler is BuildScheduler
+    limiting concurrent builds (see get_build_scheduler()).
+    """
+    _check_env_name(env_name)
+    hererocks_args = list(hererocks_args)
+    if profile:
+        check_no_cflags(hererocks_args)
+        hererocks_args = profile.get_hererocks_args(lua_type) + hererocks_args
+    spec = EnvSpec(
+        lua_type=lua_type,
+        lua_version=lua_version,
+        luarocks_version=luarocks_version,
+        hererocks_args=hererocks_args,
+        profile=profile.name if profile else None,
+    )
+    return _create_env_from_spec(
+        env_dir, env_name, spec, project=project, profile=profile,
+        compiler_cache=compiler_cache, tmpfs=tmpfs,
+        rocks_upstream=rocks_upstream, binary_cache=binary_cache,
+        upload_binary=upload_binary, scheduler=scheduler, quiet=quiet,
+        hererocks=hererocks)
+
+
+def resolve_spec(spec, hererocks=None):
+    """Return a copy of EnvSpec with version aliases resolved
+
+    '5.3' or 'latest' become the exact versions hererocks installs for
+    them. Local paths and git URIs are kept as is.
+    """
+    dct = spec.to_dict()
+    for field, product_key in [('lua_version', spec.lua_type),
+                               ('luarocks_version', 'luarocks')]:
+        version = dct[field]
+        if version and not is_local_path_or_git_uri(
+                version, skip_path_check=True):
+            dct[field] = get_supported_versions(
+                product_key, hererocks=hererocks).get(version, version)
+    return EnvSpec.from_dict(dct)
+
+
+def _get_artifact_key(spec, env_path, hererocks):
+    """Return binary cache key or None if the build is not reproducible"""
+    for version in [spec.lua_version, spec.luarocks_version]:
+        if version and is_local_path_or_git_uri(
+                version, skip_path_check=True):
+            return None
+    if any('=native' in arg for arg in spec.hererocks_args):
+        # -march=native and the like, tied to the build machine CPU
+        return None
+    resolved = resolve_spec(spec, hererocks=hererocks)
+    return get_artifact_key({
+        'lua_type': resolved.lua_type,
+        'lua_version': resolved.lua_version,
+        'luarocks_version': resolved.luarocks_version,
+        'hererocks_args': resolved.hererocks_args,
+    }, env_path)
+
+
+def _create_env_from_spec(env_dir, env_name, spec, project=None,
+                          profile=None, compiler_cache=None, tmpfs=None,
+                          rocks_upstream=None, binary_cache=None,
+                          upload_binary=False, scheduler=None, quiet=False,
+                          hererocks=None):
+    _check_env_name(env_name)
+    hererocks = _get_hererocks(hererocks)
+    check_version(spec.lua_type, spec.lua_version, hererocks=hererocks)
+    if spec.luarocks_version is not None:
+        check_version('luarocks', spec.luarocks_version, hererocks=hererocks)
+    env_path = os.path.join(env_dir, env_name)
+    argv = [PRODUCT_CLI_ARGS[spec.lua_type][-1], spec.lua_version]
+    if spec.luarocks_version:
+        argv.extend(
+            [PRODUCT_CLI_ARGS['luarocks'][-1], spec.luarocks_version])
+    argv.extend(spec.hererocks_args)
+    argv.append(env_path)
+
+    def verify(result):
+        if profile:
+            start = time.time()
+            verify_build(env_path, profile)
+            result.phases['verification'] = time.time() - start
+            result.duration += result.phases['verification']
+
+    def build():
+        result = _build(
+            env_dir, env_name, argv, compiler_cache=compiler_cache,
+            tmpfs=tmpfs, scheduler=scheduler, quiet=quiet,
+            hererocks=hererocks)
+        spec.hererocks_version = hererocks.hererocks_version
+        write_env_spec(env_path, spec)
+        # a build failing verification is not uploaded
+        verify(result)
+        return result
+
+    key = None
+    if binary_cache and not os.path.lexists(env_path):
+        key = _get_artifact_key(spec, env_path, hererocks)
+    if key:
+        cache = BinaryCache(get_backend(binary_cache), upload=upload_binary)
+        start = time.time()
+        timer = PhaseTimer()
+        status, result, error = fetch_or_build(
+            cache, key, env_path, get_state_path(env_dir, 'tmp'), build,
+            timer)
+        if result is None:
+            result = BuildResult(env=None, duration=0)
+            verify(result)
+        result.phases.update(timer.phases)
+        result.duration = time.time() - start
+        result.binary_cache = str(cache)
+        result.binary_cache_status = status
+        result.binary_cache_error = str(error) if error else None
+    else:
+        result = build()
+    _configure_rocks(env_dir, env_path, rocks_upstream)
+    if project:
+        with open(os.path.join(env_path, PROJECT_FILE_NAME), 'w') as f:
+            f.write(os.path.abspath(os.path.expandvars(project)))
+    result.env = get_env(env_dir, env_name)
+    return result
+
+
+def upgrade_env(env_dir, env_name, lua_type=None, lua_version=None,
+                luarocks_version=None, compiler_cache=None, tmpfs=None,
+                rocks_upstream=None, scheduler=None, quiet=False,
+                profiles_path=None, hererocks=None):
+    """Rebuild only the specified components of an existing environment
+
+    Other hererocks arguments are taken from the environment creation
+    spec. If the environment was built with a profile and lua_type
+    changes, the profile is looked up in profiles_path and expanded
+    anew for the new interpreter. Rocks are reinstalled only if the Lua
+    ABI (interpreter or its major version) has changed: rocks with
+    C modules if only the interpreter has changed, all rocks if
+    the major version has changed (LuaRocks uses a separate rocks tree
+    per major version). luarocks output is appended to the build log
+    and, unless quiet is True, printed to stdout; the reinstalled rocks
+    are listed in BuildResult.installed_rocks and removed_rocks.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    hererocks = _get_hererocks(hererocks)
+    spec = read_env_spec(env_path)
+    if not spec:
+        raise LuambException(
+            "can't determine how environment '{}' was created".format(
+                env_name))
+    if lua_type is None and luarocks_version is None:
+        raise LuambException('specify a new Lua or LuaRocks version')
+    if lua_type is not None:
+        check_version(lua_type, lua_version, hererocks=hererocks)
+    if lua_type is not None and lua_type != spec.lua_type and spec.profile:
+        spec.hererocks_args = change_lua_type(
+            get_profile(spec.profile, profiles_path), spec.hererocks_args,
+            lua_type)
+    if luarocks_version is not None:
+        check_version('luarocks', luarocks_version, hererocks=hererocks)
+
+    old_abi = get_lua_abi(read_hererocks_manifest(env_path))
+    old_rocks_tree = get_rocks_tree(
+        env_path, old_abi[1] if old_abi else None)
+    rocks = list(iter_installed_rocks(old_rocks_tree))
+    # hererocks overwrites programs in place
+    break_links(env_path)
+
+    start = time.time()
+    # all phases write to the same log rotated once
+    with _open_build_log(env_dir, env_name) as build_log:
+        results = []
+        build_kwargs = dict(
+            compiler_cache=compiler_cache, tmpfs=tmpfs, scheduler=scheduler,
+            quiet=quiet, build_log=build_log, hererocks=hererocks)
+        new_abi = old_abi
+        if lua_type is not None:
+            results.append(_build(
+                env_dir, env_name,
+                [PRODUCT_CLI_ARGS[lua_type][-1], lua_version]
+                + spec.hererocks_args + [env_path],
+                **build_kwargs))
+            spec.lua_type, spec.lua_version = lua_type, lua_version
+            new_abi = get_lua_abi(read_hererocks_manifest(env_path))
+
+        major_version_changed = bool(
+            old_abi and new_abi and old_abi[1] != new_abi[1])
+        if luarocks_version is None and major_version_changed:
+            # LuaRocks config is per Lua major version
+            luarocks_version = spec.luarocks_version
+        if luarocks_version is not None:
+            luarocks_args = [
+                PRODUCT_CLI_ARGS['luarocks'][-1], luarocks_version]
+            if major_version_changed:
+                luarocks_args.append('--ignore-installed')
+            results.append(_build(
+                env_dir, env_name,
+                luarocks_args + spec.hererocks_args + [env_path],
+                **build_kwargs))
+            spec.luarocks_version = luarocks_version
+            _configure_rocks(env_dir, env_path, rocks_upstream)
+
+        spec.hererocks_version = hererocks.hererocks_version
+        write_env_spec(env_path, spec)
+
+        to_reinstall = []
+        if rocks and old_abi != new_abi:
+            if major_version_changed:
+                to_reinstall = rocks
+            else:
+                to_reinstall = [
+                    rock for rock in rocks if rock.has_c_modules]
+        # the old rocks tree is left as is on a major version change
+        to_remove = [] if major_version_changed else to_reinstall
+        with _echo_output(build_log, quiet=quiet):
+            for rock in to_reinstall:
+                if not major_version_changed:
+                    call_luarocks(
+                        env_path, 'remove', '--force', rock.name,
+                        rock.version, build_log=build_log)
+                call_luarocks(
+                    env_path, 'install', '--deps-mode=none', rock.name,
+                    rock.version, build_log=build_log)
+
+    _refresh_index(env_path)
+
+    # the Lua build result is the most interesting one
+    result = results[0]
+    for other_result in results[1:]:
+        for phase, duration in other_result.phases.items():
+            result.phases[phase] = result.phases.get(phase, 0) + duration
+    result.env = get_env(env_dir, env_name)
+    result.duration = time.time() - start
+    result.output_tail = build_log.tail
+    result.installed_rocks = [
+        LockedRock(r.name, r.version, r.has_c_modules) for r in to_reinstall]
+    result.removed_rocks = [
+        LockedRock(r.name, r.version, r.has_c_modules) for r in to_remove]
+    return result
+
+
+def remove_env(env_dir, env_name, active_env=None):
+    if env_name == active_env:
+        raise LuambException('cannot remove the active environment')
+    env_path = get_env_path(env_dir, env_name)
+    try:
+        shutil.rmtree(env_path)
+    except OSError:
+        raise LuambException("can't delete {}".format(env_path))
+    shutil.rmtree(_get_snapshots_dir(env_dir, env_name), ignore_errors=True)
+    log_path = get_build_log_path(env_dir, env_name)
+    log_dir, log_name = os.path.split(log_path)
+    if os.path.isdir(log_dir):
+        for file_name in os.listdir(log_dir):
+            if file_name == log_name or file_name.startswith(log_name + '.'):
+                os.remove(os.path.join(log_dir, file_name))
+
+
+def freeze_env(env_dir, env_name):
+    """Return lockfile data (JSON-serializable dict)"""
+    env_path = _get_live_env_path(env_dir, env_name)
+    return freeze(read_env_spec(env_path), get_rocks_tree(env_path))
+
+
+def sync_env(env_dir, env_name, lockfile, jobs=None, compiler_cache=None,
+             tmpfs=None, rocks_upstream=None, binary_cache=None,
+             upload_binary=False, scheduler=None, quiet=False,
+             hererocks=None):
+    """Make the environment match the lockfile, return SyncResult
+
+    The environment is created from the lockfile spec if it doesn't exist
+    (see create_env() for the build arguments).
+    Installed rocks are read from the rocks tree directly, so a no-op
+    sync doesn't run luarocks at all. luarocks output is appended to
+    the build log and, unless quiet is True, printed to stdout.
+    """
+    locked_spec, locked_rocks = read_lockfile(lockfile)
+    env_path = _get_live_env_path(env_dir, env_name, raise_exc=False)
+    build = None
+    spec_mismatch = False
+    if env_path:
+        spec = read_env_spec(env_path)
+        spec_mismatch = bool(locked_spec and spec and (
+            (spec.lua_type, spec.lua_version, spec.luarocks_version)
+            != (locked_spec['lua_type'], locked_spec['lua_version'],
+                locked_spec.get('luarocks_version'))
+        ))
+    else:
+        if not locked_spec or not locked_spec.get('lua_version'):
+            raise LuambException(
+                "environment '{}' doesn't exist and the lockfile "
+                "has no spec to create it".format(env_name))
+        # profile arguments are already expanded in the locked spec
+        build = _create_env_from_spec(
+            env_dir, env_name, EnvSpec.from_dict(locked_spec),
+            compiler_cache=compiler_cache,
+            tmpfs=tmpfs,
+            rocks_upstream=rocks_upstream,
+            binary_cache=binary_cache,
+            upload_binary=upload_binary,
+            scheduler=scheduler,
+            quiet=quiet,
+            hererocks=hererocks,
+        )
+        env_path = build.env.path
+    rocks_tree = get_rocks_tree(env_path)
+    to_remove, to_install = plan_sync(
+        iter_installed_rocks(rocks_tree), locked_rocks)
+    if to_remove or to_install:
+        # luarocks overwrites installed files in place
+        break_links(env_path)
+        # appended to the output of the build if the env has been created
+        with _open_build_log(env_dir, env_name, append=True) as build_log, \
+                _echo_output(build_log, quiet=quiet):
+            for rock in to_remove:
+                call_luarocks(
+                    env_path, 'remove', '--force', rock.name, rock.version,
+                    build_log=build_log)
+            if to_install:
+                install_rocks(
+                    env_path, rocks_tree, to_install, jobs=jobs,
+                    build_log=build_log)
+        _refresh_index(env_path)
+    return SyncResult(
+        env=get_env(env_dir, env_name),
+        removed=[
+            LockedRock(r.name, r.version, r.has_c_modules) for r in to_remove],
+        installed=to_install,
+        build=build,
+        spec_mismatch=spec_mismatch,
+    )
+
+
+def archive_env(env_dir, env_name, active_env=None):
+    """Pack the environment into a compressed archive, return ArchiveInfo
+
+    The environment directory is replaced with a stub keeping the
+    information shown by list_envs(). The environment is restored
+    automatically on activation and by functions that need its files.
+    """
+    if env_name == active_env:
+        raise LuambException('cannot archive the active environment')
+    env = get_env(env_dir, env_name)
+    if env.archived:
+        raise LuambException(
+            "environment '{}' is already archived".format(env_name))
+    return archive(
+        env.path, get_state_path(env_dir, 'tmp'),
+        project=env.project,
+        spec=env.spec.to_dict() if env.spec else None,
+        programs=env.programs,
+    )
+
+
+def restore_env(env_dir, env_name):
+    """Unpack the archived environment, return Env"""
+    env_path = get_env_path(env_dir, env_name)
+    if not is_archived(env_path):
+        raise LuambException(
+            "environment '{}' is not archived".format(env_name))
+    restore(env_path, get_state_path(env_dir, 'tmp'))
+    return get_env(env_dir, env_name)
+
+
+def find_idle_envs(env_dir, idle_days, active_env=None):
+    """Return names of unarchived environments not activated for idle_days
+
+    Environments that have never been activated are considered used
+    at the time of their creation.
+    """
+    threshold = time.time() - idle_days * 24 * 60 * 60
+    env_names = []
+    for env_name in list_env_names(env_dir):
+        env_path = os.path.join(env_dir, env_name)
+        if env_name == active_env or is_archived(env_path):
+            continue
+        if get_last_used(env_path) < threshold:
+            env_names.append(env_name)
+    return env_names
+
+
+def check_envs(env_dir, env_names=None, jobs=None, use_cache=True):
+    """Check environments concurrently, return list of CheckResult
+
+    All environments are checked if env_names is None. Results of
+    the checks running programs are cached until the environment or
+    its binaries change. Archived environments are not restored and
+    not checked.
+    """
+    check_all = env_names is None
+    if check_all:
+        env_names = list_env_names(env_dir)
+    envs = [
+        (env_name, get_env_path(env_dir, env_name)) for env_name in env_names]
+    cache = None
+    if use_cache:
+        cache = CheckCache(
+            get_state_path(env_dir, CHECK_CACHE_FILE_NAME)).load()
+    results = _check_envs(envs, cache=cache, jobs=jobs)
+    if cache:
+        if check_all:
+            cache.prune(env_names)
+        cache.save()
+    return results
+
+
+def get_rocks_mirror_path(env_dir):
+    return get_state_path(env_dir, 'rocks', 'mirror')
+
+
+def _configure_rocks(env_dir, env_path, rocks_upstream=None):
+    return configure_env(
+        env_path,
+        mirror_dir=get_rocks_mirror_path(env_dir),
+        cache_dir=get_state_path(env_dir, 'rocks', 'cache'),
+        upstream=rocks_upstream,
+    )
+
+
+def configure_rocks(env_dir, env_name, rocks_upstream=None):
+    """Point LuaRocks of the environment at the shared cache and mirror
+
+    The shared mirror (see prefetch_rocks()) goes first in the list of
+    rocks servers, so mirrored rocks are installed without network
+    access, rocks_upstream (https://luarocks.org by default, a local
+    directory with a manifest works too) is used for everything else.
+    New environments are configured automatically, this function is
+    for environments created before. Return True if the config has
+    been changed.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    return _configure_rocks(env_dir, env_path, rocks_upstream)
+
+
+def prefetch_rocks(env_dir, env_name, rocks, rocks_upstream=None, jobs=None):
+    """Download rocks with dependencies into the shared mirror
+
+    rocks is a list of (name, version or None), luarocks and lua of
+    the environment env_name are used to download rocks and read their
+    rockspecs. Return names of files added to the mirror.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    return prefetch(
+        env_path,
+        mirror_dir=get_rocks_mirror_path(env_dir),
+        staging_dir=get_state_path(env_dir, 'tmp'),
+        rocks=rocks,
+        upstream=rocks_upstream,
+        jobs=jobs,
+    )
+
+
+def index_env(env_dir, env_name):
+    """Generate module index of the environment, return ModuleIndex
+
+    The index maps module names to files found via the default
+    package.path/package.cpath of the interpreter. It is loaded with
+    LUA_INIT (set by the shell function on activation) and installs
+    a searcher in front of the default ones. bin/luarocks is replaced
+    with a hook refreshing the index when rocks change (see
+    refresh_env_index()), luamb refreshes it after installing or
+    removing rocks itself.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    index = _build_index(env_path)
+    _write_index(env_path, index)
+    return index
+
+
+def refresh_env_index(env_dir, env_name):
+    """Regenerate the index and bytecode if the environment is indexed
+
+    Return False if there is no index.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    if not os.path.isfile(get_index_path(env_path)):
+        return False
+    _refresh_index(env_path)
+    return True
+
+
+def remove_env_index(env_dir, env_name):
+    """Remove module index, return False if there was none"""
+    return remove_index(_get_live_env_path(env_dir, env_name))
+
+
+def benchmark_env_index(env_dir, env_name, modules=None, repeat=5):
+    """Measure require() of modules without and with the index
+
+    All indexed modules are required by default. If the environment is
+    compiled, the index is measured without and with bytecode too.
+    Return IndexBenchmark.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    index = _build_index(env_path)
+    return _benchmark(
+        env_path, index, names=modules, repeat=repeat,
+        bytecode=bool(index.bytecode))
+
+
+def compile_env(env_dir, env_name, jobs=None, strip=False):
+    """Precompile Lua modules of the environment, return CompileResult
+
+    Modules found via the default package.path are compiled to bytecode
+    concurrently (jobs processes, the number of CPUs by default), and
+    the module index is written to load bytecode instead of sources.
+    Sources and the interpreter are checked for changes, so only stale
+    bytecode is recompiled; luamb recompiles it after 'sync' and
+    'upgrade'. The index falls back to the source if it differs from
+    the copy stored with the bytecode.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    result = _compile(env_path, build_index(env_path), jobs=jobs, strip=strip)
+    _write_index(env_path, _build_index(env_path))
+    return result
+
+
+def remove_env_bytecode(env_dir, env_name):
+    """Remove bytecode, return False if there was none"""
+    env_path = _get_live_env_path(env_dir, env_name)
+    if not remove_bytecode(env_path):
+        return False
+    _refresh_index(env_path)
+    return True
+
+
+def _build_index(env_path):
+    index = build_index(env_path)
+    index.bytecode = get_fresh_bytecode(env_path)
+    return index
+
+
+def _compile(env_path, index, jobs=None, strip=False):
+    source_paths = [
+        path for path, _ in index.lua_modules.values()
+        if path.endswith('.lua')]
+    return compile_modules(env_path, source_paths, jobs=jobs, strip=strip)
+
+
+def _write_index(env_path, index):
+    write_index(env_path, index)
+    env_dir, env_name = os.path.split(env_path)
+    install_luarocks_hook(env_path, index, [
+        'env', 'LUAMB_DIR=' + env_dir, sys.executable, '-m', 'luamb',
+        'index', '--refresh', env_name,
+    ])
+
+
+def _refresh_index(env_path):
+    if is_compiled(env_path):
+        _compile(
+            env_path, build_index(env_path),
+            strip=get_strip_option(env_path))
+    if os.path.isfile(get_index_path(env_path)):
+        _write_index(env_path, _build_index(env_path))
+
+
+def _get_snapshots_dir(env_dir, env_name):
+    return get_state_path(env_dir, SNAPSHOTS_DIR_NAME, env_name)
+
+
+def snapshot_env(env_dir, env_name, tag=None):
+    """Save a copy-on-write snapshot of the environment, return Snapshot
+
+    Files are reflinked if the filesystem supports it and hardlinked
+    otherwise; files rewritten in place by LuaRocks (configs, manifests)
+    and the environment's root files are copied. luamb gives hardlinked
+    files their own copies before rebuilding programs over them. The tag
+    defaults to the current time.
+    """
+    env_path = _get_live_env_path(env_dir, env_name)
+    return create_snapshot(
+        _get_snapshots_dir(env_dir, env_name), env_path, tag or make_tag())
+
+
+def rollback_env(env_dir, env_name, tag):
+    """Replace the environment with the snapshot, return Snapshot
+
+    The snapshot is cloned and swapped with the environment directory
+    atomically (renameat2 on Linux), the snapshot itself is kept.
+    """
+    env_path = get_env_path(env_dir, env_name)
+    return rollback(
+        _get_snapshots_dir(env_dir, env_name), env_path, tag,
+        get_state_path(env_dir, 'tmp'))
+
+
+def list_env_snapshots(env_dir, env_name, usage=False):
+    """Return snapshots of the environment sorted by creation time
+
+    With usage, Snapshot.unique_size is the disk space freed by deleting
+    the snapshot (an upper bound for reflink snapshots).
+    """
+    return list_snapshots(_get_snapshots_dir(env_dir, env_name), usage=usage)
+
+
+def delete_env_snapshot(env_dir, env_name, tag):
+    delete_snapshot(_get_snapshots_dir(env_dir, env_name), tag)
+
+
+def get_history(env_dir):
+    """Return History of commands run by the luamb CLI"""
+    return History(get_state_path(env_dir, HISTORY_FILE_NAME))
+
+
+def _get_existing_build_log_path(env_dir, env_name):
+    _check_env_name(env_name)
+    log_path = get_build_log_path(env_dir, env_name)
+    if not os.path.isfile(log_path):
+        raise LuambException(
+            "no build log for environment '{}'".format(env_name))
+    return log_path
+
+
+def read_build_log(env_dir, env_name, lines=None):
+    """Yield the latest build log in chunks (or only the last lines)"""
+    return iter_log(
+        _get_existing_build_log_path(env_dir, env_name), lines=lines)
+
+
+def follow_build_log(env_dir, env_name, poll_interval=0.5):
+    """Yield new build log contents as they appear, never returns"""
+    _check_env_name(env_name)
+    return follow_log(
+        get_build_log_path(env_dir, env_name), poll_interval=poll_interval)
+
+
+# batch calls
+
+
+def _call_batch_item(item):
+    func, key, args, kwargs = item
+    try:
+        return BatchResult(key, value=func(*args, **kwargs))
+    except LuambException as exc:
+        # subclasses may be not picklable, and process pool executors
+        # pickle results
+        return BatchResult(key, error=LuambException(str(exc)))
+
+
+def _run_batch(items, executor=None):
+    if executor is None:
+        return [_call_batch_item(item) for item in items]
+    return list(executor.map(_call_batch_item, items))
+
+
+def get_envs(env_dir, env_names, active_env=None, executor=None):
+    """Return list of BatchResult with Env values"""
+    return _run_batch([
+        (get_env, env_name, (env_dir, env_name), {'active_env': active_env})
+        for env_name in env_names
+    ], executor=executor)
+
+
+def create_envs(env_dir, requests, executor=None, **common_kwargs):
+    """Create several environments, return list of BatchResult
+
+    requests is an iterable of dicts with create_env() keyword arguments
+    (env_name, lua_type, lua_version, etc.), common_kwargs are added to
+    each request.
+    """
+    items = []
+    for request in requests:
+        kwargs = dict(common_kwargs, **request)
+        env_name = kwargs.pop('env_name')
+        items.append((create_env, env_name, (env_dir, env_name), kwargs))
+    return _run_batch(items, executor=executor)
+
+
+def remove_envs(env_dir, env_names, active_env=None, executor=None):
+    return _run_batch([
+        (remove_env, env_name, (env_dir, env_name), {'active_env': active_env})
+        for env_name in env_names
+    ], executor=executor)
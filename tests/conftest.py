@@ -0,0 +1,99 @@
+import json
+import os
+import re
+import subprocess
+
+import pytest
+
+from luamb._ccache import find_executable
+
+
+def find_interpreters():
+    """Return paths of real Lua interpreters to run Lua code with
+
+    TEST_LUA is a PATH-like list of interpreters, lua and luajit found
+    in PATH are used by default.
+    """
+    value = os.environ.get('TEST_LUA')
+    if value:
+        return [path for path in value.split(os.pathsep) if path]
+    return [path for path in map(find_executable, ('lua', 'luajit'))
+            if path]
+
+
+def pytest_generate_tests(metafunc):
+    if 'real_lua' not in metafunc.fixturenames:
+        return
+    params = find_interpreters() or [pytest.param(
+        None, marks=pytest.mark.skip('no Lua interpreter, set TEST_LUA'))]
+    metafunc.parametrize('real_lua', params, ids=str)
+
+
+class LuaEnv(object):
+    """Environment running a real interpreter with its own search paths"""
+
+    def __init__(self, env_dir, name, real_lua, relative_first=False):
+        self.env_dir = env_dir
+        self.name = name
+        self.path = os.path.join(env_dir, name)
+        version = subprocess.check_output(
+            [real_lua, '-v'], stderr=subprocess.STDOUT).decode('utf-8')
+        if 'LuaJIT' in version:
+            manifest = {'LuaJIT': {'name': 'LuaJIT', 'major version': '5.1'}}
+            major_version = '5.1'
+        else:
+            major_version = re.search(r'Lua (\d+\.\d+)', version).group(1)
+            manifest = {'lua': {'name': 'Lua',
+                                'major version': major_version}}
+        self.share = os.path.join(self.path, 'share', 'lua', major_version)
+        self.lib = os.path.join(self.path, 'lib', 'lua', major_version)
+        templates = [os.path.join(self.share, '?.lua'),
+                     os.path.join(self.share, '?', 'init.lua')]
+        if relative_first:
+            templates.insert(0, './?.lua')
+        else:
+            templates.append('./?.lua')
+        os.makedirs(os.path.join(self.path, 'bin'))
+        os.makedirs(self.share)
+        self.lua = os.path.join(self.path, 'bin', 'lua')
+        # the default search paths are compiled into the interpreter,
+        # the wrapper gives it paths inside the environment
+        with open(self.lua, 'w') as f:
+            f.write("#!/bin/sh\nLUA_PATH='{}' LUA_CPATH='{}' "
+                    "exec '{}' \"$@\"\n".format(
+                        # ';;' adds the defaults (e.g., jit.* modules)
+                        ';'.join(templates) + ';;',
+                        os.path.join(self.lib, '?.so'), real_lua))
+        os.chmod(self.lua, 0o755)
+        with open(os.path.join(self.path, 'hererocks.manifest'), 'w') as f:
+            json.dump(manifest, f)
+
+    def write_module(self, name, content):
+        path = os.path.join(self.share, *name.split('.')) + '.lua'
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def run(self, code, index_path=None, cwd=None):
+        environ = dict(
+            (key, value) for key, value in os.environ.items()
+            if not key.startswith('LUA_'))
+        if index_path:
+            environ['LUA_INIT'] = '@' + index_path
+        return subprocess.check_output(
+            [self.lua, '-e', code], env=environ, cwd=cwd,
+            stderr=subprocess.STDOUT).decode('utf-8')
+
+
+@pytest.fixture()
+def make_lua_env(tmp_path, real_lua):
+    env_dir = str(tmp_path / 'envs')
+    os.makedirs(env_dir)
+    return lambda **kwargs: LuaEnv(env_dir, 'app', real_lua, **kwargs)
+
+
+@pytest.fixture()
+def lua_env(make_lua_env):
+    return make_lua_env()
@@ -15,6 +15,7 @@ def test_shellsrc(script_runner):
     ('/foo', False),
     ('foo/', False),
     ('/', False),
+    ('.luamb', False),
     ('...', True),
     ('foo', True),
     ('foo bar', True),
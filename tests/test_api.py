@@ -0,0 +1,297 @@
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from luamb import api
+from luamb._rocks import LockedRock
+
+
+@pytest.fixture()
+def env_dir(tmp_path):
+    env_dir = tmp_path / 'luambenvs'
+    for env_name in ('foo', 'bar', '.luamb'):
+        (env_dir / env_name).mkdir(parents=True)
+    with open(str(env_dir / 'foo' / 'hererocks.manifest'), 'w') as f:
+        json.dump({
+            'lua': {'name': 'Lua', 'source': 'release', 'version': '5.3.6',
+                    'major version': '5.3'},
+            'version': 3,
+        }, f)
+    with open(str(env_dir / 'foo' / '.project'), 'w') as f:
+        f.write('/srv/foo\n')
+    return str(env_dir)
+
+
+def test_list_envs(env_dir):
+    envs = api.list_envs(env_dir, active_env='foo')
+    assert [(env.name, env.active) for env in envs] == [
+        ('bar', False), ('foo', True)]
+    bar, foo = envs
+    assert foo.project == '/srv/foo'
+    assert foo.spec.lua_type == 'lua'
+    assert foo.spec.lua_version == '5.3.6'
+    assert [p['name'] for p in foo.programs] == ['Lua']
+    assert bar.programs == []
+    assert bar.spec is None
+
+
+def test_get_envs_batch(env_dir):
+    results = api.get_envs(env_dir, ['foo', 'missing', '..'])
+    assert [r.ok for r in results] == [True, False, False]
+    assert results[0].value.path == os.path.join(env_dir, 'foo')
+    assert 'doesn\'t exist' in str(results[1].error)
+
+
+def test_remove_envs(env_dir):
+    results = api.remove_envs(env_dir, ['foo', 'bar'], active_env='bar')
+    assert [r.ok for r in results] == [True, False]
+    assert api.list_env_names(env_dir) == ['bar']
+
+
+# luarocks and luarocks-admin installed by FakeHererocks, rocks listed in
+# c_rocks get C modules
+FAKE_LUAROCKS = """#!/bin/sh
+rocks_tree='{rocks_tree}'
+c_rocks=' lpeg '
+case "$1" in
+help)
+    echo '--no-manifest';;
+install)
+    shift 2
+    [ "$1" = --no-manifest ] && shift
+    echo "installing $1 $2"
+    mkdir -p "$rocks_tree/$1/$2"
+    case "$c_rocks" in
+    *" $1 "*) printf 'rock_manifest = {{\\n   lib = {{}}\\n}}\\n';;
+    *) echo 'rock_manifest = {{}}';;
+    esac > "$rocks_tree/$1/$2/rock_manifest";;
+remove)
+    echo "removing $3 $4"
+    rm -r "$rocks_tree/$3/$4";;
+make_manifest)
+    echo 'manifest rebuilt';;
+esac
+"""
+
+
+class FakeHererocks(object):
+
+    hererocks_version = '0.0.0'
+
+    class RioLua(object):
+        versions = ['5.1.5', '5.3.6', '5.4.4']
+        translations = {'5.3': '5.3.6', 'latest': '5.4.4'}
+
+    class LuaJIT(object):
+        versions = ['2.1']
+        translations = {}
+
+    class LuaRocks(object):
+        versions = ['3.8.0']
+        translations = {'latest': '3.8.0'}
+
+    def __init__(self):
+        self.builds = []
+
+    def main(self, argv):
+        env_path = argv[-1]
+        self.builds.append(argv)
+        manifest_path = os.path.join(env_path, 'hererocks.manifest')
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        bin_dir = os.path.join(env_path, 'bin')
+        if not os.path.isdir(bin_dir):
+            os.makedirs(bin_dir)
+        for option, version in zip(argv[::2], argv[1::2]):
+            if option == '--lua':
+                version = self.RioLua.translations.get(version, version)
+                print('Building Lua {}'.format(version))
+                manifest.pop('LuaJIT', None)
+                manifest['lua'] = {
+                    'name': 'Lua', 'version': version,
+                    'major version': version[:3]}
+            elif option == '--luajit':
+                print('Building LuaJIT {}'.format(version))
+                manifest.pop('lua', None)
+                manifest['LuaJIT'] = {
+                    'name': 'LuaJIT', 'version': version,
+                    'major version': '5.1'}
+            elif option == '--luarocks':
+                print('Installing LuaRocks {}'.format(version))
+                manifest['luarocks'] = {
+                    'name': 'LuaRocks', 'version': version}
+        major_version = [
+            program['major version'] for program in manifest.values()
+            if 'major version' in program][0]
+        rocks_tree = os.path.join(
+            env_path, 'lib', 'luarocks', 'rocks-' + major_version)
+        if 'luarocks' in manifest:
+            if not os.path.isdir(rocks_tree):
+                os.makedirs(rocks_tree)
+                open(os.path.join(rocks_tree, 'manifest'), 'w').close()
+            for name in ('luarocks', 'luarocks-admin'):
+                path = os.path.join(bin_dir, name)
+                with open(path, 'w') as f:
+                    f.write(FAKE_LUAROCKS.format(rocks_tree=rocks_tree))
+                os.chmod(path, 0o755)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+
+@pytest.fixture()
+def new_env_dir(tmp_path):
+    env_dir = str(tmp_path / 'envs')
+    os.makedirs(env_dir)
+    return env_dir
+
+
+def read_build_log(env_dir, env_name):
+    return ''.join(api.read_build_log(env_dir, env_name))
+
+
+def test_create_env(new_env_dir, capfd):
+    hererocks = FakeHererocks()
+    result = api.create_env(
+        new_env_dir, 'app', 'lua', '5.3', luarocks_version='3.8.0',
+        compiler_cache='off', quiet=True, hererocks=hererocks)
+    assert hererocks.builds == [[
+        '--lua', '5.3', '--luarocks', '3.8.0',
+        os.path.join(new_env_dir, 'app')]]
+    env = result.env
+    assert env.name == 'app'
+    assert (env.spec.lua_type, env.spec.lua_version) == ('lua', '5.3')
+    assert env.spec.hererocks_version == '0.0.0'
+    assert [program['name'] for program in env.programs] == [
+        'Lua', 'LuaRocks']
+    assert result.output_tail == [
+        'Building Lua 5.3.6', 'Installing LuaRocks 3.8.0']
+    assert result.log_path == api.get_build_log_path(new_env_dir, 'app')
+    assert capfd.readouterr().out == ''
+
+    with pytest.raises(api.LuambException):
+        api.create_env(
+            new_env_dir, 'other', 'lua', '5.2', quiet=True,
+            hererocks=hererocks)
+
+
+def test_build_result_timings(new_env_dir):
+    result = api.create_env(
+        new_env_dir, 'app', 'lua', '5.3', compiler_cache='off', quiet=True,
+        hererocks=FakeHererocks())
+    assert list(result.phases) == ['build']
+    assert 0 <= result.phases['build'] <= result.duration
+    assert repr(result).startswith('<BuildResult app ')
+
+
+def write_lockfile(path, env_dir, rocks):
+    lock = api.freeze_env(env_dir, 'app')
+    lock['rocks'] = [rock.to_dict() for rock in rocks]
+    with open(path, 'w') as f:
+        json.dump(lock, f)
+
+
+def installed_rocks(env_dir):
+    return [
+        rock['name'] for rock in api.freeze_env(env_dir, 'app')['rocks']]
+
+
+def test_sync_and_upgrade_env(new_env_dir, tmp_path, capfd):
+    hererocks = FakeHererocks()
+    api.create_env(
+        new_env_dir, 'app', 'lua', '5.1.5', luarocks_version='3.8.0',
+        compiler_cache='off', quiet=True, hererocks=hererocks)
+    lockfile = str(tmp_path / 'luamb.lock')
+    rocks = [LockedRock('inspect', '3.1.3-0'), LockedRock('json', '1.0-1'),
+             LockedRock('lpeg', '1.0.2-1', True)]
+    write_lockfile(lockfile, new_env_dir, rocks)
+
+    result = api.sync_env(new_env_dir, 'app', lockfile, quiet=True)
+    assert result.changed and result.build is None
+    assert [rock.key for rock in result.installed] == [
+        rock.key for rock in rocks]
+    assert result.removed == []
+    assert installed_rocks(new_env_dir) == ['inspect', 'json', 'lpeg']
+    log = read_build_log(new_env_dir, 'app')
+    # appended to the output of the build
+    assert log.startswith('Building Lua 5.1.5\n')
+    for line in ['Installed inspect 3.1.3-0', 'installing lpeg 1.0.2-1',
+                 'manifest rebuilt']:
+        assert line in log
+    assert not api.sync_env(new_env_dir, 'app', lockfile).changed
+
+    write_lockfile(lockfile, new_env_dir, rocks[1:])
+    result = api.sync_env(new_env_dir, 'app', lockfile, quiet=True)
+    assert [rock.key for rock in result.removed] == [rocks[0].key]
+    assert result.installed == []
+    assert 'removing inspect 3.1.3-0' in read_build_log(new_env_dir, 'app')
+
+    # same Lua ABI major version, C rocks are rebuilt
+    result = api.upgrade_env(
+        new_env_dir, 'app', lua_type='luajit', lua_version='2.1',
+        compiler_cache='off', quiet=True, hererocks=hererocks)
+    assert [rock.name for rock in result.installed_rocks] == ['lpeg']
+    assert [rock.name for rock in result.removed_rocks] == ['lpeg']
+    assert result.env.spec.lua_type == 'luajit'
+
+    # new major version, all rocks are installed into a new rocks tree
+    result = api.upgrade_env(
+        new_env_dir, 'app', lua_type='lua', lua_version='5.4.4',
+        compiler_cache='off', quiet=True, hererocks=hererocks)
+    assert hererocks.builds[-1][:3] == [
+        '--luarocks', '3.8.0', '--ignore-installed']
+    assert [rock.name for rock in result.installed_rocks] == [
+        'json', 'lpeg']
+    assert result.removed_rocks == []
+    assert api.get_env(new_env_dir, 'app').spec.lua_version == '5.4.4'
+    assert installed_rocks(new_env_dir) == ['json', 'lpeg']
+    assert capfd.readouterr().out == ''
+
+
+def test_batch_with_executor(new_env_dir):
+    hererocks = FakeHererocks()
+    pool = ThreadPool(2)
+    try:
+        results = api.create_envs(new_env_dir, [
+            {'env_name': 'a', 'lua_type': 'lua', 'lua_version': '5.3'},
+            {'env_name': 'b', 'lua_type': 'luajit', 'lua_version': '2.1'},
+            {'env_name': 'c', 'lua_type': 'lua', 'lua_version': '5.0'},
+        ], executor=pool, compiler_cache='off', quiet=True,
+            hererocks=hererocks)
+        assert [(r.key, r.ok) for r in results] == [
+            ('a', True), ('b', True), ('c', False)]
+        assert results[1].value.env.spec.lua_type == 'luajit'
+        assert isinstance(results[2].error, api.LuambException)
+        assert len(hererocks.builds) == 2
+
+        results = api.get_envs(new_env_dir, ['a', 'c'], executor=pool)
+        assert [r.ok for r in results] == [True, False]
+        results = api.remove_envs(
+            new_env_dir, ['a', 'b'], active_env='b', executor=pool)
+        assert [r.ok for r in results] == [True, False]
+    finally:
+        pool.close()
+        pool.join()
+    assert api.list_env_names(new_env_dir) == ['b']
+
+
+def test_upgrade_writes_one_build_log(new_env_dir):
+    hererocks = FakeHererocks()
+    api.create_env(
+        new_env_dir, 'app', 'lua', '5.3', luarocks_version='3.8.0',
+        compiler_cache='off', quiet=True, hererocks=hererocks)
+    # new major version: Lua and LuaRocks are built one after another
+    result = api.upgrade_env(
+        new_env_dir, 'app', lua_type='lua', lua_version='5.4.4',
+        compiler_cache='off', quiet=True, hererocks=hererocks)
+    assert len(hererocks.builds) == 3
+    log_path = api.get_build_log_path(new_env_dir, 'app')
+    assert read_build_log(new_env_dir, 'app') == (
+        'Building Lua 5.4.4\nInstalling LuaRocks 3.8.0\n')
+    with open(log_path + '.1') as f:
+        assert f.read().startswith('Building Lua 5.3.6\n')
+    assert not os.path.exists(log_path + '.2')
+    assert result.output_tail[-1] == 'Installing LuaRocks 3.8.0'
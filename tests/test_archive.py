@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+import pytest
+
+from luamb import api
+from luamb._archive import LAST_ACTIVATED_FILE_NAME
+
+
+@pytest.fixture()
+def env_dir(tmp_path):
+    env_dir = tmp_path / 'luambenvs'
+    for env_name in ('foo', 'bar'):
+        (env_dir / env_name / 'bin').mkdir(parents=True)
+    foo = env_dir / 'foo'
+    with open(str(foo / 'hererocks.manifest'), 'w') as f:
+        json.dump({
+            'lua': {'name': 'Lua', 'source': 'release', 'version': '5.3.6',
+                    'major version': '5.3'},
+            'version': 3,
+        }, f)
+    with open(str(foo / 'bin' / 'lua'), 'w') as f:
+        f.write('#!/bin/sh\n')
+    os.chmod(str(foo / 'bin' / 'lua'), 0o755)
+    os.symlink('lua', str(foo / 'bin' / 'lua5.3'))
+    return str(env_dir)
+
+
+def test_archive_and_restore(env_dir):
+    info = api.archive_env(env_dir, 'foo')
+    foo_path = os.path.join(env_dir, 'foo')
+    assert sorted(os.listdir(foo_path)) == ['.archived', 'env.tar.gz']
+    assert info.size > 0
+
+    foo = api.get_env(env_dir, 'foo')
+    assert foo.archived.archived_at == info.archived_at
+    assert foo.spec.lua_version == '5.3.6'
+    assert [p['name'] for p in foo.programs] == ['Lua']
+
+    with pytest.raises(api.LuambException, match='already archived'):
+        api.archive_env(env_dir, 'foo')
+
+    foo = api.restore_env(env_dir, 'foo')
+    assert foo.archived is None
+    lua = os.path.join(foo_path, 'bin', 'lua')
+    assert os.access(lua, os.X_OK)
+    assert os.readlink(os.path.join(foo_path, 'bin', 'lua5.3')) == 'lua'
+    assert os.listdir(os.path.join(env_dir, '.luamb', 'tmp')) == []
+
+
+def test_archive_active_env(env_dir):
+    with pytest.raises(api.LuambException, match='active'):
+        api.archive_env(env_dir, 'foo', active_env='foo')
+
+
+def test_freeze_restores_archived_env(env_dir):
+    api.archive_env(env_dir, 'foo')
+    api.freeze_env(env_dir, 'foo')
+    assert api.get_env(env_dir, 'foo').archived is None
+
+
+def test_find_idle_envs(env_dir):
+    old = time.time() - 10 * 24 * 60 * 60
+    os.utime(os.path.join(env_dir, 'foo'), (old, old))
+    assert api.find_idle_envs(env_dir, 5) == ['foo']
+    assert api.find_idle_envs(env_dir, 5, active_env='foo') == []
+    with open(os.path.join(env_dir, 'foo', LAST_ACTIVATED_FILE_NAME), 'w'):
+        pass
+    os.utime(os.path.join(env_dir, 'foo'), (old, old))
+    assert api.find_idle_envs(env_dir, 5) == []
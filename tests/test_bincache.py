@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+
+import pytest
+
+from luamb import api
+from luamb._bincache import (
+    BinaryCache, BinaryCacheError, DirectoryBackend, HTTPBackend,
+    fetch_or_build,
+)
+from luamb._scratch import PhaseTimer
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    pytest.skip('Python 3 only', allow_module_level=True)
+
+
+class FakeHererocks(object):
+
+    hererocks_version = '0.0.0'
+
+    class RioLua(object):
+        versions = ['5.3.6', '5.4.4']
+        translations = {'5.3': '5.3.6', 'latest': '5.4.4'}
+
+    class LuaRocks(object):
+        versions = ['3.8.0']
+        translations = {'latest': '3.8.0'}
+
+    def __init__(self):
+        self.builds = []
+
+    def main(self, argv):
+        env_path = argv[-1]
+        self.builds.append(argv)
+        bin_dir = os.path.join(env_path, 'bin')
+        os.makedirs(bin_dir)
+        lua = os.path.join(bin_dir, 'lua')
+        with open(lua, 'w') as f:
+            f.write('#!/bin/sh\nprintf ok\n')
+        os.chmod(lua, 0o755)
+        with open(os.path.join(env_path, 'hererocks.manifest'), 'w') as f:
+            json.dump({'lua': {
+                'name': 'Lua', 'version': '5.3.6', 'major version': '5.3',
+                'path': env_path}}, f)
+
+
+class CacheHandler(SimpleHTTPRequestHandler):
+    """Stand-in for a cache server: GET, PUT (with If-None-Match), DELETE"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_PUT(self):
+        path = self.translate_path(self.path)
+        if self.headers.get('If-None-Match') == '*':
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError:
+                self.send_response(412)
+                self.end_headers()
+                return
+            os.close(fd)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.send_response(201)
+        self.end_headers()
+
+    def do_DELETE(self):
+        path = self.translate_path(self.path)
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        os.remove(path)
+        self.send_response(204)
+        self.end_headers()
+
+
+@pytest.fixture()
+def http_cache(tmp_path):
+    cache_dir = tmp_path / 'server'
+    cache_dir.mkdir()
+
+    def handler(*args, **kwargs):
+        return CacheHandler(*args, directory=str(cache_dir), **kwargs)
+
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port), str(cache_dir)
+    server.shutdown()
+    server.server_close()
+
+
+def create(env_dir, binary_cache, hererocks, upload_binary=False):
+    return api.create_env(
+        env_dir, 'ci', 'lua', '5.3', luarocks_version=None,
+        binary_cache=binary_cache, upload_binary=upload_binary, quiet=True,
+        hererocks=hererocks)
+
+
+@pytest.mark.parametrize('backend', ['directory', 'http'])
+def test_create_env_with_binary_cache(tmp_path, http_cache, backend):
+    url, cache_dir = http_cache
+    location = url if backend == 'http' else cache_dir
+    env_dir = str(tmp_path / 'envs')
+    os.makedirs(env_dir)
+    hererocks = FakeHererocks()
+
+    result = create(env_dir, location, hererocks)
+    assert result.binary_cache_status == 'miss'
+    assert os.listdir(cache_dir) == []
+
+    api.remove_env(env_dir, 'ci')
+    result = create(env_dir, location, hererocks, upload_binary=True)
+    assert result.binary_cache_status == 'uploaded'
+    assert len(hererocks.builds) == 2
+    assert sorted(name.rsplit('.', 1)[-1] for name in os.listdir(
+        cache_dir)) == ['gz', 'sha256']
+
+    api.remove_env(env_dir, 'ci')
+    result = create(env_dir, location, hererocks, upload_binary=True)
+    assert result.binary_cache_status == 'hit'
+    assert len(hererocks.builds) == 2
+    assert 'download' in result.phases
+    env = result.env
+    assert env.spec.lua_version == '5.3'
+    assert env.programs[0]['version'] == '5.3.6'
+    assert os.access(os.path.join(env.path, 'bin', 'lua'), os.X_OK)
+
+
+def test_checksum_mismatch(tmp_path, http_cache):
+    url, cache_dir = http_cache
+    env_dir = str(tmp_path / 'envs')
+    os.makedirs(env_dir)
+    hererocks = FakeHererocks()
+    create(env_dir, url, hererocks, upload_binary=True)
+    checksum_name = [
+        name for name in os.listdir(cache_dir) if name.endswith('.sha256')][0]
+    with open(os.path.join(cache_dir, checksum_name), 'w') as f:
+        f.write('0' * 64)
+
+    api.remove_env(env_dir, 'ci')
+    result = create(env_dir, url, hererocks)
+    assert result.binary_cache_status == 'miss'
+    assert 'checksum mismatch' in result.binary_cache_error
+    assert len(hererocks.builds) == 2
+    # the partially unpacked tree is removed
+    assert os.listdir(os.path.join(env_dir, '.luamb', 'tmp')) == []
+
+
+def test_local_sources_are_not_cached(tmp_path):
+    env_dir = str(tmp_path / 'envs')
+    os.makedirs(env_dir)
+    result = api.create_env(
+        env_dir, 'ci', 'lua', str(tmp_path), binary_cache=str(tmp_path),
+        quiet=True, hererocks=FakeHererocks())
+    assert result.binary_cache_status is None
+
+
+@pytest.mark.parametrize('backend', ['directory', 'http'])
+def test_lock(http_cache, backend):
+    url, cache_dir = http_cache
+    if backend == 'http':
+        backend = HTTPBackend(url)
+    else:
+        backend = DirectoryBackend(cache_dir)
+    cache = BinaryCache(backend, upload=True, lock_ttl=60)
+    other = BinaryCache(backend, upload=True, lock_ttl=60)
+    assert cache.acquire_lock('key')
+    assert not other.acquire_lock('key')
+    assert other.is_locked('key')
+    cache.release_lock('key')
+    assert not other.is_locked('key')
+
+    # a lock of a crashed node expires
+    assert cache.acquire_lock('key')
+    other.lock_ttl = -1
+    assert not other.is_locked('key')
+    assert other.acquire_lock('key')
+
+
+def test_wait_for_other_node(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    cache = BinaryCache(
+        DirectoryBackend(cache_dir), upload=True, poll_interval=0.01)
+    assert cache.acquire_lock('key')
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'file').write_text('built by another node')
+    staging_dir = str(tmp_path / 'staging')
+    timer = PhaseTimer()
+
+    def upload_later():
+        cache.store('key', str(source), staging_dir)
+        cache.release_lock('key')
+
+    threading.Timer(0.2, upload_later).start()
+    status, value, error = fetch_or_build(
+        BinaryCache(DirectoryBackend(cache_dir), poll_interval=0.01),
+        'key', str(tmp_path / 'env'), staging_dir,
+        build=lambda: pytest.fail('must not build'), timer=timer)
+    assert (status, value, error) == ('hit', None, None)
+    assert timer.phases['wait'] > 0
+    assert (tmp_path / 'env' / 'file').read_text() == 'built by another node'
+
+
+def test_unreachable_cache():
+    with pytest.raises(BinaryCacheError):
+        HTTPBackend('http://127.0.0.1:9').read('key.sha256')
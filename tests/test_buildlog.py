@@ -0,0 +1,20 @@
+import os
+
+from luamb._buildlog import BuildLog, iter_log
+
+
+def test_build_log_tail_and_rotation(tmp_path):
+    path = str(tmp_path / 'logs' / 'env.log')
+    for build in range(3):
+        build_log = BuildLog(path, max_bytes=1000, backup_count=2,
+                             tail_size=3).open()
+        for i in range(100):
+            build_log.feed('build {} line {}\n'.format(build, i))
+        build_log.feed(b'no newline')
+        build_log.close()
+    assert build_log.tail == [
+        'build 2 line 98', 'build 2 line 99', 'no newline']
+    assert sorted(os.listdir(str(tmp_path / 'logs'))) == [
+        'env.log', 'env.log.1', 'env.log.2']
+    assert os.path.getsize(path) <= 1000
+    assert list(iter_log(path, lines=1)) == ['no newline']
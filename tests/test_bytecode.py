@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from luamb import api
+from luamb._bytecode import get_bytecode_path, get_compiler, is_compiled
+from luamb._modindex import get_index_path
+
+
+def write(path, content, mode=0o644):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, mode)
+
+
+# stands in for luac: copies the source, fails on 'syntax error'
+FAKE_LUAC = '''#!/bin/sh
+while [ "$1" != "-o" ]; do shift; done
+if grep -q 'syntax error' "$3"; then
+    echo "luac: $3:1: syntax error" >&2
+    exit 1
+fi
+echo "$3" >> "$(dirname "$0")/luac.log"
+cp "$3" "$2"
+'''
+
+
+@pytest.fixture()
+def env_path(tmp_path):
+    env_path = str(tmp_path / 'envs' / 'app')
+    share = os.path.join(env_path, 'share', 'lua', '5.3')
+    path = ';'.join([os.path.join(share, '?.lua'), './?.lua'])
+    cpath = './?.so'
+    write(os.path.join(env_path, 'bin', 'lua'),
+          "#!/bin/sh\nprintf '%s\\n%s\\n/' '{}' '{}'\n".format(path, cpath),
+          mode=0o755)
+    write(os.path.join(env_path, 'bin', 'luac'), FAKE_LUAC, mode=0o755)
+    write(os.path.join(env_path, 'hererocks.manifest'), json.dumps(
+        {'lua': {'name': 'Lua', 'major version': '5.3'}, 'version': 3}))
+    for name in ['json.lua', 'pl/path.lua']:
+        write(os.path.join(share, name), 'return true\n')
+    write(os.path.join(share, 'broken.lua'), 'syntax error\n')
+    return env_path
+
+
+def compiled_sources(env_path):
+    with open(os.path.join(env_path, 'bin', 'luac.log')) as f:
+        sources = [os.path.basename(line.strip()) for line in f]
+    os.remove(os.path.join(env_path, 'bin', 'luac.log'))
+    return sorted(sources)
+
+
+def test_compile_env(env_path):
+    env_dir = os.path.dirname(env_path)
+    share = os.path.join(env_path, 'share', 'lua', '5.3')
+    assert get_compiler(env_path) == 'luac'
+
+    result = api.compile_env(env_dir, 'app')
+    assert (result.compiled, result.reused) == (2, 0)
+    assert [os.path.basename(path) for path, _ in result.failed] == [
+        'broken.lua']
+    assert compiled_sources(env_path) == ['json.lua', 'path.lua']
+    bytecode_path = get_bytecode_path(
+        env_path, os.path.join(share, 'json.lua'))
+    assert bytecode_path.endswith('.luac')
+    with open(get_index_path(env_path)) as f:
+        chunk = f.read()
+    assert '"{}", "{}"}}'.format(bytecode_path, bytecode_path[:-1]) in chunk
+    assert 'broken.luac' not in chunk
+
+    # only changed sources are recompiled
+    write(os.path.join(share, 'json.lua'), 'return "changed"\n')
+    os.remove(os.path.join(share, 'pl', 'path.lua'))
+    result = api.compile_env(env_dir, 'app')
+    assert (result.compiled, result.reused) == (1, 0)
+    assert compiled_sources(env_path) == ['json.lua']
+    assert not os.path.exists(get_bytecode_path(
+        env_path, os.path.join(share, 'pl', 'path.lua')))
+
+    # a rebuilt interpreter invalidates all bytecode
+    os.utime(os.path.join(env_path, 'bin', 'lua'), (1, 1))
+    write(os.path.join(share, 'new.lua'), 'return true\n')
+    api._refresh_index(env_path)
+    assert compiled_sources(env_path) == ['json.lua', 'new.lua']
+    with open(get_index_path(env_path)) as f:
+        assert 'new.luac' in f.read()
+
+    assert api.remove_env_bytecode(env_dir, 'app')
+    assert not api.remove_env_bytecode(env_dir, 'app')
+    with open(get_index_path(env_path)) as f:
+        assert '.luac' not in f.read()
+
+
+def test_compiler_selection(env_path):
+    os.remove(os.path.join(env_path, 'bin', 'luac'))
+    assert get_compiler(env_path) == 'string.dump'
+    write(os.path.join(env_path, 'hererocks.manifest'), json.dumps(
+        {'LuaJIT': {'name': 'LuaJIT', 'major version': '5.1'}}))
+    assert get_compiler(env_path) == 'luajit -b'
+
+
+def test_remove_index_keeps_bytecode(env_path):
+    env_dir = os.path.dirname(env_path)
+    api.compile_env(env_dir, 'app')
+    assert api.remove_env_index(env_dir, 'app')
+    assert not os.path.exists(get_index_path(env_path))
+    assert is_compiled(env_path)
+    assert api.remove_env_bytecode(env_dir, 'app')
+
+
+def test_stale_bytecode_real_interpreter(lua_env):
+    json_path = lua_env.write_module('json', 'return "v1"\n')
+    other_path = lua_env.write_module('other', 'return "bc"\n')
+    api.compile_env(lua_env.env_dir, lua_env.name)
+    index_path = get_index_path(lua_env.path)
+    code = "io.write((require('json')))"
+    assert lua_env.run(code, index_path) == 'v1'
+
+    # bytecode is loaded while the source matches the compiled one
+    shutil.copyfile(get_bytecode_path(lua_env.path, other_path),
+                    get_bytecode_path(lua_env.path, json_path))
+    assert lua_env.run(code, index_path) == 'bc'
+
+    # an edit keeping the size and the mtime falls back to the source
+    st = os.stat(json_path)
+    lua_env.write_module('json', 'return "v2"\n')
+    os.utime(json_path, (st.st_atime, st.st_mtime))
+    assert lua_env.run(code, index_path) == 'v2'
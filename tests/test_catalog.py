@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from luamb import api
+from luamb._catalog import Catalog, parse_sort, parse_where, query
+from luamb._exceptions import LuambException
+from luamb._luamb import Luamb
+
+
+def make_env(env_dir, env_name, lua_type, lua_version, project=None):
+    env_path = os.path.join(env_dir, env_name)
+    os.makedirs(env_path)
+    with open(os.path.join(env_path, '.spec'), 'w') as f:
+        json.dump({'lua_type': lua_type, 'lua_version': lua_version}, f)
+    if project:
+        with open(os.path.join(env_path, '.project'), 'w') as f:
+            f.write(project)
+    return env_path
+
+
+@pytest.fixture()
+def env_dir(tmp_path):
+    env_dir = str(tmp_path / 'luambenvs')
+    make_env(env_dir, 'lua51', 'lua', '5.1')
+    make_env(env_dir, 'lua54', 'lua', '5.4', project='/srv/app')
+    make_env(env_dir, 'jit', 'luajit', '2.1')
+    make_env(env_dir, 'lua53', 'lua', '5.3')
+    make_env(env_dir, 'local', 'lua', '/src/lua-5.4')
+    return env_dir
+
+
+def names(envs):
+    return [env.name for env in envs]
+
+
+def test_parse_where():
+    assert parse_where('lua=luajit, version=2.1*') == [
+        ('lua', 'luajit'), ('version', '2.1*')]
+    with pytest.raises(LuambException):
+        parse_where('lua')
+    with pytest.raises(LuambException):
+        parse_where('color=red')
+
+
+def test_parse_sort():
+    assert parse_sort('-version') == ('version', True)
+    assert parse_sort('name') == ('name', False)
+
+
+def test_query_sort_limit():
+    entries = [
+        {'name': name, 'spec': {'lua_version': version}}
+        for name, version in [
+            ('a', '5.10'), ('b', '5.2'), ('c', '5.4'), ('d', '5.2')]
+    ]
+    sort = ('version', False)
+    assert [e['name'] for e in query(entries, sort=sort)] == [
+        'b', 'd', 'c', 'a']
+    assert [e['name'] for e in query(entries, sort=sort, limit=2)] == [
+        'b', 'd']
+    sort = ('version', True)
+    assert [e['name'] for e in query(entries, sort=sort, limit=3)] == [
+        'a', 'c', 'd']
+    assert [e['name'] for e in query(entries, limit=1)] == ['a']
+
+
+def test_iter_envs(env_dir):
+    assert names(api.iter_envs(env_dir)) == [
+        'jit', 'local', 'lua51', 'lua53', 'lua54']
+    assert names(api.iter_envs(env_dir, where='lua=lua,version=5.[34]*')) == [
+        'lua53', 'lua54']
+    assert names(api.iter_envs(
+        env_dir, where=['lua=lua', 'project=/srv/*'])) == ['lua54']
+    assert names(api.iter_envs(
+        env_dir, where='lua=lua', sort='-version', limit=2)) == [
+        'lua54', 'lua53']
+    envs = list(api.iter_envs(env_dir, where='name=jit', active_env='jit'))
+    assert envs[0].active
+    assert envs[0].spec.lua_type == 'luajit'
+
+
+def test_catalog_incremental(env_dir, tmp_path):
+    loaded = []
+
+    def load_entry(env_name):
+        loaded.append(env_name)
+        return api.get_env(env_dir, env_name).to_dict()
+
+    path = str(tmp_path / 'catalog.json')
+    Catalog(env_dir, path, load_entry).refresh().save()
+    assert len(loaded) == 5
+
+    del loaded[:]
+    catalog = Catalog(env_dir, path, load_entry).refresh()
+    catalog.save()
+    assert loaded == []
+    assert len(list(catalog)) == 5
+
+    del loaded[:]
+    make_env(env_dir, 'new', 'lua', '5.2')
+    # timestamps are coarse-grained, don't rely on the clock moving
+    os.utime(os.path.join(env_dir, 'lua51'), (1, 1))
+    os.utime(env_dir, (2, 2))
+    catalog = Catalog(env_dir, path, load_entry).refresh()
+    catalog.save()
+    assert sorted(loaded) == ['lua51', 'new']
+
+    del loaded[:]
+    shutil.rmtree(os.path.join(env_dir, 'new'))
+    os.utime(env_dir, (3, 3))
+    catalog = Catalog(env_dir, path, load_entry).refresh()
+    assert loaded == []
+    assert 'new' not in [entry['name'] for entry in catalog]
+
+    Catalog(env_dir, path, load_entry).refresh(full=True)
+    assert len(loaded) == 5
+
+
+@pytest.mark.parametrize('argv', [
+    ['--sort', 'version', '--reverse'],
+    ['--sort', 'version', '-r'],
+    ['--sort=-version'],
+])
+def test_ls_sort_cli(env_dir, capsys, argv):
+    luamb = Luamb(env_dir, history=False)
+    luamb.run(['ls', '-s', '--where', 'lua=lua'] + argv + ['--limit', '2'])
+    assert capsys.readouterr().out.split() == ['lua54', 'lua53']
+
+
+def test_ls_reverse_requires_sort(env_dir, capsys):
+    with pytest.raises(SystemExit):
+        Luamb(env_dir, history=False).run(['ls', '--reverse'])
+    assert '--reverse requires --sort' in capsys.readouterr().err
@@ -0,0 +1,183 @@
+import os
+import subprocess
+
+import pytest
+
+from luamb._ccache import (
+    CACHE_DIR_VAR, STATS_FILE_VAR, CompilerCache, CompilerCacheStats,
+    _parse_compile_args, wrap_compiler,
+)
+
+
+# stands in for gcc: -E prints the source (fails on '#error') after
+# the working directory marker with -g, -c writes the source with a marker
+# to -o, warns about sources containing 'warn'
+FAKE_GCC = '''#!/bin/sh
+for arg; do
+    case "$prev" in -o) out=$arg ;; esac
+    case "$arg" in *.c) src=$arg ;; esac
+    prev=$arg
+done
+case " $* " in
+*" -E "*)
+    if grep -q '#error' "$src"; then
+        echo "$src:1: error" >&2
+        exit 1
+    fi
+    case " $* " in *" -g "*) echo "# 1 \\"$(pwd)//\\"" ;; esac
+    cat "$src"
+    ;;
+*)
+    echo "$src" >> "$(dirname "$0")/gcc.log"
+    if grep -q warn "$src"; then
+        echo "$src:1: warning: unused variable" >&2
+    fi
+    { echo "object $*"; cat "$src"; } > "$out"
+    ;;
+esac
+'''
+
+
+def write(path, content, mode=0o644):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, mode)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture()
+def gcc(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    path = str(bin_dir / 'gcc')
+    write(path, FAKE_GCC, mode=0o755)
+    monkeypatch.setenv(
+        'PATH', os.pathsep.join([str(bin_dir), os.environ['PATH']]))
+    monkeypatch.chdir(str(tmp_path))
+    return path
+
+
+def compile_count(gcc):
+    log_path = os.path.join(os.path.dirname(gcc), 'gcc.log')
+    if not os.path.exists(log_path):
+        return 0
+    with open(log_path) as f:
+        return len(f.readlines())
+
+
+def read_stats(path):
+    with open(path) as f:
+        return f.read().split()
+
+
+@pytest.mark.parametrize('args,expected', [
+    (
+        ['-O2', '-c', '-o', 'lapi.o', 'lapi.c'],
+        ('lapi.c', 'lapi.o', ['-O2', '-c', 'lapi.c']),
+    ),
+    (
+        ['-c', 'lapi.c'],
+        ('lapi.c', 'lapi.o', ['-c', 'lapi.c']),
+    ),
+    (
+        ['-c', '-olapi.o', 'src/lapi.c'],
+        ('src/lapi.c', 'lapi.o', ['-c', 'src/lapi.c']),
+    ),
+    (['-o', 'lua', 'lua.o', 'liblua.a'], None),
+    (['-c', 'lapi.c', 'lcode.c'], None),
+    (['-c', '-MMD', 'lapi.c'], None),
+    (['-c', '-o'], None),
+])
+def test_parse_compile_args(args, expected):
+    assert _parse_compile_args(args) == expected
+
+
+def test_wrap_compiler(gcc, tmp_path, monkeypatch, capfd):
+    cache_dir = str(tmp_path / 'objects')
+    stats_path = str(tmp_path / 'stats')
+    monkeypatch.setenv(CACHE_DIR_VAR, cache_dir)
+    monkeypatch.setenv(STATS_FILE_VAR, stats_path)
+    write('lapi.c', 'int x; /* warn */')
+    args = ['-O2', '-c', '-o', 'lapi.o', 'lapi.c']
+
+    assert wrap_compiler(gcc, args) == 0
+    assert compile_count(gcc) == 1
+    assert 'warning: unused variable' in capfd.readouterr().err
+    compiled = read('lapi.o')
+    os.remove('lapi.o')
+    # the same flags and preprocessed source: the object is copied
+    assert wrap_compiler(gcc, args) == 0
+    assert compile_count(gcc) == 1
+    assert read('lapi.o') == compiled
+    # warnings are replayed on a hit
+    assert 'warning: unused variable' in capfd.readouterr().err
+    assert read_stats(stats_path) == ['miss', 'hit']
+
+    # flags and source are a part of the key
+    assert wrap_compiler(gcc, ['-O3'] + args[1:]) == 0
+    write('lapi.c', 'int y; /* warn */')
+    assert wrap_compiler(gcc, args) == 0
+    assert compile_count(gcc) == 3
+    assert read_stats(stats_path) == ['miss', 'hit', 'miss', 'miss']
+
+    # failed preprocessing and uncacheable calls are passed through
+    object_count = sum(len(files) for _, _, files in os.walk(cache_dir))
+    write('lapi.c', '#error')
+    assert wrap_compiler(gcc, args) == 0
+    assert wrap_compiler(gcc, args) == 0
+    assert wrap_compiler(gcc, ['-c', '-MMD', '-o', 'lapi.o', 'lapi.c']) == 0
+    assert compile_count(gcc) == 6
+    assert sum(len(files) for _, _, files in os.walk(cache_dir)) == (
+        object_count)
+    assert len(read_stats(stats_path)) == 4
+
+
+def test_debug_builds_in_other_directories(gcc, tmp_path, monkeypatch):
+    monkeypatch.setenv(CACHE_DIR_VAR, str(tmp_path / 'objects'))
+    args = ['-g', '-c', '-o', 'lapi.o', 'lapi.c']
+    for name in ('one', 'two'):
+        build_dir = tmp_path / name
+        build_dir.mkdir()
+        monkeypatch.chdir(str(build_dir))
+        write('lapi.c', 'int x;')
+        assert wrap_compiler(gcc, args) == 0
+        assert os.path.isfile('lapi.o')
+    assert compile_count(gcc) == 1
+
+
+def test_session(gcc, tmp_path):
+    environ = dict(os.environ)
+    cache = CompilerCache(str(tmp_path / 'cache'), 'builtin')
+    write('lapi.c', 'int x;')
+    with cache.session() as stats:
+        assert os.environ['PATH'].split(os.pathsep)[0] == cache.bin_dir
+        assert os.environ[CACHE_DIR_VAR].startswith(cache.cache_dir)
+        with open(os.path.join(cache.bin_dir, 'gcc')) as f:
+            assert "'{}'".format(gcc) in f.read()
+        objects = []
+        for _ in range(2):
+            subprocess.check_call(['gcc', '-c', '-o', 'lapi.o', 'lapi.c'])
+            objects.append(read('lapi.o'))
+            os.remove('lapi.o')
+        assert compile_count(gcc) == 1
+        assert objects[0] == objects[1]
+        # shims never point at the shims directory itself
+        cache._write_shims()
+        with open(os.path.join(cache.bin_dir, 'gcc')) as f:
+            assert "'{}'".format(gcc) in f.read()
+    assert (stats.hits, stats.misses) == (1, 1)
+    assert str(stats) == '1 hits, 1 misses (50% hit rate)'
+    assert dict(os.environ) == environ
+
+
+def test_stats_formatting():
+    stats = CompilerCacheStats()
+    assert str(stats) == 'no cacheable compilations'
+    stats.hits, stats.misses = 3, 1
+    assert str(stats) == '3 hits, 1 misses (75% hit rate)'
+    stats.available = False
+    assert str(stats) == 'statistics are not available'
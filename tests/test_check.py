@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+
+from luamb import api
+
+
+def make_env(env_dir, env_name, lua_script):
+    env_path = os.path.join(env_dir, env_name)
+    bin_dir = os.path.join(env_path, 'bin')
+    os.makedirs(bin_dir)
+    with open(os.path.join(env_path, 'hererocks.manifest'), 'w') as f:
+        json.dump({'lua': {'name': 'Lua', 'major version': '5.3'}}, f)
+    lua = os.path.join(bin_dir, 'lua')
+    with open(lua, 'w') as f:
+        f.write('#!/bin/sh\n' + lua_script)
+    os.chmod(lua, 0o755)
+    with open(os.path.join(bin_dir, 'activate'), 'w') as f:
+        f.write("PATH='{}':\"$PATH\"\n".format(bin_dir))
+    return env_path
+
+
+@pytest.fixture()
+def env_dir(tmp_path):
+    env_dir = str(tmp_path / 'luambenvs')
+    make_env(env_dir, 'good', 'printf ok\n')
+    make_env(env_dir, 'bad', 'echo "error while loading libreadline"\n'
+                             'exit 127\n')
+    os.makedirs(os.path.join(env_dir, 'half', 'bin'))
+    with open(os.path.join(env_dir, 'good', '.project'), 'w') as f:
+        f.write(str(tmp_path / 'missing'))
+    return env_dir
+
+
+def test_check_envs(env_dir):
+    results = api.check_envs(env_dir)
+    assert [(r.env_name, r.status, r.cached) for r in results] == [
+        ('bad', 'broken', False),
+        ('good', 'broken', False),
+        ('half', 'broken', False),
+    ]
+    bad, good, half = results
+    assert bad.problems == [
+        'lua exited with status 127: error while loading libreadline']
+    assert good.problems[0].startswith("project directory doesn't exist")
+    assert 'incomplete build' in half.problems[0]
+
+
+def test_check_envs_cache(env_dir):
+    api.check_envs(env_dir, ['good'])
+    os.mkdir(os.path.join(env_dir, 'missing'))
+    with open(os.path.join(env_dir, 'good', '.project'), 'w') as f:
+        f.write(os.path.join(env_dir, 'missing'))
+    result, = api.check_envs(env_dir, ['good'])
+    # project is rechecked even if the result is taken from the cache
+    assert (result.status, result.cached) == ('ok', True)
+    lua = os.path.join(env_dir, 'good', 'bin', 'lua')
+    os.rename(lua, lua + '.old')
+    with open(lua, 'w') as f:
+        f.write('#!/bin/sh\nexit 1\n')
+    os.chmod(lua, 0o755)
+    result, = api.check_envs(env_dir, ['good'])
+    assert (result.status, result.cached) == ('broken', False)
+    result, = api.check_envs(env_dir, ['good'], use_cache=False)
+    assert not result.cached
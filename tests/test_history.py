@@ -0,0 +1,156 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from luamb import api
+from luamb._history import (
+    KIND_BINARY_CACHE, History, format_spec_key, percentile, spec_key,
+)
+from luamb._luamb import Luamb
+from luamb._spec import EnvSpec
+
+
+@pytest.mark.parametrize('percent,expected', [
+    (50, 5), (95, 10), (100, 10), (1, 1),
+])
+def test_percentile(percent, expected):
+    assert percentile(list(range(1, 11)), percent) == expected
+
+
+def test_build_stats(tmp_path):
+    history = History(str(tmp_path / 'state' / 'history.sqlite3'))
+    spec = EnvSpec('lua', '5.4', '3.8', hererocks_version='0.25.1')
+    other_spec = EnvSpec('luajit', '2.1', hererocks_args=['--cflags=-O3'])
+    records = [
+        ('mk', 'a', spec, 3.0, 0),
+        ('mk', 'b', EnvSpec('lua', '5.4', '3.8'), 1.0, 0),
+        ('mk', 'c', spec, 100.0, 1),
+        ('mk', 'd', other_spec, 2.0, 0),
+        ('rm', None, None, 0.1, 0),
+    ]
+    for started_at, (command, env_name, spec_, duration, status) in (
+            enumerate(records)):
+        assert history.record(
+            started_at, duration, command, [env_name], status,
+            env_name=env_name, spec=spec_)
+    stats = history.get_build_stats()
+    assert [(format_spec_key(key), durations, env_names)
+            for key, durations, env_names in stats] == [
+        ('lua 5.4 + luarocks 3.8', [1.0, 3.0], ['a', 'b']),
+        ('luajit 2.1 (--cflags=-O3)', [2.0], ['d']),
+    ]
+    assert len(history.get_build_stats(since=2)) == 1
+
+
+def test_binary_cache_hits_are_not_builds(tmp_path):
+    history = History(str(tmp_path / 'history.sqlite3'))
+    spec = EnvSpec('lua', '5.4', '3.8')
+    history.record(0, 60.0, 'mk', ['a'], 0, env_name='a', spec=spec)
+    history.record(1, 0.5, 'mk', ['b'], 0, env_name='b', spec=spec,
+                   kind=KIND_BINARY_CACHE)
+    assert [durations for _, durations, _ in history.get_build_stats()] == [
+        [60.0]]
+    assert history.count_binary_cache_hits() == 1
+    assert history.count_binary_cache_hits(since=2) == 0
+
+
+def test_old_database_is_migrated(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE operations (id INTEGER PRIMARY KEY, '
+        'started_at REAL NOT NULL, duration REAL NOT NULL, '
+        'command TEXT NOT NULL, args TEXT NOT NULL, env_name TEXT, '
+        'spec TEXT, exit_status INTEGER NOT NULL, hererocks_version TEXT, '
+        'luamb_version TEXT)')
+    conn.execute(
+        "INSERT INTO operations (started_at, duration, command, args, "
+        "env_name, spec, exit_status) VALUES (0, 5, 'mk', '[]', 'a', ?, 0)",
+        (spec_key(EnvSpec('lua', '5.4')),))
+    conn.commit()
+    conn.close()
+    history = History(path)
+    assert history.record(1, 1.0, 'mk', ['b'], 0, env_name='b',
+                          spec=EnvSpec('lua', '5.4'), kind=KIND_BINARY_CACHE)
+    assert [durations for _, durations, _ in history.get_build_stats()] == [
+        [5.0]]
+    assert history.count_binary_cache_hits() == 1
+
+
+class FakeHererocks(object):
+
+    hererocks_version = '0.0.0'
+
+    class RioLua(object):
+        versions = ['5.3.6', '5.4.4']
+        translations = {'5.3': '5.3.6', 'latest': '5.4.4'}
+
+    class LuaRocks(object):
+        versions = ['3.8.0']
+        translations = {'3': '3.8.0', 'latest': '3.8.0'}
+
+    def main(self, argv):
+        env_path = argv[-1]
+        os.makedirs(os.path.join(env_path, 'bin'))
+        with open(os.path.join(env_path, 'hererocks.manifest'), 'w') as f:
+            json.dump({'lua': {
+                'name': 'Lua', 'version': '5.3.6', 'major version': '5.3',
+                'path': env_path}}, f)
+
+    def show_identifiers(self, identifiers):
+        pass
+
+
+def test_spec_key_resolved_versions():
+    keys = [
+        spec_key(api.resolve_spec(spec, hererocks=FakeHererocks()))
+        for spec in [EnvSpec('lua', '5.3', '3'),
+                     EnvSpec('lua', '5.3.6', 'latest'),
+                     EnvSpec('lua', '5.3.6', '3.8.0')]
+    ]
+    assert keys[0] == keys[1] == keys[2]
+    assert format_spec_key(keys[0]) == 'lua 5.3.6 + luarocks 3.8.0'
+    # local sources are not versions
+    spec = api.resolve_spec(
+        EnvSpec('lua', '/src/lua-5.3'), hererocks=FakeHererocks())
+    assert spec.lua_version == '/src/lua-5.3'
+
+
+def test_record_failure_is_ignored(tmp_path):
+    path = tmp_path / 'history.sqlite3'
+    os.mkdir(str(path))
+    assert not History(str(path)).record(0, 0, 'ls', [], 0)
+
+
+def test_commands_recorded_by_one_instance(tmp_path, capsys):
+    env_dir = str(tmp_path / 'envs')
+    os.makedirs(env_dir)
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    luamb = Luamb(env_dir, binary_cache=cache_dir, upload_binary=True,
+                  hererocks=FakeHererocks())
+    luamb.run(['mk', '-l', '5.3', 'a'])
+    luamb.run(['rm', 'a'])
+    luamb.run(['mk', '-l', '5.3', 'a'])
+    luamb.run(['ls'])
+    conn = sqlite3.connect(luamb.history.path)
+    rows = conn.execute(
+        'SELECT command, env_name, spec IS NOT NULL, kind '
+        'FROM operations ORDER BY id').fetchall()
+    conn.close()
+    assert rows == [
+        ('mk', 'a', 1, 'build'),
+        ('rm', None, 0, None),
+        ('mk', 'a', 1, KIND_BINARY_CACHE),
+        ('ls', None, 0, None),
+    ]
+    history = luamb.history
+    assert [len(durations) for _, durations, _ in (
+        history.get_build_stats())] == [1]
+    assert history.count_binary_cache_hits() == 1
+    capsys.readouterr()
+    luamb.run(['stats'])
+    assert '(and 1 environments from the binary cache)' in (
+        capsys.readouterr().out)
@@ -0,0 +1,61 @@
+import os
+import zipfile
+
+import pytest
+
+from luamb._exceptions import LuambException
+from luamb._mirror import (
+    CONFIG_MARKER, _read_rockspec, configure_env, iter_mirrored_rocks,
+    parse_rock_arg,
+)
+
+
+def test_configure_env(tmp_path):
+    env_path = tmp_path / 'env'
+    (env_path / 'etc' / 'luarocks').mkdir(parents=True)
+    config_path = str(env_path / 'etc' / 'luarocks' / 'config-5.3.lua')
+    with open(config_path, 'w') as f:
+        f.write('rocks_trees = {}\n')
+    mirror_dir = str(tmp_path / 'mirror')
+    assert configure_env(
+        str(env_path), mirror_dir, '/cache', upstream='/up"stream')
+    assert not configure_env(str(env_path), mirror_dir, '/cache')
+    with open(config_path) as f:
+        config = f.read()
+    assert config.count(CONFIG_MARKER) == 1
+    assert 'local_cache = "/cache"' in config
+    assert '"{}",\n    "/up\\"stream",'.format(mirror_dir) in config
+    assert os.path.isfile(os.path.join(mirror_dir, 'manifest'))
+
+
+def test_configure_env_without_luarocks(tmp_path):
+    assert not configure_env(
+        str(tmp_path), str(tmp_path / 'mirror'), str(tmp_path / 'cache'))
+    assert not os.path.exists(str(tmp_path / 'mirror'))
+
+
+@pytest.mark.parametrize('arg,expected', [
+    ('lpeg', ('lpeg', None)),
+    ('lpeg==1.0.2-1', ('lpeg', '1.0.2-1')),
+    ('lua-cjson==2.1.0', ('lua-cjson', '2.1.0')),
+])
+def test_parse_rock_arg(arg, expected):
+    assert parse_rock_arg(arg) == expected
+
+
+@pytest.mark.parametrize('arg', ['', '==1.0', 'lpeg==', 'a/b'])
+def test_parse_rock_arg_invalid(arg):
+    with pytest.raises(LuambException):
+        parse_rock_arg(arg)
+
+
+def test_mirror_contents(tmp_path):
+    rock_path = str(tmp_path / 'lua-cjson-2.1.0-1.src.rock')
+    with zipfile.ZipFile(rock_path, 'w') as rock:
+        rock.writestr('lua-cjson-2.1.0-1.rockspec', 'package = "lua-cjson"')
+        rock.writestr('lua-cjson/lua_cjson.c', '')
+    (tmp_path / 'luasocket-3.0-1.rockspec').write_text(u'package = "x"')
+    (tmp_path / 'manifest').write_text(u'')
+    assert list(iter_mirrored_rocks(str(tmp_path))) == [
+        ('lua-cjson', '2.1.0-1'), ('luasocket', '3.0-1')]
+    assert _read_rockspec(rock_path) == b'package = "lua-cjson"'
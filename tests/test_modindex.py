@@ -0,0 +1,219 @@
+import os
+import subprocess
+
+import pytest
+
+import luamb
+from luamb import api
+from luamb._exceptions import LuambException
+from luamb._modindex import (
+    build_index, count_probes, get_index_path, iter_template_modules,
+)
+from luamb._rocks import get_luarocks_path
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write('return true\n')
+
+
+@pytest.fixture()
+def env_path(tmp_path):
+    env_path = str(tmp_path / 'envs' / 'app')
+    share = os.path.join(env_path, 'share', 'lua', '5.3')
+    lib = os.path.join(env_path, 'lib', 'lua', '5.3')
+    path = ';'.join([
+        os.path.join(share, '?.lua'), os.path.join(share, '?', 'init.lua'),
+        './?.lua',
+    ])
+    cpath = ';'.join([os.path.join(lib, '?.so'), './?.so'])
+    # stands in for the interpreter printing its default search paths
+    lua = os.path.join(env_path, 'bin', 'lua')
+    touch(lua)
+    with open(lua, 'w') as f:
+        f.write("#!/bin/sh\nprintf '%s\\n%s\\n/' '{}' '{}'\n".format(
+            path, cpath))
+    os.chmod(lua, 0o755)
+    for name in ['json.lua', 'lpeg.lua', 'pl/init.lua', 'pl/path.lua',
+                 'pl/init/init.lua', 'bad.name.lua', 'README']:
+        touch(os.path.join(share, name))
+    for name in ['lpeg.so', 'socket/core.so', 'lua-cjson.so']:
+        touch(os.path.join(lib, name))
+    rocks_tree = os.path.join(env_path, 'lib', 'luarocks', 'rocks-5.3')
+    touch(os.path.join(rocks_tree, 'manifest'))
+    return env_path
+
+
+def test_iter_template_modules(tmp_path):
+    for name in ['a.lua', 'b/c.lua', 'b/init.lua', 'x.y.lua', 'd.txt']:
+        touch(str(tmp_path / name))
+    template = os.path.join(str(tmp_path), '?.lua')
+    assert sorted(iter_template_modules(template)) == [
+        ('a', template.replace('?', 'a')),
+        ('b.c', template.replace('?', 'b/c')),
+        ('b.init', template.replace('?', 'b/init')),
+    ]
+    template = os.path.join(str(tmp_path), '?', 'init.lua')
+    assert list(iter_template_modules(template)) == [
+        ('b', template.replace('?', 'b'))]
+
+
+def test_build_index(env_path):
+    index = build_index(env_path)
+    assert list(index.lua_modules) == ['json', 'lpeg', 'pl.init', 'pl.path',
+                                       'pl.init.init', 'pl']
+    # first matching template wins
+    assert index.lua_modules['pl.init'][1] == 0
+    assert index.lua_modules['pl'][1] == 1
+    assert list(index.c_modules) == ['lpeg', 'socket.core']
+    assert index.lua_unindexed == [(2, './?.lua')]
+    assert index.c_unindexed == [(1, './?.so')]
+    assert index.manifest.endswith('manifest')
+    assert index.manifest_size == len('return true\n')
+
+    chunk = index.render()
+    assert '["socket.core"] = {{"{}", 0}}'.format(
+        os.path.join(env_path, 'lib', 'lua', '5.3', 'socket', 'core.so')
+    ) in chunk
+    assert 'local manifest_size = 12' in chunk
+
+
+def test_count_probes(env_path):
+    index = build_index(env_path)
+    # json: found by the first template; socket.core: after 3 Lua
+    # templates and the first C template; missing: all 5 templates
+    names = ['json', 'socket.core', 'missing']
+    assert count_probes(index, names, use_index=False) == 1 + 4 + 5
+    # socket.core: relative Lua template checked before loading
+    assert count_probes(index, names, use_index=True) == 1 + 2 + 5
+
+
+def test_index_env(env_path):
+    env_dir = os.path.dirname(env_path)
+    index_path = get_index_path(env_path)
+    with pytest.raises(LuambException):
+        api.benchmark_env_index(env_dir, 'app')
+    api.index_env(env_dir, 'app')
+    assert os.path.isfile(index_path)
+
+    touch(os.path.join(env_path, 'share', 'lua', '5.3', 'new.lua'))
+    api._refresh_index(env_path)
+    with open(index_path) as f:
+        assert '["new"]' in f.read()
+
+    assert api.remove_env_index(env_dir, 'app')
+    assert not api.remove_env_index(env_dir, 'app')
+    api._refresh_index(env_path)
+    assert not os.path.exists(index_path)
+
+
+@pytest.mark.parametrize('output', ['', 'Lua 5.3.6 Copyright', 'a\nb\nc\nd'])
+def test_unexpected_interpreter_output(env_path, output):
+    env_dir = os.path.dirname(env_path)
+    lua = os.path.join(env_path, 'bin', 'lua')
+    with open(lua, 'w') as f:
+        f.write("#!/bin/sh\nprintf '{}'\n".format(output.replace('\n', '\\n')))
+    with pytest.raises(LuambException, match="can't get search paths"):
+        api.index_env(env_dir, 'app')
+
+
+def test_unexpected_benchmark_output(env_path):
+    env_dir = os.path.dirname(env_path)
+    api.index_env(env_dir, 'app')
+    lua = os.path.join(env_path, 'bin', 'lua')
+    with open(lua) as f:
+        script = f.read()
+    with open(lua, 'w') as f:
+        f.write(script.replace('#!/bin/sh\n', (
+            "#!/bin/sh\n"
+            "case \"$2\" in *os.clock*) echo 'not a number'; exit 0;; esac\n"
+        )))
+    with pytest.raises(LuambException, match='benchmark failed'):
+        api.benchmark_env_index(env_dir, 'app', modules=['json'], repeat=1)
+
+
+# stands in for luarocks: 'install NAME' adds a module and a manifest entry
+FAKE_LUAROCKS = """#!/bin/sh
+env_path='{}'
+if [ "$1" = install ]; then
+    echo 'return true' > "$env_path/share/lua/5.3/$2.lua"
+    echo "-- $2" >> "$env_path/lib/luarocks/rocks-5.3/manifest"
+fi
+echo "$*" >> "$env_path/luarocks.log"
+"""
+
+
+def test_luarocks_hook(env_path, monkeypatch):
+    env_dir = os.path.dirname(env_path)
+    monkeypatch.setenv('PYTHONPATH', os.path.dirname(
+        os.path.dirname(os.path.abspath(luamb.__file__))))
+    monkeypatch.setenv('LUAMB_DISABLE_HISTORY', 'true')
+    luarocks = os.path.join(env_path, 'bin', 'luarocks')
+    script = FAKE_LUAROCKS.format(env_path)
+    with open(luarocks, 'w') as f:
+        f.write(script)
+    os.chmod(luarocks, 0o755)
+    index_path = get_index_path(env_path)
+    api.index_env(env_dir, 'app')
+    real_luarocks = get_luarocks_path(env_path)
+    assert real_luarocks != luarocks
+
+    subprocess.check_call([luarocks, 'list'])
+    mtime = os.stat(index_path).st_mtime
+    # a failed refresh would leave the index as is
+    os.utime(index_path, (mtime - 10, mtime - 10))
+    subprocess.check_call([luarocks, 'list'])
+    assert os.stat(index_path).st_mtime == mtime - 10
+    subprocess.check_call([luarocks, 'install', 'lfs'])
+    with open(index_path) as f:
+        assert '["lfs"]' in f.read()
+    with open(os.path.join(env_path, 'luarocks.log')) as f:
+        assert f.read().split('\n') == ['list', 'list', 'install lfs', '']
+
+    # reindexing keeps the original script
+    api.index_env(env_dir, 'app')
+    assert get_luarocks_path(env_path) == real_luarocks
+    api.remove_env_index(env_dir, 'app')
+    assert get_luarocks_path(env_path) == luarocks
+    with open(luarocks) as f:
+        assert f.read() == script
+
+
+def test_searcher_real_interpreter(tmp_path, make_lua_env):
+    # ./?.lua precedes the indexed templates
+    env = make_lua_env(relative_first=True)
+    env_dir = env.env_dir
+    env.write_module('json', 'return "env json"')
+    env.write_module('pl.init', 'return "pl"')
+    env.write_module('pl.path', 'return "pl.path"')
+    index = api.index_env(env_dir, 'app')
+    assert sorted(index.lua_modules) == ['json', 'pl', 'pl.init', 'pl.path']
+    index_path = get_index_path(env.path)
+    code = """
+        local searchers = package.searchers or package.loaders
+        io.write(#searchers, ' ', (require('json')), ' ', (require('pl')),
+                 ' ', (require('pl.path')))
+    """
+    default = env.run(code, cwd=str(tmp_path))
+    assert default.split(' ', 1)[1] == 'env json pl pl.path'
+    searcher_count = int(default.split()[0]) + 1
+    assert env.run(code, index_path, cwd=str(tmp_path)) == (
+        '{} env json pl pl.path'.format(searcher_count))
+
+    # modules shadowing indexed ones are still found first
+    with open(str(tmp_path / 'json.lua'), 'w') as f:
+        f.write('return "local json"')
+    assert env.run(code, index_path, cwd=str(tmp_path)) == (
+        '{} local json pl pl.path'.format(searcher_count))
+
+    # the index steps aside when the search path changes at runtime
+    code = """
+        package.path = %s .. package.path
+        io.write((require('json')))
+    """ % repr(str(tmp_path / 'other' / '?.lua') + ';')
+    os.makedirs(str(tmp_path / 'other'))
+    with open(str(tmp_path / 'other' / 'json.lua'), 'w') as f:
+        f.write('return "other json"')
+    assert env.run(code, index_path) == 'other json'
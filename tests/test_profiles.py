@@ -0,0 +1,116 @@
+import json
+import os
+
+import pytest
+
+from luamb import api
+from luamb._exceptions import LuambException
+from luamb._profiles import (
+    BUILTIN_PROFILES, check_no_cflags, get_profile, load_profiles,
+)
+
+
+def test_builtin_profile_args():
+    profile = BUILTIN_PROFILES['release-native']
+    assert profile.get_hererocks_args('lua') == [
+        '--cflags=-O3 -march=native -flto']
+    assert profile.get_hererocks_args('luajit') == [
+        '--cflags=-O3 -march=native']
+
+
+def test_user_profiles(tmp_path):
+    path = str(tmp_path / 'profiles.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'release': {'cflags': '-O2', 'args': ['--no-readline']},
+            'compat': {'args': ['--compat=all'], 'description': 'compat'},
+        }, f)
+    profiles = load_profiles(path)
+    assert list(profiles) == ['release', 'release-native', 'debug', 'compat']
+    assert profiles['release'].get_hererocks_args('lua') == [
+        '--cflags=-O2', '--no-readline']
+    assert get_profile('compat', path).get_hererocks_args('luajit') == [
+        '--compat=all']
+    with pytest.raises(LuambException, match='unknown build profile'):
+        get_profile('fast', path)
+
+
+@pytest.mark.parametrize('content,error', [
+    ('[]', 'not an object'),
+    ('{"x": {"cflag": "-O3"}}', 'unknown keys: cflag'),
+    ('{"x": {"args": "--no-readline"}}', "invalid profile 'x'"),
+    ('{', 'invalid profiles file'),
+])
+def test_invalid_profiles_file(tmp_path, content, error):
+    path = str(tmp_path / 'profiles.json')
+    with open(path, 'w') as f:
+        f.write(content)
+    with pytest.raises(LuambException, match=error):
+        load_profiles(path)
+
+
+def test_check_no_cflags():
+    check_no_cflags(['--target', 'linux'])
+    for args in (['--cflags', '-O1'], ['--cflags=-O1']):
+        with pytest.raises(LuambException):
+            check_no_cflags(args)
+
+
+class FakeHererocks(object):
+    """Installs an interpreter passing any verification chunk"""
+
+    hererocks_version = '0.0.0'
+
+    class RioLua(object):
+        versions = ['5.1.5']
+        translations = {}
+
+    class LuaJIT(object):
+        versions = ['2.1']
+        translations = {}
+
+    def __init__(self):
+        self.builds = []
+
+    def main(self, argv):
+        env_path = argv[-1]
+        self.builds.append(argv)
+        bin_dir = os.path.join(env_path, 'bin')
+        if not os.path.isdir(bin_dir):
+            os.makedirs(bin_dir)
+        lua = os.path.join(bin_dir, 'lua')
+        with open(lua, 'w') as f:
+            f.write('#!/bin/sh\nprintf ok\n')
+        os.chmod(lua, 0o755)
+        key = 'LuaJIT' if argv[0] == '--luajit' else 'lua'
+        with open(os.path.join(env_path, 'hererocks.manifest'), 'w') as f:
+            json.dump({key: {'name': key, 'major version': '5.1'}}, f)
+
+
+def test_upgrade_reexpands_profile(tmp_path):
+    env_dir = str(tmp_path / 'envs')
+    os.makedirs(env_dir)
+    path = str(tmp_path / 'profiles.json')
+    with open(path, 'w') as f:
+        json.dump({'fast': {
+            'cflags': '-O2', 'jit_cflags': '-O3', 'args': ['--no-readline'],
+        }}, f)
+    hererocks = FakeHererocks()
+    api.create_env(
+        env_dir, 'app', 'lua', '5.1.5', hererocks_args=['--target=linux'],
+        profile=get_profile('fast', path), compiler_cache='off',
+        quiet=True, hererocks=hererocks)
+    assert hererocks.builds[-1][2:-1] == [
+        '--cflags=-O2', '--no-readline', '--target=linux']
+
+    api.upgrade_env(
+        env_dir, 'app', lua_type='luajit', lua_version='2.1',
+        compiler_cache='off', quiet=True, profiles_path=path,
+        hererocks=hererocks)
+    assert hererocks.builds[-1][:2] == ['--luajit', '2.1']
+    assert hererocks.builds[-1][2:-1] == [
+        '--cflags=-O3', '--no-readline', '--target=linux']
+    spec = api.get_env(env_dir, 'app').spec
+    assert (spec.lua_type, spec.profile) == ('luajit', 'fast')
+    assert spec.hererocks_args == [
+        '--cflags=-O3', '--no-readline', '--target=linux']
@@ -0,0 +1,49 @@
+import os
+
+from luamb._rocks import (
+    LockedRock, get_rocks_tree, iter_installed_rocks, plan_sync,
+)
+
+
+def make_rock(rocks_tree, name, version, lib=False):
+    rock_dir = os.path.join(rocks_tree, name, version)
+    os.makedirs(rock_dir)
+    with open(os.path.join(rock_dir, 'rock_manifest'), 'w') as f:
+        f.write('rock_manifest = {\n')
+        if lib:
+            f.write('   lib = {\n      ["' + name + '.so"] = "abc"\n   },\n')
+        f.write('   lua = {}\n}\n')
+
+
+def test_iter_installed_rocks(tmp_path):
+    rocks_tree = str(tmp_path / 'lib' / 'luarocks' / 'rocks-5.1')
+    make_rock(rocks_tree, 'lpeg', '1.0.2-1', lib=True)
+    make_rock(rocks_tree, 'inspect', '3.1.3-0')
+    open(os.path.join(rocks_tree, 'manifest'), 'w').close()
+    assert get_rocks_tree(str(tmp_path)) == rocks_tree
+    rocks = [
+        (rock.name, rock.version, rock.has_c_modules)
+        for rock in iter_installed_rocks(rocks_tree)
+    ]
+    assert rocks == [
+        ('inspect', '3.1.3-0', False),
+        ('lpeg', '1.0.2-1', True),
+    ]
+
+
+def test_plan_sync():
+    installed = [
+        LockedRock('inspect', '3.1.3-0'),
+        LockedRock('lpeg', '1.0.1-1', True),
+        LockedRock('penlight', '1.13.1-1'),
+    ]
+    locked = [
+        LockedRock('inspect', '3.1.3-0'),
+        LockedRock('lpeg', '1.0.2-1', True),
+        LockedRock('luafilesystem', '1.8.0-1', True),
+    ]
+    to_remove, to_install = plan_sync(installed, locked)
+    assert [r.key for r in to_remove] == [
+        ('lpeg', '1.0.1-1'), ('penlight', '1.13.1-1')]
+    assert [r.key for r in to_install] == [
+        ('lpeg', '1.0.2-1'), ('luafilesystem', '1.8.0-1')]
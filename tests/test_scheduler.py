@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+import pytest
+
+from luamb import api
+from luamb._exceptions import LuambException
+from luamb._ccache import find_executable
+from luamb._scheduler import BuildScheduler, CommandPrefixer, parse_ionice
+
+
+@pytest.fixture()
+def env_dir(tmp_path):
+    return str(tmp_path)
+
+
+def make_scheduler(env_dir, max_builds, **kwargs):
+    scheduler = api.get_build_scheduler(env_dir, max_builds, **kwargs)
+    scheduler.poll_interval = 0.01
+    return scheduler
+
+
+def test_admission_limit_and_fifo(env_dir):
+    lock = threading.Lock()
+    running = []
+    max_running = []
+    started = []
+
+    def build(name):
+        scheduler = make_scheduler(env_dir, 2, total_jobs=8)
+        with scheduler.admit(name) as slot:
+            assert slot.make_jobs == 4
+            assert os.environ['MAKEFLAGS'] == '-j4'
+            with lock:
+                started.append(name)
+                running.append(name)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(name)
+
+    threads = []
+    for index in range(6):
+        thread = threading.Thread(target=build, args=(str(index),))
+        thread.start()
+        threads.append(thread)
+        # tickets are numbered in the order of arrival
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    assert max(max_running) == 2
+    assert started == [str(index) for index in range(6)]
+    assert api.get_build_queue(env_dir) == ([], [])
+
+
+def test_queue_position_and_status(env_dir):
+    holder = make_scheduler(env_dir, 1)
+    positions = []
+    admitted = threading.Event()
+
+    def wait():
+        scheduler = make_scheduler(env_dir, 1, on_wait=positions.append)
+        with scheduler.admit('waiter'):
+            admitted.set()
+
+    with holder.admit('holder'):
+        thread = threading.Thread(target=wait)
+        thread.start()
+        for _ in range(100):
+            running, waiting = api.get_build_queue(env_dir)
+            if waiting:
+                break
+            time.sleep(0.01)
+        assert [build['env'] for build in running] == ['holder']
+        assert [build['env'] for build in waiting] == ['waiter']
+        assert not admitted.is_set()
+    thread.join()
+    assert admitted.is_set()
+    assert positions == [1]
+
+
+def test_dead_ticket_is_skipped(env_dir):
+    scheduler = make_scheduler(env_dir, 1)
+    scheduler._makedirs()
+    # a ticket of a crashed process: nobody holds its lock
+    with open(os.path.join(scheduler.queue_dir, '000000000000.ticket'),
+              'w') as f:
+        f.write('{}')
+    with scheduler.admit('env'):
+        pass
+    assert os.listdir(scheduler.queue_dir) == []
+
+
+@pytest.mark.skipif(not find_executable('nice'), reason='no nice')
+def test_priority_of_build_commands(env_dir):
+    niceness = os.nice(0)
+    scheduler = make_scheduler(env_dir, 1, nice=niceness + 5)
+    with scheduler.admit('env') as slot:
+        # the calling process is not reniced
+        assert os.nice(0) == niceness
+        assert slot.command_prefix == ['nice', '-n', '5']
+        output = CommandPrefixer(slot).check_output(['nice'])
+        assert int(output) == niceness + 5
+    assert os.nice(0) == niceness
+    with make_scheduler(env_dir, 1, nice=niceness).admit('env') as slot:
+        assert slot.command_prefix == []
+
+
+def test_invalid_settings(env_dir):
+    with pytest.raises(LuambException):
+        BuildScheduler(env_dir, 0)
+    assert parse_ionice('best-effort:7') == ['-c', '2', '-n', '7']
+    assert parse_ionice('idle') == ['-c', '3']
+    with pytest.raises(LuambException):
+        parse_ionice('fast')
+    with pytest.raises(LuambException):
+        parse_ionice('idle:9')
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from luamb._exceptions import LuambException
+from luamb._scratch import (
+    DEFAULT_TMPFS_DIR, ScratchBuild, parse_tmpfs_setting,
+)
+
+
+@pytest.mark.parametrize('value,expected', [
+    (None, None),
+    ('', None),
+    ('off', None),
+    ('on', DEFAULT_TMPFS_DIR),
+    (' /mnt/ram ', '/mnt/ram'),
+])
+def test_parse_tmpfs_setting(value, expected):
+    assert parse_tmpfs_setting(value) == expected
+
+
+def test_scratch_build_copies_env_out(tmp_path):
+    tmpfs = tmp_path / 'tmpfs'
+    tmpfs.mkdir()
+    env_path = str(tmp_path / 'envs' / 'env')
+    os.mkdir(os.path.dirname(env_path))
+    scratch = ScratchBuild(
+        str(tmpfs), env_path, str(tmp_path / 'envs' / 'staging'),
+        min_free_bytes=0)
+    with scratch.activate():
+        assert os.path.islink(env_path)
+        with open(os.path.join(env_path, 'file'), 'w') as f:
+            f.write('data')
+    assert not os.path.islink(env_path)
+    with open(os.path.join(env_path, 'file')) as f:
+        assert f.read() == 'data'
+    assert os.listdir(str(tmpfs)) == []
+    assert list(scratch.timer.phases) == [
+        'scratch setup', 'build', 'copy to environment directory',
+        'scratch cleanup']
+
+
+def test_scratch_build_failure_leaves_no_env(tmp_path):
+    env_path = str(tmp_path / 'env')
+    scratch = ScratchBuild(
+        str(tmp_path), env_path, str(tmp_path / 'staging'), min_free_bytes=0)
+    with pytest.raises(RuntimeError):
+        with scratch.activate():
+            raise RuntimeError
+    assert not os.path.lexists(env_path)
+
+
+def test_scratch_build_not_enough_space(tmp_path):
+    scratch = ScratchBuild(
+        str(tmp_path), str(tmp_path / 'env'), str(tmp_path / 'staging'),
+        min_free_bytes=2 ** 62)
+    with pytest.raises(LuambException, match='not enough free space'):
+        scratch.check()
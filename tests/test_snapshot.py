@@ -0,0 +1,169 @@
+import json
+import os
+
+import pytest
+
+from luamb import _snapshot, api
+from luamb._exceptions import LuambException
+from luamb._luamb import Luamb
+from luamb._rocks import LockedRock
+from luamb._snapshot import break_links, exchange
+
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture()
+def env_dir(tmp_path):
+    env_dir = str(tmp_path / 'envs')
+    env_path = os.path.join(env_dir, 'app')
+    write(os.path.join(env_path, 'bin', 'lua'), 'lua 5.3.5')
+    write(os.path.join(env_path, '.project'), '/srv/app')
+    rocks_tree = os.path.join(env_path, 'lib', 'luarocks', 'rocks-5.3')
+    write(os.path.join(rocks_tree, 'manifest'), 'modules = {}')
+    write(os.path.join(env_path, 'share', 'lua', '5.3', 'json.lua'), 'v1')
+    os.symlink('json.lua', os.path.join(
+        env_path, 'share', 'lua', '5.3', 'cjson.lua'))
+    return env_dir
+
+
+def test_snapshot_rollback(env_dir):
+    env_path = os.path.join(env_dir, 'app')
+    share = os.path.join(env_path, 'share', 'lua', '5.3')
+    snapshot = api.snapshot_env(env_dir, 'app', 'before')
+    assert snapshot.method in ('hardlink', 'reflink')
+    with pytest.raises(LuambException):
+        api.snapshot_env(env_dir, 'app', 'before')
+    if snapshot.method == 'hardlink':
+        assert os.stat(os.path.join(share, 'json.lua')).st_nlink == 2
+    # files rewritten in place are not shared
+    manifest = os.path.join('lib', 'luarocks', 'rocks-5.3', 'manifest')
+    assert os.stat(os.path.join(env_path, manifest)).st_nlink == 1
+    assert os.stat(os.path.join(env_path, '.project')).st_nlink == 1
+
+    write(os.path.join(env_path, manifest), 'modules = {json = {}}')
+    os.remove(os.path.join(share, 'json.lua'))
+    write(os.path.join(share, 'json.lua'), 'v2')
+    write(os.path.join(share, 'extra.lua'), 'v2')
+    inode = os.stat(env_path).st_ino
+
+    api.rollback_env(env_dir, 'app', 'before')
+    assert os.stat(env_path).st_ino != inode
+    assert read(os.path.join(share, 'json.lua')) == 'v1'
+    assert read(os.path.join(share, 'cjson.lua')) == 'v1'
+    assert os.path.islink(os.path.join(share, 'cjson.lua'))
+    assert not os.path.exists(os.path.join(share, 'extra.lua'))
+    assert read(os.path.join(env_path, manifest)) == 'modules = {}'
+    assert os.listdir(os.path.join(env_dir, '.luamb', 'tmp')) == []
+
+    # the snapshot is kept
+    api.rollback_env(env_dir, 'app', 'before')
+    with pytest.raises(LuambException):
+        api.rollback_env(env_dir, 'app', 'missing')
+
+
+def test_list_delete(env_dir):
+    api.snapshot_env(env_dir, 'app', 'one')
+    api.snapshot_env(env_dir, 'app', 'two')
+    snapshots = api.list_env_snapshots(env_dir, 'app', usage=True)
+    assert [snapshot.tag for snapshot in snapshots] == ['one', 'two']
+    if snapshots[0].method == 'hardlink':
+        # only copied files and directories
+        before = snapshots[0].unique_size
+        assert before < 64 * 1024
+        # a file only the snapshot keeps
+        os.remove(os.path.join(env_dir, 'app', 'bin', 'lua'))
+        os.remove(os.path.join(snapshots[1].path, 'bin', 'lua'))
+        assert api.list_env_snapshots(
+            env_dir, 'app', usage=True)[0].unique_size > before
+
+    api.delete_env_snapshot(env_dir, 'app', 'one')
+    assert [snapshot.tag for snapshot in api.list_env_snapshots(
+        env_dir, 'app')] == ['two']
+    with pytest.raises(LuambException):
+        api.snapshot_env(env_dir, 'app', '../escape')
+
+    api.remove_env(env_dir, 'app')
+    assert not os.path.exists(os.path.join(env_dir, '.luamb', 'snapshots',
+                                           'app'))
+
+
+# installs rewrite module files in place like luarocks does
+FAKE_LUAROCKS = """#!/bin/sh
+env_path='{env_path}'
+rock_dir="$env_path/lib/luarocks/rocks-5.3/$3/$4"
+case "$1" in
+install)
+    mkdir -p "$rock_dir"
+    echo 'rock_manifest = {{}}' > "$rock_dir/rock_manifest"
+    printf '%s' "$4" > "$env_path/share/lua/5.3/json.lua";;
+remove)
+    rm -r "$rock_dir";;
+esac
+"""
+
+
+def test_sync_keeps_snapshot(env_dir, tmp_path):
+    env_path = os.path.join(env_dir, 'app')
+    luarocks = os.path.join(env_path, 'bin', 'luarocks')
+    write(luarocks, FAKE_LUAROCKS.format(env_path=env_path))
+    os.chmod(luarocks, 0o755)
+    write(os.path.join(env_path, 'lib', 'luarocks', 'rocks-5.3', 'json',
+                       '1.0-1', 'rock_manifest'), 'rock_manifest = {}')
+    snapshot = api.snapshot_env(env_dir, 'app', 'before')
+    lock = api.freeze_env(env_dir, 'app')
+    lock['rocks'] = [LockedRock('json', '2.0-1').to_dict()]
+    lockfile = str(tmp_path / 'luamb.lock')
+    write(lockfile, json.dumps(lock))
+
+    result = api.sync_env(env_dir, 'app', lockfile, quiet=True)
+    assert [r.key for r in result.installed] == [('json', '2.0-1')]
+    assert read(os.path.join(env_path, 'share', 'lua', '5.3',
+                             'json.lua')) == '2.0-1'
+    assert read(os.path.join(snapshot.path, 'share', 'lua', '5.3',
+                             'json.lua')) == 'v1'
+
+
+def test_break_links(tmp_path):
+    path = str(tmp_path / 'file')
+    write(path, 'data')
+    os.link(path, str(tmp_path / 'link'))
+    # the other name keeps the original inode
+    assert break_links(str(tmp_path)) == 1
+    write(path, 'changed')
+    assert read(str(tmp_path / 'link')) == 'data'
+    assert break_links(str(tmp_path)) == 0
+
+
+def test_exchange(tmp_path):
+    write(str(tmp_path / 'a' / 'file'), 'a')
+    write(str(tmp_path / 'b' / 'file'), 'b')
+    exchange(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    assert read(str(tmp_path / 'a' / 'file')) == 'b'
+    assert read(str(tmp_path / 'b' / 'file')) == 'a'
+
+
+def test_ls_skips_usage(env_dir, capsys, monkeypatch):
+    api.snapshot_env(env_dir, 'app', 'one')
+    walked = []
+    original = _snapshot.get_unique_size
+    monkeypatch.setattr(
+        _snapshot, 'get_unique_size',
+        lambda path: walked.append(path) or original(path))
+    luamb = Luamb(env_dir, history=False)
+    luamb.run(['ls'])
+    output = capsys.readouterr().out
+    assert 'one' in output and 'unique' not in output
+    assert walked == []
+    luamb.run(['info', 'app'])
+    assert 'unique' in capsys.readouterr().out
+    assert len(walked) == 1
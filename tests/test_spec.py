@@ -0,0 +1,37 @@
+import json
+
+from luamb._spec import (
+    EnvSpec, get_lua_abi, read_env_spec, write_env_spec,
+)
+
+
+def test_spec_roundtrip(tmp_path):
+    spec = EnvSpec('luajit', '2.1', '3.8.0', ['--cflags', '-O3'], 'H 0.25',
+                   profile='release')
+    write_env_spec(str(tmp_path), spec)
+    assert read_env_spec(str(tmp_path)).to_dict() == spec.to_dict()
+
+
+def test_spec_from_hererocks_manifest(tmp_path):
+    manifest = {
+        'LuaJIT': {
+            'name': 'LuaJIT', 'source': 'git',
+            'repo': 'https://github.com/luajit/luajit', 'commit': 'abc',
+            'c flags': '-O3', 'compat': 'default', 'major version': '5.1',
+        },
+        'luarocks': {'name': 'LuaRocks', 'source': 'release',
+                     'version': '3.8.0'},
+        'version': 3,
+    }
+    with open(str(tmp_path / 'hererocks.manifest'), 'w') as f:
+        json.dump(manifest, f)
+    spec = read_env_spec(str(tmp_path))
+    assert spec.lua_type == 'luajit'
+    assert spec.lua_version == 'https://github.com/luajit/luajit@abc'
+    assert spec.luarocks_version == '3.8.0'
+    assert spec.hererocks_args == ['--cflags', '-O3']
+    assert get_lua_abi(manifest) == ('luajit', '5.1')
+
+
+def test_no_spec(tmp_path):
+    assert read_env_spec(str(tmp_path)) is None